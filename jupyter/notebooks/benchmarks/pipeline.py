@@ -0,0 +1,238 @@
+#####
+# Times every stage of generate_totals, and the whole thing, on made up scenarios of different sizes
+#
+# The stages are timed separately:
+#     generate_series     one draw of num_samples samples
+#     set_item_balances   adding every item, which projects it over every year ("paths" mode projects its samples instead)
+#     generate_total      the totals of all four ledgers
+#     process_expenses    the simulations for every year, and the distributions they take from the investments
+#     generate_networth
+#     graph data          building the DataFrames (every *_by_year, which are only built when they're used) and the amounts the graphs draw
+# and "end to end" is all of them together.
+#
+# Starting from a base scenario (10,000 samples, 40 years, 5 items of each kind), one thing is changed at a time:
+#     num_samples   1,000 to 1,000,000
+#     years         10 to 80
+#     items         1 to 50 of each kind (income, expenses, non-retirement and retirement investments)
+# and every size is run with each of the engines below, so they can be compared side by side.
+# Once an engine takes longer than --max-seconds, the bigger sizes are skipped for it.  So is anything that would need more than --max-memory.
+#
+# Run from jupyter/notebooks with
+#     python benchmarks/pipeline.py
+#     python benchmarks/pipeline.py --quick --engines vectorized incremental
+# The results are written to jupyter/data/benchmark-pipeline.json, with a graph of how each engine scales in benchmark-pipeline.png
+#####
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import financeTool as tool
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
+#####
+# The Scenario settings that make up each engine
+#####
+ENGINES = {
+    "legacy": {"expense_engine": "legacy", "reprojection": "full"},
+    "vectorized": {"expense_engine": "vectorized", "reprojection": "full"},
+    "incremental": {"expense_engine": "vectorized", "reprojection": "incremental"},
+    "paths": {"simulation_mode": "paths"},
+    "correlated": {"simulation_mode": "paths", "return_correlation": 0.8},
+    "streaming": {"streaming": True}
+}
+
+BASE = {"num_samples": 10000, "years": 40, "items": 5}
+
+SIZES = {
+    "num_samples": [1000, 10000, 100000, 1000000],
+    "years": [10, 20, 40, 80],
+    "items": [1, 5, 10, 25, 50]
+}
+
+QUICK_SIZES = {
+    "num_samples": [1000, 10000, 50000],
+    "years": [10, 40],
+    "items": [1, 5, 10]
+}
+
+STAGES = ["generate_series", "set_item_balances", "generate_total", "process_expenses", "generate_networth", "graph data"]
+
+START_AGE = 30
+
+
+# Adds items of each kind to a scenario, with made up but realistic amounts
+# Income stops at retirement, and the expenses are split into before and after retirement so distributions get taken
+def add_items(scenario, years, items, rng):
+    death_age = START_AGE + years
+    retirement_age = START_AGE + (years * 3) // 4
+    scenario.retirement_age = retirement_age
+
+    for item_num in range(items):
+        salary = rng.uniform(40000, 120000)
+        scenario.add_income(name="income " + str(item_num),
+                            starting_amt_low=salary,
+                            starting_amt_high=salary * 1.2,
+                            start_age=START_AGE,
+                            end_age=retirement_age,
+                            growth_perc_low=0.01,
+                            growth_perc_high=0.05)
+
+        spending = rng.uniform(30000, 80000)
+        scenario.add_expense(name="expense " + str(item_num),
+                             starting_amt_low=spending,
+                             starting_amt_high=spending * 1.3,
+                             start_age=START_AGE + (item_num % 2) * (years // 2),
+                             end_age=death_age if (item_num % 2) else START_AGE + years // 2,
+                             growth_perc_low=0.02,
+                             growth_perc_high=0.05)
+
+        for add, kind in [(scenario.add_nonretirement_investment, "non-retirement "), (scenario.add_retirement_investment, "retirement ")]:
+            balance = rng.uniform(5000, 200000)
+            add(name=kind + str(item_num),
+                starting_amt_low=balance,
+                starting_amt_high=balance,
+                start_age=START_AGE,
+                end_age=death_age,
+                growth_perc_low=-0.02,
+                growth_perc_high=0.12,
+                annual_contrib_amt_low=5000,
+                annual_contrib_amt_high=10000,
+                annual_contrib_start_age=START_AGE,
+                annual_contrib_end_age=retirement_age)
+
+# Runs the stages of generate_totals one at a time, and returns how long each took in seconds
+def run_pipeline(engine, num_samples, years, items):
+    np.random.seed(0)
+    scenario = tool.Scenario(2022, START_AGE, START_AGE + years)
+    scenario.num_samples = num_samples
+    for name, value in ENGINES[engine].items():
+        setattr(scenario, name, value)
+
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    start = time.perf_counter()
+    scenario.generate_series(0, 1, ("benchmark",))
+    timings["generate_series"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    add_items(scenario, years, items, np.random.default_rng(0))
+    timings["set_item_balances"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scenario.generate_total(scenario.income_ledger, scenario.income_paths)
+    scenario.generate_total(scenario.expenses_ledger, scenario.expenses_paths)
+    timings["generate_total"] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    scenario.process_expenses()
+    timings["process_expenses"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scenario.generate_total(scenario.nonretirement_investments_ledger, scenario.nonretirement_investment_paths)
+    scenario.generate_total(scenario.retirement_investments_ledger, scenario.retirement_investment_paths)
+    timings["generate_total"] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    scenario.generate_networth()
+    timings["generate_networth"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scenario.build_frames()
+    for file_name, attribute in tool.RESULT_FILES:
+        getattr(scenario, attribute)
+    for ledger in [scenario.expenses_ledger, scenario.income_ledger, scenario.nonretirement_investments_ledger, scenario.retirement_investments_ledger]:
+        tool.generate_amounts_for_graph(ledger)
+    timings["graph data"] = time.perf_counter() - start
+
+    timings["end to end"] = sum(timings[stage] for stage in STAGES)
+    return timings
+
+# Roughly how many bytes an engine needs at its largest, so runs that won't fit can be skipped
+# "paths" keeps three (num_samples x years) matrices per item, the others a handful of num_samples arrays (or chunks of them)
+def estimate_memory(engine, num_samples, years, items):
+    if engine == "paths":
+        return num_samples * years * 3 * 8 * items * 4
+    if engine == "streaming":
+        return 65536 * 8 * 10 * items
+    return num_samples * 8 * 10 * items
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of generate_totals on made up scenarios of different sizes")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES.keys()), choices=list(ENGINES.keys()))
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a quick check")
+    parser.add_argument("--max-seconds", type=float, default=60, help="once a run takes longer than this, bigger sizes are skipped for that engine")
+    parser.add_argument("--max-memory", type=float, default=4e9, help="runs estimated to need more bytes than this are skipped")
+    parser.add_argument("--output", default=os.path.join(DATA_DIR, "benchmark-pipeline"), help="path of the .json and .png, without the extension")
+    args = parser.parse_args()
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = []
+
+    for dimension, values in sizes.items():
+        for engine in args.engines:
+            too_slow = False
+            for value in values:
+                size = dict(BASE, **{dimension: value})
+                row = {"dimension": dimension, "engine": engine, **size}
+
+                if too_slow or (estimate_memory(engine, size["num_samples"], size["years"], size["items"]) > args.max_memory):
+                    row["skipped"] = True
+                    results.append(row)
+                    continue
+
+                row.update(run_pipeline(engine, size["num_samples"], size["years"], size["items"]))
+                row["skipped"] = False
+                results.append(row)
+                print(dimension, value, engine, '{:.3f}s'.format(row["end to end"]))
+                too_slow = row["end to end"] > args.max_seconds
+
+    output = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.platform(),
+        "processors": os.cpu_count(),
+        "base": BASE,
+        "engines": {engine: ENGINES[engine] for engine in args.engines},
+        "results": results
+    }
+    with open(args.output + ".json", "w") as f:
+        json.dump(output, f, indent=2)
+
+    #####
+    # One log-log graph per dimension with the end to end time of every engine,
+    # and the time of each stage for every engine at the base size
+    #####
+    results = pd.DataFrame([row for row in results if not row["skipped"]])
+    fig, axes = plt.subplots(1, len(sizes) + 1, figsize=(6 * (len(sizes) + 1), 5))
+    for ax, dimension in zip(axes, sizes):
+        for engine in args.engines:
+            data = results[(results["dimension"] == dimension) & (results["engine"] == engine)]
+            ax.plot(data[dimension], data["end to end"], marker="o", label=engine)
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel(dimension)
+        ax.set_ylabel("seconds, end to end")
+        ax.grid(True, which="both", alpha=0.3)
+        ax.legend()
+
+    base = results[(results["dimension"] == "num_samples") & (results["num_samples"] == BASE["num_samples"])].set_index("engine")
+    base[STAGES].plot.bar(stacked=True, ax=axes[-1])
+    axes[-1].set_ylabel("seconds at the base size")
+    fig.tight_layout()
+    fig.savefig(args.output + ".png")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#####
+# Compares how quickly each sampler's 90% bounds settle as the number of samples goes up
+#
+# For every sampler and sample count the same two estimates are repeated with different seeds:
+#     one year:  the 5th and 95th percentile of one year of an investment, i.e. generate_samples_for_year
+#     paths:     the 5th and 95th percentile of an investment's balance after several years in "paths" mode
+# The error is the root mean square distance from a reference worked out with a very large number of random samples,
+# as a fraction of the width of the reference's 90% range.
+#
+# Run from jupyter/notebooks with
+#     python benchmarks/samplers.py
+# A table is printed, and the results are written to jupyter/data/benchmark-samplers.csv and .png
+#####
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import financeTool as tool
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data")
+
+#####
+# An investment like the ones in the README, starting at $50k - $65k, growing -2% to 10% with $20k - $25k contributions
+#####
+START_AGE = 40
+YEARS = 10
+ITEM = {
+    "starting_amt_low": 50000,
+    "starting_amt_high": 65000,
+    "growth_perc_low": -0.02,
+    "growth_perc_high": 0.10,
+    "annual_contrib_amt_low": 20000,
+    "annual_contrib_amt_high": 25000
+}
+
+
+def new_scenario(sampler, num_samples, seed):
+    scenario = tool.Scenario(2022, START_AGE, START_AGE + YEARS)
+    scenario.sampler = sampler
+    scenario.num_samples = num_samples
+    scenario.seed = seed
+    return scenario
+
+def one_year_samples(scenario):
+    return scenario.generate_samples_for_year(ITEM["starting_amt_low"],
+                                              ITEM["starting_amt_high"],
+                                              ITEM["growth_perc_low"],
+                                              ITEM["growth_perc_high"],
+                                              ITEM["annual_contrib_amt_low"],
+                                              ITEM["annual_contrib_amt_high"],
+                                              ("benchmark", "one year"),
+                                              0,
+                                              scenario.num_samples)
+
+def paths_samples(scenario):
+    paths = scenario.generate_item_paths(START_AGE,
+                                         START_AGE + YEARS,
+                                         ITEM["growth_perc_low"],
+                                         ITEM["growth_perc_high"],
+                                         ITEM["starting_amt_low"],
+                                         ITEM["starting_amt_high"],
+                                         ITEM["annual_contrib_amt_low"],
+                                         ITEM["annual_contrib_amt_high"],
+                                         START_AGE,
+                                         START_AGE + YEARS,
+                                         ("benchmark", "paths"))
+    return paths["amount"][:, -1]
+
+PROBLEMS = {
+    "one year": one_year_samples,
+    "paths": paths_samples
+}
+
+def get_bounds(samples):
+    return np.quantile(samples, [0.05, 0.95])
+
+def main():
+    parser = argparse.ArgumentParser(description="Error of the 90% bounds versus sample count for each sampler")
+    parser.add_argument("--sample-counts", type=int, nargs="+", default=[250, 500, 1000, 2000, 4000, 8000, 16000])
+    parser.add_argument("--repeats", type=int, default=20, help="how many seeds each estimate is repeated with")
+    parser.add_argument("--reference-samples", type=int, default=400000)
+    parser.add_argument("--output", default=os.path.join(DATA_DIR, "benchmark-samplers"), help="path of the .csv and .png, without the extension")
+    args = parser.parse_args()
+
+    rows = []
+    for problem, draw in PROBLEMS.items():
+        reference = get_bounds(draw(new_scenario("random", args.reference_samples, 0)))
+        width = reference[1] - reference[0]
+
+        for sampler in tool.SAMPLERS:
+            for num_samples in args.sample_counts:
+                errors = [get_bounds(draw(new_scenario(sampler, num_samples, seed))) - reference for seed in range(1, args.repeats + 1)]
+                rows.append({
+                    "problem": problem,
+                    "sampler": sampler,
+                    "num_samples": num_samples,
+                    "error": np.sqrt(np.mean(np.square(errors))) / width
+                })
+
+    results = pd.DataFrame(rows)
+    print(results.pivot_table(index=["problem", "num_samples"], columns="sampler", values="error").to_string(float_format="{:.4f}".format))
+    results.to_csv(args.output + ".csv", index=False)
+
+    #####
+    # One log-log graph per problem, with a line for each sampler
+    #####
+    fig, axes = plt.subplots(1, len(PROBLEMS), figsize=(14, 5))
+    for ax, problem in zip(axes, PROBLEMS):
+        for sampler in tool.SAMPLERS:
+            data = results[(results["problem"] == problem) & (results["sampler"] == sampler)]
+            ax.plot(data["num_samples"], data["error"], marker="o", label=sampler)
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_title(problem)
+        ax.set_xlabel("num_samples")
+        ax.set_ylabel("error of the 90% bounds (fraction of the range)")
+        ax.grid(True, which="both", alpha=0.3)
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(args.output + ".png")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#####
+# Runs scenarios from the command line, without jupyter
+#
+# Each scenario is a YAML or JSON file with the ages given to setup(), any Scenario settings, and the items to add,
+# using the same names as the add_* functions:
+#
+#     current_year: 2022
+#     current_age: 37
+#     death_age: 100
+#     settings:
+#       retirement_age: 60
+#       num_samples: 10000
+#     income:
+#       - name: job salary
+#         starting_amt_low: 85000
+#         starting_amt_high: 100000
+#         start_age: 37
+#         end_age: 60
+#         growth_perc_low: 0.01
+#         growth_perc_high: 0.05
+#     expenses:
+#       - ...
+#     nonretirement_investments:
+#       - ...
+#     retirement_investments:
+#       - ...
+#
+# Items are added in the order they're in the file.  Every file is run with generate_totals(), and its output (the CSV files, the log,
+# and the graphs with --graphs) is written to <output>/<file name without the extension>
+#
+# Run from jupyter/notebooks with
+#     python financeCli.py my-plan.yaml
+#     python financeCli.py plans/*.yaml --jobs 8 --output ../data/plans --graphs
+#####
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import financeTool as tool
+
+#####
+# The lists of items a scenario file can have, and the add_* function each one uses
+#####
+ITEM_FUNCTIONS = {
+    "income": "add_income",
+    "expenses": "add_expense",
+    "nonretirement_investments": "add_nonretirement_investment",
+    "retirement_investments": "add_retirement_investment"
+}
+
+AGES = ["current_year", "current_age", "death_age"]
+
+
+# Reads a scenario file.  YAML needs PyYAML, JSON doesn't need anything
+def load_scenario_file(path):
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in [".yaml", ".yml"]:
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+# Builds a scenario from what's in a scenario file, see the top of this file
+def scenario_from_file(contents):
+    for key in contents:
+        if key not in AGES + ["settings"] + list(ITEM_FUNCTIONS.keys()):
+            raise Exception(key, "is not part of a scenario file.  Use " + ", ".join(AGES + ["settings"] + list(ITEM_FUNCTIONS.keys())))
+    for key in AGES:
+        if key not in contents:
+            raise Exception(key, "is missing.  Every scenario file needs " + ", ".join(AGES))
+
+    scenario = tool.Scenario()
+    for name, value in (contents.get("settings") or {}).items():
+        if name not in tool.SCENARIO_SETTINGS:
+            raise Exception(name, "is not a setting.  Use one of " + ", ".join(tool.SCENARIO_SETTINGS))
+        setattr(scenario, name, value)
+
+    scenario.setup(contents["current_year"], contents["current_age"], contents["death_age"])
+    for key, function_name in [(key, ITEM_FUNCTIONS[key]) for key in contents if key in ITEM_FUNCTIONS]:
+        for arguments in contents[key] or []:
+            getattr(scenario, function_name)(**arguments)
+    return scenario
+
+# Runs in the worker processes (or in this one with --jobs 1).  Runs one scenario file and writes its output to output_dir
+# Returns how long it took in seconds
+def run_scenario_file(path, output_dir, graphs):
+    start = time.perf_counter()
+    scenario = scenario_from_file(load_scenario_file(path))
+    os.makedirs(output_dir, exist_ok=True)
+    scenario.output_dir = output_dir
+    scenario.generate_totals()
+
+    if graphs:
+        #there is no screen to show them on, they're only saved
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        scenario.show_account_types_graph()
+        scenario.show_networth_graph()
+        plt.close("all")
+
+    return time.perf_counter() - start
+
+def print_result(path, output_dir, seconds=None, error=None):
+    if error is not None:
+        print(path + ": failed:", error, file=sys.stderr)
+    else:
+        print(path + ": written to " + output_dir + " in " + '{:.1f}'.format(seconds) + "s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run scenarios from YAML or JSON files and write their output")
+    parser.add_argument("files", nargs="+", help="scenario files, .yaml, .yml or .json")
+    parser.add_argument("--output", default=".", help="each file's output is written to <output>/<file name without the extension>")
+    parser.add_argument("--jobs", type=int, default=1, help="how many files to run at once, each in its own process")
+    parser.add_argument("--graphs", action="store_true", help="also save the account types and networth graphs")
+    args = parser.parse_args()
+
+    runs = {path: os.path.join(args.output, os.path.splitext(os.path.basename(path))[0]) for path in args.files}
+    if len(set(runs.values())) < len(runs):
+        parser.error("two of the files have the same name, so their output would be written to the same directory")
+
+    #####
+    # A file that fails is reported and the rest still run
+    #####
+    failed = 0
+    if args.jobs == 1:
+        for path, output_dir in runs.items():
+            try:
+                print_result(path, output_dir, seconds=run_scenario_file(path, output_dir, args.graphs))
+            except Exception as error:
+                print_result(path, output_dir, error=error)
+                failed += 1
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {executor.submit(run_scenario_file, path, output_dir, args.graphs): path for path, output_dir in runs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                if future.exception() is not None:
+                    print_result(path, runs[path], error=future.exception())
+                    failed += 1
+                else:
+                    print_result(path, runs[path], seconds=future.result())
+
+    if failed:
+        print(failed, "of", len(runs), "scenarios failed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
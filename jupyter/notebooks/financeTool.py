@@ -1,512 +1,3101 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import warnings
+import types
+import sys
+import os
+import zlib
+import itertools
+import concurrent.futures
+import contextlib
+import time
+import array
+import json
+import importlib.util
+import hashlib
+import pickle
+
+
+#####
+# The Scenario settings that are copied when a scenario is rebuilt from its spec, and that a sweep can override
+#####
+SCENARIO_SETTINGS = ["num_samples", "retirement_age", "expense_engine", "simulation_mode", "reprojection", "seed",
+                     "streaming", "chunk_size", "sketch_capacity", "adaptive", "adaptive_batch_size", "adaptive_tolerance",
+                     "sampler", "percentiles", "log_level", "log_format", "output_dir", "export_format", "export_samples",
+                     "cache_dir", "cache_size", "cache_bypass", "recompute", "return_correlation", "historical_returns", "block_size",
+                     "distribution_strategy", "withdrawal_rate"]
+
+#####
+# Settings that don't change the results, so they're left out of the cache key, see Scenario.get_cache_path
+#####
+OUTPUT_SETTINGS = ["log_format", "output_dir", "export_format", "export_samples", "cache_dir", "cache_size", "cache_bypass", "recompute"]
+
+#####
+# The settings that make a copy of a scenario run in "paths" mode, for comparisons that need to follow each simulation from year to year
+# In "bands" mode every year's balances are drawn again from its 90% range, so how often the accounts run out doesn't say how often any one simulation would
+#####
+PATHS_SETTINGS = {"simulation_mode": "paths", "streaming": False, "adaptive": False, "recompute": "full"}
+
+#####
+# Part of every cache key.  Change it whenever the same inputs would give different results, so older cached results aren't used
+#####
+CACHE_VERSION = 5
+
+#####
+# When a scenario has a seed, the samples of every draw are made in chunks of this many, each from its own random stream
+# The chunks are what let part of a draw be made on its own (e.g. by a worker) and still match the whole draw exactly
+# Changing this changes the samples for a given seed
+#####
+RANDOM_CHUNK_SIZE = 4096
+
+#####
+# How many of the most recently drawn chunks random_normal keeps, so drawing a chunk a little at a time (e.g. adaptive mode's batches) doesn't draw it again each time
+#####
+RANDOM_CACHE_SIZE = 16
+
+#####
+# The ways samples can be drawn, see Scenario.sampler
+#####
+SAMPLERS = ["random", "antithetic", "latin hypercube", "sobol"]
+
+#####
+# The files the results are written to, and the Scenario attribute of the DataFrame that goes in each one, see write_csv_files and export_results
+#####
+RESULT_FILES = [
+    ("expenses", "expenses_by_year"),
+    ("income", "income_by_year"),
+    ("nonretirement-investments", "nonretirement_investments_by_year"),
+    ("retirement-investments", "retirement_investments_by_year"),
+    ("networth", "networth_by_year")
+]
+
+#####
+# Positions of the statistics kept in a Ledger for every item and year
+# Only investment ledgers have the distribution statistics.  Any extra percentiles come after these, see Ledger.set_percentiles
+#####
+LOW = 0
+HIGH = 1
+DISTRIBUTION_LOW = 2
+DISTRIBUTION_HIGH = 3
+
+#####
+# A Ledger holds the values of every item in one category (income, expenses, etc) for every year
+# Rather than a column per value in a DataFrame, everything is in one numpy array indexed by (item, year, statistic)
+# index maps an item's name to its position in that array, and totals holds the total low and high for every year
+# The array has room for more items than it holds, which doubles whenever it fills up, so adding items one at a time doesn't copy everything every time
+# Any extra percentiles (e.g. the median) are kept after the other statistics, and after the low and high in totals
+# category is the kind of items in it (e.g. "expenses"), which keeps the random streams of items with the same name in different ledgers apart
+#####
+class Ledger:
+
+    def __init__(self, ages, years, isInvestment=False, total_name="total", category=""):
+        self.category = category
+        self.ages = np.array(ages)
+        self.years = np.array(years)
+        self.isInvestment = isInvestment
+        self.statistics = ["low", "high", "distribution low", "distribution high"] if isInvestment else ["low", "high"]
+        self.percentile_start = len(self.statistics)
+        self.percentiles = []
+        self.total_name = total_name
+        self.names = []
+        self.index = {}
+        self.buffer = np.zeros((0, len(self.ages), len(self.statistics)))
+        self.totals = None
+
+    # The (item x year x statistic) values of the items that have been added, a view of the first len(names) items of buffer
+    @property
+    def values(self):
+        return self.buffer[:len(self.names)]
+
+    @values.setter
+    def values(self, values):
+        self.buffer = values
+
+    # Adds an item with every value set to 0 and returns its position
+    def add(self, name):
+        if name in self.index:
+            raise Exception(name, "has already been added.  Every item needs a different name.")
+        if len(self.names) == len(self.buffer):
+            buffer = np.zeros((max(2 * len(self.buffer), 8),) + self.buffer.shape[1:])
+            buffer[:len(self.names)] = self.values
+            self.buffer = buffer
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        return self.index[name]
+
+    # Sets the extra percentiles (0 to 100) kept for every item and total.  Any items already added get a 0 for new ones
+    def set_percentiles(self, percentiles):
+        percentiles = list(percentiles)
+        if percentiles == self.percentiles:
+            return
+        values = np.zeros(self.values.shape[:2] + (self.percentile_start + len(percentiles),))
+        values[:, :, :self.percentile_start] = self.values[:, :, :self.percentile_start]
+        self.values = values
+        self.percentiles = percentiles
+        self.statistics = self.statistics[:self.percentile_start] + [percentile_name(p) for p in percentiles]
+
+    # Returns the positions of the years between start age (inclusive) and end age (exclusive)
+    def year_range(self, start_age, end_age):
+        first_age = int(self.ages[0]) if len(self.ages) > 0 else 0
+        start = min(max(start_age - first_age, 0), len(self.ages))
+        end = min(max(end_age - first_age, start), len(self.ages))
+        return range(start, end)
+
+    # Returns the low and high value of an item at some specified age
+    def get_for_age(self, name, age):
+        item_num = self.get_item_nums([name])[0]
+        year_num = self.get_year_nums([age])[0]
+        return {
+            'low': int(self.values[item_num, year_num, LOW]),
+            'high': int(self.values[item_num, year_num, HIGH])
+        }
+
+    # Looks up every one of names at every one of ages at once
+    # Returns a (names x ages x statistics) array if as_array is True, otherwise a DataFrame with a row for every name and age,
+    # with columns name, age and each of the statistics.  names defaults to every item, ages to every age, statistics to low and high
+    def lookup(self, names=None, ages=None, statistics=None, as_array=False):
+        names = list(self.names) if names is None else list(names)
+        ages = self.ages if ages is None else np.asarray(ages, dtype=int)
+        statistics = self.statistics[:2] if statistics is None else list(statistics)
+        for statistic in statistics:
+            if statistic not in self.statistics:
+                raise Exception(statistic, "is not one of " + ", ".join(self.statistics))
+
+        values = self.values[np.ix_(self.get_item_nums(names), self.get_year_nums(ages), [self.statistics.index(statistic) for statistic in statistics])]
+        if as_array:
+            return values
+
+        frame = pd.DataFrame({
+            "name": np.repeat(names, len(ages)),
+            "age": np.tile(ages, len(names))
+        })
+        for stat_num, statistic in enumerate(statistics):
+            frame[statistic] = values[:, :, stat_num].ravel()
+        return frame
+
+    def get_item_nums(self, names):
+        for name in names:
+            if name not in self.index:
+                raise Exception(name, "has not been added")
+        return [self.index[name] for name in names]
+
+    # The positions of ages in the ledger, which must all be between the first and last age
+    def get_year_nums(self, ages):
+        year_nums = np.asarray(ages, dtype=int) - (int(self.ages[0]) if len(self.ages) > 0 else 0)
+        if np.any((year_nums < 0) | (year_nums >= len(self.ages))):
+            raise Exception("age", "must be between " + str(self.ages[0]) + " and " + str(self.ages[-1]))
+        return year_nums
+
+    # The name of the DataFrame column for one of an item's statistics
+    def column_name(self, name, statistic):
+        if self.isInvestment and not statistic.startswith("distribution"):
+            return name + " balance " + statistic
+        return name + " " + statistic
+
+    # Builds the DataFrame with an age and year column, columns for every item's values, and the totals if they've been generated
+    # The values go in as one (year x item and statistic) block rather than a column at a time
+    def to_frame(self):
+        columns = [self.column_name(name, statistic) for name in self.names for statistic in self.statistics]
+        blocks = [self.values.transpose(1, 0, 2).reshape(len(self.ages), len(columns))]
+        if self.totals is not None:
+            columns += [self.total_name + " low", self.total_name + " high"] + [self.total_name + " " + percentile_name(p) for p in self.percentiles]
+            blocks.append(self.totals)
+        frame = pd.DataFrame(np.concatenate(blocks, axis=1), columns=columns)
+        frame.insert(0, "year", self.years)
+        frame.insert(0, "age", self.ages)
+        frame.attrs["names"] = list(self.names)
+        return frame
+
+    # Builds a DataFrame with a row for every item and age, with columns name, age, year and every statistic
+    # Unlike to_frame, the columns are the same however many items there are, which makes it easier to filter and group
+    def to_long_frame(self):
+        frame = pd.DataFrame({
+            "name": np.repeat(self.names, len(self.ages)),
+            "age": np.tile(self.ages, len(self.names)),
+            "year": np.tile(self.years, len(self.names))
+        })
+        values = self.values.reshape(len(self.names) * len(self.ages), len(self.statistics))
+        for stat_num, statistic in enumerate(self.statistics):
+            frame[statistic] = values[:, stat_num]
+        return frame
+
+
+#####
+# An Item is one add_* call: the function that added it and the arguments it was called with
+# Scenario.items keeps them in the order they were added, see spec and update_item
+#####
+class Item:
+    __slots__ = ["function_name", "name", "arguments"]
+
+    def __init__(self, function_name, arguments):
+        self.function_name = function_name
+        self.name = arguments.get('name')
+        self.arguments = dict(arguments)
+
+    def __repr__(self):
+        return "Item(" + repr(self.function_name) + ", " + repr(self.arguments) + ")"
+
+
+#####
+# A QuantileSketch estimates percentiles of a stream of values without keeping all of them, used by streaming mode
+# Values are kept in levels.  A value in level h stands for 2^h of the values that were added.
+# When a level holds more than capacity values it is sorted and every other value is moved up a level (a compaction)
+# Each compaction moves the rank of any value by at most the weight of that level, and those weights are added up in rank_error_weight
+# So rank_error() is a guaranteed bound: the reported percentile is the true value of some percentile within rank_error() of the one asked for
+# Which works out to at most log2(count / capacity) / capacity, e.g. 0.2% with the default capacity and a million samples
+# Two sketches can be merged, and the bound still holds
+#####
+class QuantileSketch:
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.levels = []
+        self.offsets = []
+        self.count = 0
+        self.rank_error_weight = 0
+
+    # Adds an array of values
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        self.count += len(values)
+        self.add_to_level(0, values)
+        self.compress()
+
+    # Adds everything from another sketch
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            self.add_to_level(level, items)
+        self.count += other.count
+        self.rank_error_weight += other.rank_error_weight
+        self.compress()
+
+    def add_to_level(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(np.zeros(0))
+            self.offsets.append(0)
+        self.levels[level] = np.concatenate([self.levels[level], values])
+
+    # Compacts every level that is over capacity, starting at the bottom since compacting one level adds to the next
+    # The offset alternates between compactions so the kept values don't lean low or high.  With an odd count the largest value stays behind
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity:
+                items = np.sort(items)
+                even_count = len(items) - (len(items) % 2)
+                promoted = items[self.offsets[level]:even_count:2]
+                self.levels[level] = items[even_count:]
+                self.offsets[level] = 1 - self.offsets[level]
+                self.rank_error_weight += 2 ** level
+                self.add_to_level(level + 1, promoted)
+            level += 1
+
+    # The fraction of the values the rank of any reported percentile can be off by
+    def rank_error(self):
+        return self.rank_error_weight / self.count if self.count > 0 else 0
+
+    # Returns the quantile (0 to 1) of the values added, interpolating between values like pd.Series.quantile
+    # Until a compaction happens this is exactly what pd.Series.quantile would give
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        #####
+        # Before any compaction every value has a weight of 1, and np.quantile gives the exact answer without a full sort
+        #####
+        if len(self.levels) == 1:
+            return np.quantile(self.levels[0], qs)
+
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        values = values[order]
+        cumulative = np.cumsum(weights[order])
+
+        ranks = np.asarray(qs, dtype=float) * (self.count - 1)
+        lower = np.floor(ranks)
+        upper = np.minimum(lower + 1, self.count - 1)
+        lower_values = values[np.minimum(np.searchsorted(cumulative, lower, side="right"), len(values) - 1)]
+        upper_values = values[np.minimum(np.searchsorted(cumulative, upper, side="right"), len(values) - 1)]
+        return lower_values + (upper_values - lower_values) * (ranks - lower)
+
+
+#####
+# Keeps track of where the time goes in a scenario, see Scenario.instrumentation
+#
+# stages holds, for every stage (e.g. "process_expenses"), how many times it ran and its total wall clock and CPU seconds
+# Stages can run inside other stages, e.g. "reprojection" runs inside "process_expenses", and each one's time includes the stages inside it
+# counters holds running totals of things like "samples drawn", "quantile computations", "account reprojections" and "rows written"
+#
+# To send the numbers somewhere else as they happen:
+#     callbacks are called with ("stage", name, {"wall": seconds, "cpu": seconds}) as each stage finishes,
+#               and ("counter", name, amount) every time a counter goes up
+#     hooks are called with the stage name as each stage starts, and must return a context manager that is entered for the length of the stage,
+#           e.g. lambda name: tracer.start_as_current_span(name)
+#####
+class Instrumentation:
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.callbacks = []
+        self.hooks = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        with contextlib.ExitStack() as hooks:
+            for hook in self.hooks:
+                hooks.enter_context(hook(name))
+
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            try:
+                yield
+            finally:
+                self.record_stage(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+    def record_stage(self, name, wall, cpu):
+        stage = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+        stage["calls"] += 1
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        for callback in self.callbacks:
+            callback("stage", name, {"wall": wall, "cpu": cpu})
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+        for callback in self.callbacks:
+            callback("counter", name, amount)
+
+    # Clears the numbers, but keeps the callbacks and hooks
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    # One row per stage, slowest first, with how many times it ran and its total and average wall clock and CPU seconds
+    def report(self):
+        report = pd.DataFrame([{"stage": name,
+                                "calls": stage["calls"],
+                                "wall seconds": stage["wall"],
+                                "cpu seconds": stage["cpu"],
+                                "wall seconds per call": stage["wall"] / stage["calls"]} for name, stage in self.stages.items()],
+                              columns=["stage", "calls", "wall seconds", "cpu seconds", "wall seconds per call"])
+        return report.sort_values("wall seconds", ascending=False, ignore_index=True)
+
+#####
+# What Scenario.stage returns when instrumentation is off, so the stages cost next to nothing
+#####
+NO_STAGE = contextlib.nullcontext()
+
+
+#####
+# Levels of the events in an EventLog, see Scenario.log_level
+#####
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "none": 100}
+
+#####
+# Every kind of event an EventLog holds, and its level
+#####
+EVENT_LEVELS = {
+    "message": "info",
+    "sufficient income": "info",
+    "insufficient income": "warning",
+    "distribution": "info",
+    "no distribution": "debug"
+}
+EVENT_KINDS = list(EVENT_LEVELS.keys())
+
+#####
+# The log of a scenario, kept as events rather than lines of text
+# Each field of the events is a column in its own compact array, and account names are stored once and referred to by number
+# Nothing is formatted until the log is written or read, see lines, so a log nobody looks at (e.g. in a sweep) costs very little
+#     kind:                 one of EVENT_KINDS
+#     year, age:            when it happened, NaN for events that aren't about a year
+#     account:              the investment account's name, for distributions
+#     simulations:          how many simulations were run that year
+#     insufficient:         how many of them found insufficient income
+#     distribution:         the low and high of the distribution taken from the account (negative numbers)
+#     balance before/after: the low and high of the account's balance before and after the distribution
+#     message:              the text of "message" events, which are kept by event number as there are only a few of them
+#####
+class EventLog:
+
+    NUMBER_COLUMNS = ["year", "age", "distribution low", "distribution high", "balance before low", "balance before high", "balance after low", "balance after high"]
+
+    def __init__(self):
+        self.kinds = array.array("B")
+        self.accounts = array.array("i")
+        self.simulations = array.array("q")
+        self.insufficient = array.array("q")
+        self.numbers = {column: array.array("d") for column in EventLog.NUMBER_COLUMNS}
+        self.account_names = []
+        self.account_numbers = {}
+        self.messages = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def add(self, kind, year=None, age=None, account=None, simulations=0, insufficient=0,
+            distribution=(np.nan, np.nan), balance_before=(np.nan, np.nan), balance_after=(np.nan, np.nan), message=None):
+        if message is not None:
+            self.messages[len(self.kinds)] = message
+        self.kinds.append(EVENT_KINDS.index(kind))
+
+        if account is None:
+            self.accounts.append(-1)
+        else:
+            if account not in self.account_numbers:
+                self.account_numbers[account] = len(self.account_names)
+                self.account_names.append(account)
+            self.accounts.append(self.account_numbers[account])
+
+        self.simulations.append(int(simulations))
+        self.insufficient.append(int(insufficient))
+        for column, value in zip(EventLog.NUMBER_COLUMNS,
+                                 [year, age, distribution[0], distribution[1], balance_before[0], balance_before[1], balance_after[0], balance_after[1]]):
+            self.numbers[column].append(np.nan if value is None else value)
+
+    # Drops every event after the first length of them
+    def truncate(self, length):
+        for column in [self.kinds, self.accounts, self.simulations, self.insufficient] + list(self.numbers.values()):
+            del column[length:]
+        self.messages = {event_num: message for event_num, message in self.messages.items() if event_num < length}
+
+    def kind(self, event_num):
+        return EVENT_KINDS[self.kinds[event_num]]
+
+    def account(self, event_num):
+        account_num = self.accounts[event_num]
+        return None if account_num < 0 else self.account_names[account_num]
+
+    # The text of one event, the same as the lines of log.txt
+    def format(self, event_num):
+        kind = self.kind(event_num)
+        number = lambda column: self.numbers[column][event_num]
+
+        if kind == "message":
+            message = self.messages[event_num]
+        elif kind == "sufficient income":
+            message = "All simulations (" + str(self.simulations[event_num]) + ") found sufficient income for the year"
+        elif kind == "insufficient income":
+            message = str(self.insufficient[event_num]) + " of " + str(self.simulations[event_num]) + " simulations found insufficient income for the year"
+        elif kind == "distribution":
+            message = ("A distribution of " + usd_fmt(number("distribution low")) + " to " + usd_fmt(number("distribution high")) + " was taken from " + self.account(event_num)
+                       + ".  The balance will be changing from " + usd_fmt(number("balance before low")) + " - " + usd_fmt(number("balance before high"))
+                       + " to " + usd_fmt(number("balance after low")) + " - " + usd_fmt(number("balance after high")))
+        else:
+            message = "There is no need to update the account balance for " + self.account(event_num) + ", there was either zero or insignificant distribution found to be needed in the simulations."
+
+        if np.isnan(number("year")) or np.isnan(number("age")):
+            return message
+        return "In " + str(int(number("year"))) + " at age " + str(int(number("age"))) + ": " + message
+
+    # The text of every event at or above level, one at a time
+    def lines(self, level="debug"):
+        for event_num in range(len(self.kinds)):
+            if LOG_LEVELS[EVENT_LEVELS[self.kind(event_num)]] >= LOG_LEVELS[level]:
+                yield self.format(event_num)
+
+    # One event as a dict, leaving out the fields it doesn't have
+    def record(self, event_num):
+        kind = self.kind(event_num)
+        record = {"kind": kind, "level": EVENT_LEVELS[kind]}
+        for column in EventLog.NUMBER_COLUMNS:
+            value = self.numbers[column][event_num]
+            if not np.isnan(value):
+                record[column] = int(value) if column in ["year", "age"] else value
+        if self.accounts[event_num] >= 0:
+            record["account"] = self.account(event_num)
+        if kind in ["sufficient income", "insufficient income"]:
+            record["simulations"] = self.simulations[event_num]
+            record["insufficient"] = self.insufficient[event_num]
+        if event_num in self.messages:
+            record["message"] = self.messages[event_num]
+        return record
+
+    # Every event as a row of a DataFrame, with a column for every field
+    def to_frame(self):
+        frame = pd.DataFrame({
+            "kind": pd.Categorical.from_codes(np.frombuffer(self.kinds, dtype=np.uint8), EVENT_KINDS) if len(self.kinds) else pd.Categorical([], EVENT_KINDS),
+            "account": [self.account(event_num) for event_num in range(len(self.kinds))]
+        })
+        frame["level"] = frame["kind"].map(EVENT_LEVELS).astype(str)
+        frame["simulations"] = np.frombuffer(self.simulations, dtype=np.int64) if len(self.kinds) else np.zeros(0, dtype=np.int64)
+        frame["insufficient"] = np.frombuffer(self.insufficient, dtype=np.int64) if len(self.kinds) else np.zeros(0, dtype=np.int64)
+        for column in EventLog.NUMBER_COLUMNS:
+            frame[column] = np.frombuffer(self.numbers[column], dtype=float) if len(self.kinds) else np.zeros(0)
+        frame["message"] = [self.messages.get(event_num) for event_num in range(len(self.kinds))]
+        return frame
+
+    # Writes every event at or above level to path, one JSON object per line, without building the whole log in memory
+    # Returns the number of events written
+    def write_jsonl(self, path, level="debug"):
+        written = 0
+        with open(path, "w") as output:
+            for event_num in range(len(self.kinds)):
+                if LOG_LEVELS[EVENT_LEVELS[self.kind(event_num)]] >= LOG_LEVELS[level]:
+                    output.write(json.dumps(self.record(event_num)) + "\n")
+                    written += 1
+        return written
+
 
 #####
-# These are the four main DataFrames that are used as the state for everything
+# A Scenario holds everything for one plan: its settings, the ledgers, the account settings and the log
+# Every scenario is independent of the others, so several can be run in the same process, and they can be pickled and sent to other processes
+# The notebook uses the module level functions at the bottom of this file, which all work on default_scenario
 #####
-expenses_by_year = pd.DataFrame()
-income_by_year = pd.DataFrame()
-nonretirement_investments_by_year = pd.DataFrame()
-retirement_investments_by_year = pd.DataFrame()
+class Scenario:
+
+    def __init__(self, current_year=0, current_age=0, death_age=0):
+        #For Monte Carlo analysis, how many iterations will be run?
+        self.num_samples = 10000
+
+        #at what age are retirement investments available?
+        self.retirement_age = 60
+
+        #How process_expenses runs the simulations for each year
+        #   "vectorized" runs all num_samples simulations at once as numpy array operations
+        #   "legacy" steps through the simulations one at a time, kept as a reference to check the vectorized engine against
+        self.expense_engine = "vectorized"
+
+        #How samples are carried from one year to the next.  This needs to be set before any items are added.
+        #   "bands" reduces every item to its 90% bounds each year and draws fresh samples from those bounds for the next year
+        #   "paths" keeps every sample, so each sample's ending balance feeds directly into its next year.
+        #           Bounds are only taken when the results are reported.
+        self.simulation_mode = "bands"
+
+        #How "bands" mode recalculates an account's balances after a distribution is taken from it
+        #   "incremental" recalculates just the year being processed, then each following year only once process_expenses reaches it
+        #   "full" recalculates every remaining year straight away, which repeats that work again after every later distribution
+        self.reprojection = "incremental"
+
+        #Seed for the random samples.
+        #   None draws from numpy's global random state, like np.random.normal, so results change from run to run unless np.random.seed is called
+        #   An int gives every draw (each item, account and year) its own independent stream derived from this seed,
+        #   so a run can be repeated exactly, and split across processes, and still give the same results
+        self.seed = None
+
+        #Streaming mode, for very large num_samples.  Only works with simulation_mode "bands".
+        #   False draws all num_samples samples at once and takes exact percentiles from them
+        #   True draws chunk_size samples at a time and estimates the percentiles with a QuantileSketch of sketch_capacity values,
+        #        so memory depends on chunk_size and sketch_capacity rather than num_samples.
+        #        The estimates are within streaming_rank_error of exact, which is written to the log
+        self.streaming = False
+        self.chunk_size = 65536
+        self.sketch_capacity = 4096
+
+        #Adaptive mode, only works with simulation_mode "bands".
+        #   False always uses num_samples samples
+        #   True draws adaptive_batch_size samples at a time, and stops once the 90% bounds change by less than adaptive_tolerance
+        #        (a fraction of the width between them) from one batch to the next.  num_samples is the most it will ever use.
+        #        The number of samples each stage used is kept in samples_used and written to the log
+        self.adaptive = False
+        self.adaptive_batch_size = 1000
+        self.adaptive_tolerance = 0.01
+
+        #How samples are drawn from each range
+        #   "random" draws every sample independently
+        #   "antithetic" draws half the samples and mirrors them around the middle of the range, so the two halves balance each other out
+        #   "latin hypercube" splits the range into num_samples slices of equal probability and puts one sample in each
+        #   "sobol" uses a scrambled Sobol sequence, which spreads the samples out even more evenly than "latin hypercube"
+        #The last three give steadier 90% bounds for the same num_samples.  The amount, growth and contribution of each year are drawn together.
+        #In streaming and adaptive modes each chunk is spread out on its own.  "latin hypercube" and "sobol" need scipy.
+        self.sampler = "random"
+
+        #Extra percentiles (0 to 100) to report for every item and total, alongside the 5th and 95th that make up the 90% range
+        #e.g. [25, 50, 75] adds columns like "total p50" to the DataFrames and CSV files.  This needs to be set before any items are added.
+        self.percentiles = []
+
+        #Which events are kept in the log, see EventLog
+        #   "debug" keeps everything, "info" leaves out accounts that didn't need a distribution, "warning" only keeps years with insufficient income
+        #   "none" keeps nothing, which is what sweeps use since their logs are never written
+        self.log_level = "debug"
+
+        #How write_log writes the log
+        #   "text" writes log.txt
+        #   "jsonl" writes log.jsonl, one event per line with all of its fields
+        #   "parquet" writes log.parquet, which needs pyarrow
+        self.log_format = "text"
+
+        #Where the CSV files, the log and the graphs are written
+        self.output_dir = "../data"
+
+        #Binary copies of the results, written to <output_dir>/results by generate_totals along with the CSV files, see export_results
+        #   None doesn't write them
+        #   "parquet" writes a .parquet file of each DataFrame, which needs pyarrow
+        #   "npz" writes all of them to one compressed results.npz, which only needs numpy
+        #   "auto" writes parquet if pyarrow is installed, otherwise npz
+        #export_samples also writes every item's samples for every year, as .npy files that load_results memory maps.  Only "paths" mode keeps them.
+        self.export_format = None
+        self.export_samples = False
+
+        #Cache of results, so running an unchanged scenario again loads its results rather than running the simulations again
+        #   cache_dir is the directory results are kept in, None turns the cache off
+        #   cache_size is the most bytes the cache can hold.  Once it's over, the results that were used longest ago are deleted
+        #   cache_bypass True always runs the simulations, and replaces any cached result with the new one
+        #The results are found by a hash of the ages, the settings and every add_* call, see get_cache_path.
+        #When seed is None the cached result is whichever random samples the run that cached it drew, bypass the cache to draw new ones.
+        #While the cache is on, adding an item only records it, and its balances are worked out by generate_totals (and only if they aren't cached)
+        self.cache_dir = None
+        self.cache_size = 1024 ** 3
+        self.cache_bypass = False
+
+        #How generate_totals recalculates after update_item changes an item.  Only works with simulation_mode "bands".
+        #   "full" runs everything again
+        #   "incremental" keeps a checkpoint of process_expenses at the start of every year, so after an item changes only what depends on it runs again:
+        #                 that ledger's totals, then process_expenses, the investment totals and networth, all from the first year the item changed.
+        #                 Every other item keeps its balances.  With a seed the results are exactly the same as running everything again.
+        self.recompute = "full"
+
+        #How the growth of the investment accounts moves together, like accounts invested in the same market do.  Only works with simulation_mode "paths".
+        #This needs to be set before any investments are added.
+        #   None draws every account's growth independently
+        #   A number from 0 to 1 is the correlation between every pair of accounts.  Each account's growth is that much a shared market factor.
+        #   A DataFrame (or a dict of dicts) with account names as both its index and columns is the correlation matrix of those accounts,
+        #   e.g. pd.DataFrame([[1, 0.8], [0.8, 1]], index=["brokerage account", "401k"], columns=["brokerage account", "401k"])
+        #   Accounts left out of it are independent of everything.
+        #Either way, the shared factors are drawn for every sample and year in one go, see get_growth_factor
+        self.return_correlation = None
+
+        #Historical returns, for items whose growth comes from what actually happened rather than a range
+        #   historical_returns is the path of a CSV file with a row for every year and a column of annual returns for every series, see load_historical_returns
+        #   An item uses one of the series by setting growth_perc_low to its name, e.g. growth_perc_low="stocks" (growth_perc_high is then ignored)
+        #   In "paths" mode each sample strings together runs of block_size consecutive years of history, so good and bad runs of years stay together.
+        #   Every item uses the same years for the same sample, so series that moved together in history still do.
+        #   In "bands" mode each year's growth comes from any year of history.
+        self.historical_returns = None
+        self.block_size = 5
+
+        #How distributions are taken from the investment accounts to cover a shortage, see DISTRIBUTION_STRATEGIES
+        #   "fixed order" drains the non-retirement accounts one at a time in the order they were added, then the retirement accounts
+        #   "retirement first" does the same, but with the retirement accounts first
+        #   "proportional" takes from every account at once, in proportion to their balances
+        #   "guardrail" is "fixed order", but never takes more than withdrawal_rate of all the accounts put together in a year.
+        #               Anything more is left uncovered, like cutting spending in a bad year.
+        #A function with the same arguments as the ones in DISTRIBUTION_STRATEGIES works too.
+        #Whichever it is, retirement accounts are only used from retirement_age.  To compare them, see compare_strategies
+        self.distribution_strategy = "fixed order"
+        self.withdrawal_rate = 0.04
+
+        #Where the time goes, see Instrumentation.  None turns it off.
+        #e.g. scenario.instrumentation = Instrumentation(), then after generate_totals() look at scenario.instrumentation.report() and .counters
+        #Unlike the settings above, this is kept when setup is called again, and isn't copied into sweeps
+        self.instrumentation = None
+
+        self.setup(current_year, current_age, death_age)
+
+    def log(self, message, year=None, age=None):
+        self.log_event("message", year, age, message=message)
+
+    # Adds an event to the log, unless it's below log_level.  The fields are the same as EventLog.add's
+    def log_event(self, kind, year=None, age=None, **fields):
+        if LOG_LEVELS[EVENT_LEVELS[kind]] < LOG_LEVELS[self.log_level]:
+            return
+        self.event_log.add(kind, year, age, **fields)
+
+    # The log as lines of text, the way it used to be kept
+    @property
+    def message_log(self):
+        return list(self.event_log.lines())
+
+    # A context manager that times a stage of the scenario when instrumentation is on, see Instrumentation
+    def stage(self, name):
+        if self.instrumentation is None:
+            return NO_STAGE
+        return self.instrumentation.stage(name)
+
+    # Adds to one of the instrumentation counters, when instrumentation is on
+    def count(self, name, amount=1):
+        if self.instrumentation is None:
+            return
+        self.instrumentation.count(name, amount)
+
+    def write_log(self):
+        if self.log_format == "jsonl":
+            self.count("log lines written", self.event_log.write_jsonl(os.path.join(self.output_dir, "log.jsonl")))
+            return
+        if self.log_format == "parquet":
+            self.event_log.to_frame().to_parquet(os.path.join(self.output_dir, "log.parquet"), index=False)
+            self.count("log lines written", len(self.event_log))
+            return
+        if self.log_format != "text":
+            raise Exception("log_format", "must be \"text\", \"jsonl\" or \"parquet\"")
+
+        #####
+        # log.txt has always left out the first line
+        # Each line is written as it's formatted, so the whole log is never held as text
+        #####
+        written = 0
+        with open(os.path.join(self.output_dir, "log.txt"), "w") as output:
+            for line_num, line in enumerate(self.event_log.lines()):
+                if line_num == 0:
+                    continue
+                if written > 0:
+                    output.write("\n")
+                output.write(line)
+                written += 1
+        self.count("log lines written", written)
+
+    # Forgets the *_by_year DataFrames, so they're built again from the ledgers the next time they're used, see get_frame
+    def build_frames(self):
+        self.frames = {}
+
+    # The DataFrame version of a ledger, which is only built the first time it's used after build_frames
+    # Nothing that runs the simulations needs them, so with write_output=False they're never built unless something asks for them
+    def get_frame(self, ledger_name):
+        if ledger_name not in self.frames:
+            self.frames[ledger_name] = getattr(self, ledger_name).to_frame()
+        return self.frames[ledger_name]
+
+    @property
+    def expenses_by_year(self):
+        return self.get_frame("expenses_ledger")
+
+    @property
+    def income_by_year(self):
+        return self.get_frame("income_ledger")
+
+    @property
+    def nonretirement_investments_by_year(self):
+        return self.get_frame("nonretirement_investments_ledger")
+
+    @property
+    def retirement_investments_by_year(self):
+        return self.get_frame("retirement_investments_ledger")
+
+    @property
+    def networth_by_year(self):
+        return self.get_frame("networth_ledger")
+
+    # A DataFrame with a row for every item and age of one of the ledgers ("income", "expenses", "nonretirement" or "retirement"), see Ledger.to_long_frame
+    def get_long_frame(self, category):
+        ledgers = {ledger.category: ledger for ledger in [self.income_ledger, self.expenses_ledger, self.nonretirement_investments_ledger, self.retirement_investments_ledger]}
+        if category not in ledgers:
+            raise Exception(category, "must be one of " + ", ".join(ledgers.keys()))
+        self.project_pending_items()
+        return ledgers[category].to_long_frame()
+
+    def write_csv_files(self):
+        for file_name, attribute in RESULT_FILES:
+            getattr(self, attribute).to_csv(os.path.join(self.output_dir, file_name + '.csv'))
+            self.count("rows written", len(getattr(self, attribute)))
+
+    # Writes the results as binary files that are much quicker to load than the CSV files, see export_format and load_results
+    # directory defaults to <output_dir>/results, and gets a manifest.json listing everything in it
+    def export_results(self, directory=None):
+        if directory is None:
+            directory = os.path.join(self.output_dir, "results")
+        export_format = self.export_format
+        if export_format in [None, "auto"]:
+            export_format = "parquet" if importlib.util.find_spec("pyarrow") is not None else "npz"
+        if export_format not in ["parquet", "npz"]:
+            raise Exception("export_format", "must be None, \"auto\", \"parquet\" or \"npz\"")
+        if self.export_samples and (self.simulation_mode != "paths"):
+            raise Exception("export_samples", "only works with simulation_mode \"paths\".  The other modes don't keep every sample.")
+
+        os.makedirs(directory, exist_ok=True)
+        manifest = {"format": export_format, "samples": {}}
+
+        #####
+        # Parquet gets a file for each DataFrame.  npz gets one file, with each DataFrame's values and column names stored side by side
+        #####
+        if export_format == "parquet":
+            for file_name, attribute in RESULT_FILES:
+                getattr(self, attribute).to_parquet(os.path.join(directory, file_name + ".parquet"), index=False)
+        else:
+            arrays = {}
+            for file_name, attribute in RESULT_FILES:
+                frame = getattr(self, attribute)
+                arrays[file_name + " values"] = frame.to_numpy(dtype=float)
+                arrays[file_name + " columns"] = np.array(frame.columns, dtype=str)
+            np.savez_compressed(os.path.join(directory, "results.npz"), **arrays)
+        for file_name, attribute in RESULT_FILES:
+            self.count("rows written", len(getattr(self, attribute)))
+
+        #####
+        # Each item's (num_samples x years) matrix of samples is saved as its own uncompressed .npy, so it can be memory mapped
+        #####
+        if self.export_samples:
+            for category, paths in [("income", self.income_paths),
+                                    ("expenses", self.expenses_paths),
+                                    ("nonretirement", self.nonretirement_investment_paths),
+                                    ("retirement", self.retirement_investment_paths)]:
+                os.makedirs(os.path.join(directory, "samples", category), exist_ok=True)
+                manifest["samples"][category] = {}
+                for item_num, (name, path) in enumerate(paths.items()):
+                    file_name = os.path.join("samples", category, str(item_num) + ".npy")
+                    np.save(os.path.join(directory, file_name), path["amount"])
+                    manifest["samples"][category][name] = file_name
+                    self.count("rows written", len(path["amount"]))
+
+        with open(os.path.join(directory, "manifest.json"), "w") as output:
+            json.dump(manifest, output, indent=2)
+
+    # helper function to allow you to check what an income is at some specified age
+    def get_income_for_age(self, name, age):
+        self.project_pending_items()
+        return self.income_ledger.get_for_age(name, age)
+
+    # helper function to allow you to check what an expense is at some specified age
+    def get_expense_for_age(self, name, age):
+        self.project_pending_items()
+        return self.expenses_ledger.get_for_age(name, age)
+
+    # helper function to allow you to check what a nonretirement account balance is at some specified age
+    # warning: this will give values before expenses have been processed.  This should not be relied on.
+    def get_nonretirement_balance_for_age(self, name, age):
+        warnings.warn("It is not safe to trust investment account balances before expenses have been processed (usually by generate_totals())")
+        self.project_pending_items()
+        return self.nonretirement_investments_ledger.get_for_age(name, age)
+
+    # helper function to allow you to check what a retirement account balance is at some specified age
+    # warning: this will give values before expenses have been processed.  This should not be relied on.
+    def get_retirement_balance_for_age(self, name, age):
+        warnings.warn("It is not safe to trust investment account balances before expenses have been processed (usually by generate_totals())")
+        self.project_pending_items()
+        return self.retirement_investments_ledger.get_for_age(name, age)
+
+    # Looks up the values of many items at many ages in one go, e.g. lookup("income", ["job salary"], range(40, 50))
+    # category is "income", "expenses", "nonretirement" or "retirement", and the rest are the same as Ledger.lookup
+    # Like get_*_balance_for_age, investment balances can't be trusted until generate_totals() has processed expenses
+    def lookup(self, category, names=None, ages=None, statistics=None, as_array=False):
+        ledgers = {ledger.category: ledger for ledger in [self.income_ledger, self.expenses_ledger, self.nonretirement_investments_ledger, self.retirement_investments_ledger]}
+        if category not in ledgers:
+            raise Exception(category, "must be one of " + ", ".join(ledgers.keys()))
+        if ledgers[category].isInvestment and (ledgers[category].totals is None):
+            warnings.warn("It is not safe to trust investment account balances before expenses have been processed (usually by generate_totals())")
+        self.project_pending_items()
+        return ledgers[category].lookup(names, ages, statistics, as_array)
+
+    # Create the ledgers, with a year for every year from current_year to death_age
+    # Anything that was added before is thrown away, so this can be called again to start a scenario over
+    def setup(self, cy, ca, da):
+        self.current_year = cy
+        self.current_age = ca
+        self.death_age = da
+
+        #####
+        # These are the four main ledgers that are used as the state for everything, see Ledger
+        #####
+        ages = range(self.current_age, self.death_age)
+        years = range(self.current_year, self.current_year + (self.death_age - self.current_age))
+        self.expenses_ledger = Ledger(ages, years, category="expenses")
+        self.income_ledger = Ledger(ages, years, category="income")
+        self.nonretirement_investments_ledger = Ledger(ages, years, isInvestment=True, category="nonretirement")
+        self.retirement_investments_ledger = Ledger(ages, years, isInvestment=True, category="retirement")
+        self.networth_ledger = Ledger(ages, years, total_name="networth", category="networth")
+
+        #####
+        # When running the simulation to process expenses it will be necessary to take a distribution from investments
+        # This will require recalculating the balances of that investment for that year and all subsequent years
+        # To do this we need to store the values that were used to create the investments initially so we can reference them when its recalculated
+        #####
+        self.nonretirement_account_settings = {}
+        self.retirement_account_settings = {}
+
+        #####
+        # When simulation_mode is "paths" every item keeps all of its samples for every year, rather than just the 90% bounds
+        # Each item is stored by name as a dict of (num_samples x years) matrices, see generate_item_paths
+        #####
+        self.income_paths = {}
+        self.expenses_paths = {}
+        self.nonretirement_investment_paths = {}
+        self.retirement_investment_paths = {}
+
+        self.event_log = EventLog()
+
+        #####
+        # The largest rank error of any percentile estimated in streaming mode, see QuantileSketch
+        #####
+        self.streaming_rank_error = 0
+
+        #####
+        # The most recently drawn chunks of samples, see random_normal
+        #####
+        self.random_chunk_cache = {}
+
+        #####
+        # The (num_samples x years) standard normals that correlated accounts' growth is made from, by factor, see get_growth_factor
+        #####
+        self.growth_factors = {}
+
+        #####
+        # Which year of history each sample uses for each year, see get_historical_years
+        #####
+        self.historical_years = None
+
+        #####
+        # For every year, the fraction of simulations whose shortage the investments couldn't cover (shortfall),
+        # and the fraction that couldn't because every account they could use was empty (depletion), see record_shortfalls
+        # In "paths" mode, depletion is the fraction of simulations that have run out by that year
+        #####
+        self.shortfall = np.zeros(len(ages))
+        self.depletion = np.zeros(len(ages))
+
+        #####
+        # In adaptive mode, the number of samples used every time each stage took percentiles, e.g. {"totals": [3000, 5000, ...]}
+        #####
+        self.samples_used = {}
+
+        #####
+        # Every add_* call, in order, see Item
+        # This is what lets spec() rebuild the scenario in another process, with some of the values changed, see sweep
+        #####
+        self.items = []
+
+        #####
+        # While the cache is on, the items whose balances haven't been worked out yet, see add_item and project_pending_items
+        #####
+        self.pending_projections = []
+
+        #####
+        # For recompute "incremental", see update_item and run_stages_incrementally
+        #     item_projections:  every item's balances for every year as they were projected, before any distributions, by (category, name)
+        #     changed_items:     the items update_item changed since the last run, with the first year that changed and their projection in the last run
+        #     checkpoints:       the state of process_expenses at the start of every year of the last run, see save_checkpoint
+        #     checkpoint_inputs: the settings (other than retirement_age) and number of items of the last run.  If either changes, everything is run again
+        #     checkpoint_retirement_age: the retirement_age of the last run.  If it changes, process_expenses runs again from the earlier of the two
+        #####
+        self.item_projections = {}
+        self.changed_items = {}
+        self.checkpoints = {}
+        self.checkpoint_inputs = None
+        self.checkpoint_retirement_age = None
+
+        #####
+        # DataFrame versions of the ledgers, used for the CSV files and the graphs
+        # These are only built when they're used, and forgotten by build_frames after all the totals are generated
+        #####
+        self.build_frames()
+
+    # Given two values that together represent the bounds of a 90% confidence interval
+    # Create and return a normal distribution with num_samples items that fit those bounds
+    # key names the draw, e.g. ("balances", "expenses", "rent", 5, "growth"), and picks its random stream when seed is set, see random_normal
+    def generate_series(self, low, high, key=None):
+        return pd.Series(self.generate_samples(low, high, key, 0, self.num_samples))
+
+    # generate_series as an array, for just samples start (inclusive) to stop (exclusive), used by streaming mode to draw a chunk at a time
+    def generate_samples(self, low, high, key, start, stop):
+        self.count("samples drawn", stop - start)
+        if self.sampler != "random":
+            return scale_standard_normals(self.generate_standard_normals(1, key, start, stop)[:, 0], low, high)
+
+        STD_DEV_90 = 3.29#converting from a 90% Confidence Interval to a Standard Deviation
+        mean = (low + high) /2
+        stddev = (high - low) / STD_DEV_90
+        if self.seed is None:
+            return np.random.normal(mean, stddev, stop - start)
+        return self.random_normal(mean, stddev, key, start, stop)
+
+    # Draws samples start (inclusive) to stop (exclusive) of a normal distribution, from the random stream named by key
+    # The samples are drawn in chunks of RANDOM_CHUNK_SIZE, and each chunk has its own stream made from the seed, the key and the chunk number
+    # So the same seed and key always give the same samples, no matter which part of them is drawn or by which process
+    def random_normal(self, mean, stddev, key, start=0, stop=None):
+        if key is None:
+            raise Exception("key", "is required for every draw when a seed is set")
+        if stop is None:
+            stop = self.num_samples
+        if stop <= start:
+            return np.zeros(0)
+
+        first_chunk = start // RANDOM_CHUNK_SIZE
+        last_chunk = (stop - 1) // RANDOM_CHUNK_SIZE
+        chunks = []
+        for chunk_num in range(first_chunk, last_chunk + 1):
+            cache_key = (self.seed, key, chunk_num, mean, stddev)
+            if cache_key not in self.random_chunk_cache:
+                seed_sequence = np.random.SeedSequence(self.seed, spawn_key=get_stream_key(key) + (chunk_num,))
+                if len(self.random_chunk_cache) >= RANDOM_CACHE_SIZE:
+                    del self.random_chunk_cache[next(iter(self.random_chunk_cache))]
+                self.random_chunk_cache[cache_key] = np.random.default_rng(seed_sequence).normal(mean, stddev, RANDOM_CHUNK_SIZE)
+            chunks.append(self.random_chunk_cache[cache_key])
+
+        offset = first_chunk * RANDOM_CHUNK_SIZE
+        return np.concatenate(chunks)[start - offset:stop - offset]
+
+    # Creates a series with num_samples items that represents 
+    # ((amount + contribution) + ((amount + contribution) * growth_percent))
+    # key names the item and year, and each of the three draws adds what it's for to it
+    def generate_series_for_year(self, amt_low, 
+                                amt_high, 
+                                growth_perc_low, 
+                                growth_perc_high,
+                                contrib_amt_low,
+                                contrib_amt_high,
+                                key=()
+                                ):
+        return pd.Series(self.generate_samples_for_year(amt_low, amt_high, growth_perc_low, growth_perc_high, contrib_amt_low, contrib_amt_high,
+                                                        key, 0, self.num_samples))
+
+    # generate_series_for_year as an array, for just samples start (inclusive) to stop (exclusive)
+    def generate_samples_for_year(self, amt_low,
+                                  amt_high,
+                                  growth_perc_low,
+                                  growth_perc_high,
+                                  contrib_amt_low,
+                                  contrib_amt_high,
+                                  key,
+                                  start,
+                                  stop
+                                  ):
+        #generate samples, drawing all three together when they're spread out by the sampler
+        if self.sampler != "random":
+            self.count("samples drawn", 3 * (stop - start))
+            z = self.generate_standard_normals(3, key, start, stop)
+            amt_samples = scale_standard_normals(z[:, 0], amt_low, amt_high)
+            if not isinstance(growth_perc_low, str):
+                growth_percent_samples = scale_standard_normals(z[:, 1], growth_perc_low, growth_perc_high)
+            contrib_samples = scale_standard_normals(z[:, 2], contrib_amt_low, contrib_amt_high)
+        else:
+            amt_samples = self.generate_samples(amt_low, amt_high, key + ("amount",), start, stop)
+            if not isinstance(growth_perc_low, str):
+                growth_percent_samples = self.generate_samples(growth_perc_low, growth_perc_high, key + ("growth",), start, stop)
+            contrib_samples = self.generate_samples(contrib_amt_low, contrib_amt_high, key + ("contrib",), start, stop)
+
+        #growth_perc_low can instead name a historical series, see historical_returns
+        if isinstance(growth_perc_low, str):
+            growth_percent_samples = self.generate_historical_samples(growth_perc_low, key, start, stop)
+
+        #generate samples with contrib amt added to balance amt
+        x = amt_samples + contrib_samples
+
+        #calculate growth
+        y = x * growth_percent_samples
+
+        #add it all up
+        return x + y
+
+    # Draws samples start to stop of a (samples x dimensions) matrix of standard normal values using the sampler
+    # The samples are spread out across all the dimensions at once, so e.g. amount and growth are both evenly covered
+    # With a seed the scrambling comes from the stream named by key and start, otherwise from numpy's global random state
+    def generate_standard_normals(self, dimensions, key, start, stop):
+        num = stop - start
+        rng = self.get_rng(None if key is None else key + ("sampler", start))
+
+        if self.sampler == "antithetic":
+            z = rng.standard_normal(((num + 1) // 2, dimensions))
+            return np.concatenate([z, -z])[:num]
+
+        if self.sampler in ["latin hypercube", "sobol"]:
+            from scipy.stats import norm, qmc
+            if self.sampler == "latin hypercube":
+                u = qmc.LatinHypercube(d=dimensions, seed=rng).random(num)
+            else:
+                #the first num points of the sequence are used even when num isn't a power of 2, so there is no need for the warning
+                #scrambling leaves the same sample number in nearby spots of every draw, so the points are shuffled to keep separate draws
+                #(e.g. income and expenses, or one year and the next in "paths" mode) independent, like the other samplers
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    u = rng.permutation(qmc.Sobol(d=dimensions, seed=rng).random(num))
+            return norm.ppf(u)
+
+        raise Exception("sampler", "must be one of " + ", ".join(SAMPLERS))
+
+    # A numpy Generator for the random stream named by key, or seeded from numpy's global random state when seed is None
+    def get_rng(self, key):
+        if self.seed is None:
+            return np.random.default_rng(np.random.randint(0, 2**31 - 1))
+        if key is None:
+            raise Exception("key", "is required for every draw when a seed is set")
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=get_stream_key(key)))
+
+    # The annual returns of one of the series in the historical_returns file
+    def get_historical_series(self, series):
+        if self.historical_returns is None:
+            raise Exception(series, "is the name of a historical series, but historical_returns isn't set.  Set it to the path of a CSV file of annual returns.")
+        names, returns = load_historical_returns(self.historical_returns)
+        if series not in names:
+            raise Exception(series, "is not a series in " + self.historical_returns + ".  It has " + ", ".join(names))
+        return returns[:, names.index(series)]
+
+    # "bands" mode's historical growth for samples start (inclusive) to stop (exclusive), each the return of a random year of the series
+    def generate_historical_samples(self, series, key, start, stop):
+        returns = self.get_historical_series(series)
+        self.count("samples drawn", stop - start)
+        return returns[self.get_rng(key + ("historical", start)).integers(0, len(returns), stop - start)]
+
+    # A (num_samples x years) matrix of which year of history each sample uses for each year, used by "paths" mode
+    # Each sample strings together blocks of block_size consecutive years, each block starting at a random year and wrapping around
+    # to the first year after the last one.  Every index is drawn in one go, the first time an item needs them, and shared by every item
+    def get_historical_years(self):
+        if self.historical_years is None:
+            if (not isinstance(self.block_size, (int, np.integer))) or (self.block_size < 1):
+                raise Exception("block_size", "must be a whole number of years, 1 or more")
+            num_history = len(load_historical_returns(self.historical_returns)[1])
+            num_years = self.death_age - self.current_age
+            block_size = min(self.block_size, num_history)
+            num_blocks = -(-num_years // block_size)
+
+            starts = self.get_rng(("historical years",)).integers(0, num_history, (self.num_samples, num_blocks))
+            years = (starts[:, :, np.newaxis] + np.arange(block_size)) % num_history
+            self.historical_years = np.asfortranarray(years.reshape(self.num_samples, num_blocks * block_size)[:, :num_years])
+            self.count("samples drawn", self.num_samples * num_blocks)
+        return self.historical_years
+
+    # The quantiles (0 to 1) taken everywhere: the 5th and 95th percentiles, then any extra percentiles
+    def get_quantiles(self):
+        return [0.05, 0.95] + [percentile / 100 for percentile in self.percentiles]
+
+    # Makes sure every ledger has room for the extra percentiles
+    # Adds every item again, e.g. when percentiles changed after they were added, as every item's balances include its percentiles
+    def rebuild_items(self):
+        items = list(self.items)
+        self.setup(self.current_year, self.current_age, self.death_age)
+        for item in items:
+            getattr(self, item.function_name)(**item.arguments)
+
+    def set_ledger_percentiles(self):
+        for ledger in [self.expenses_ledger, self.income_ledger, self.nonretirement_investments_ledger, self.retirement_investments_ledger, self.networth_ledger]:
+            ledger.set_percentiles(self.percentiles)
+
+    # Streaming and adaptive modes both draw samples a chunk at a time rather than all num_samples at once
+    def draws_in_chunks(self):
+        return self.streaming or self.adaptive
+
+    # The (start, stop) of every chunk of samples in streaming or adaptive mode.  Adaptive mode's batches are its chunks
+    def get_chunks(self):
+        chunk_size = self.adaptive_batch_size if self.adaptive else self.chunk_size
+        return [(start, min(start + chunk_size, self.num_samples)) for start in range(0, self.num_samples, chunk_size)]
+
+    # Streaming mode estimates percentiles with a sketch of sketch_capacity values
+    # Otherwise (adaptive mode) the sketch has room for every sample, so the percentiles are exact
+    def new_sketch(self):
+        return QuantileSketch(self.sketch_capacity if self.streaming else self.num_samples)
+
+    # In adaptive mode, whether the percentiles have settled between two batches
+    # previous and current are lists with the percentiles of each thing being estimated, e.g. [[low, high], [low, high]]
+    def has_converged(self, previous, current):
+        for previous_quantiles, current_quantiles in zip(previous, current):
+            width = max(current_quantiles) - min(current_quantiles)
+            change = np.max(np.abs(np.asarray(current_quantiles) - np.asarray(previous_quantiles)))
+            if change > self.adaptive_tolerance * width:
+                return False
+        return True
+
+    # Keeps track of how many samples a stage used, for adaptive mode's report
+    def record_samples_used(self, stage, count):
+        self.samples_used.setdefault(stage, []).append(count)
+
+    # Streaming and adaptive modes' way of taking percentiles
+    # draw(start, stop) returns samples start to stop, and each chunk of them is added to a QuantileSketch then thrown away
+    # In adaptive mode it stops as soon as the percentiles settle, see has_converged
+    # Returns the sketch's estimate of each of the quantiles (0 to 1)
+    def stream_quantiles(self, draw, quantiles, stage):
+        sketch = self.new_sketch()
+        previous = None
+        for start, stop in self.get_chunks():
+            sketch.update(draw(start, stop))
+            if self.adaptive:
+                current = sketch.quantiles(quantiles)
+                if (previous is not None) and self.has_converged([previous], [current]):
+                    break
+                previous = current
+        self.streaming_rank_error = max(self.streaming_rank_error, sketch.rank_error())
+        self.record_samples_used(stage, sketch.count)
+        self.count("quantile computations")
+        return sketch.quantiles(quantiles)
+
+    # Adds a new item to the specified Ledger
+    # Does input sanitization, adds the item to the Ledger and sets its values
+    # replace=True sets the values of an item that is already in the ledger, see update_item
+    def add_item(self, ledger,
+                 isInvestment=False,
+                 paths=None,
+                 replace=False,
+                 name=None, 
+                 starting_amt_low=None, 
+                 starting_amt_high=None, 
+                 start_age=None, 
+                 end_age=None, 
+                 growth_perc_low=0, 
+                 growth_perc_high=0, 
+                 annual_contrib_amt_low=0,
+                 annual_contrib_amt_high=0,
+                 annual_contrib_start_age=0,
+                 annual_contrib_end_age=0
+                ):
+        #####
+        # input sanitization
+        #####
+        if name is None:
+            raise Exception("name is required for all items")
+
+        if starting_amt_low is None:
+            raise Exception(name, "starting_amt_low is required for all items.  Note this can be the same value as starting_amt_high.")
+
+        if starting_amt_high is None:
+            raise Exception(name, "starting_amt_high is required for all items.  Note this can be the same value as starting_amt_low.")
+
+        if starting_amt_low > starting_amt_high:
+            raise Exception(name, "starting_amt_low cannot be greater than starting_amt_high")
+
+        if start_age is None:
+            raise Exception(name, "start_age is required for all items.")
+
+        if (end_age is None) or (end_age == start_age):
+            end_age = start_age + 1
+
+        if end_age < start_age:
+            raise Exception(name, "end_age cannot be less than start_age")
+
+        if isinstance(growth_perc_low, str):
+            self.get_historical_series(growth_perc_low)
+        elif isinstance(growth_perc_high, str):
+            raise Exception(name, "growth_perc_high can't be a historical series.  Set growth_perc_low to the series name instead.")
+        elif growth_perc_low > growth_perc_high:
+            raise Exception(name, "growth_perc_low cannot be greater than growth_perc_high.  Note they can have the same value.")
+
+        if annual_contrib_amt_low > annual_contrib_amt_high:
+            raise Exception(name, "annual_contrib_amt_low cannot be greater than annual_contrib_amt_high.  Note they can have the same value.")
+
+        if annual_contrib_start_age > annual_contrib_end_age:
+            raise Exception(name, "annual_contrib_start_age cannot be greater than annual_contrib_end_age.")
+
+        if isInvestment == False:
+            if annual_contrib_amt_low > 0: 
+                raise Exception(name, "annual_contrib_amt_low only applies to investments.")
+            if annual_contrib_amt_high > 0: 
+                raise Exception(name, "annual_contrib_amt_high only applies to investments.")
+            if annual_contrib_start_age > 0: 
+                raise Exception(name, "annual_contrib_start_age only applies to investments.")
+            if annual_contrib_end_age > 0: 
+                raise Exception(name, "annual_contrib_end_age only applies to investments.")
+
+
+        #####
+        # add the item to the ledger, investment ledgers also have room for the distribution low and high amounts
+        #####
+        self.set_ledger_percentiles()
+        if replace:
+            ledger.values[ledger.index[name]] = 0
+        else:
+            ledger.add(name)
+
+        #####
+        # Now that the item is in the ledger, set its balances for every year
+        # With the cache on that waits until generate_totals, which only does it if the results aren't already cached
+        #####
+        projection = (ledger, paths, name, start_age, end_age, growth_perc_low, growth_perc_high, starting_amt_low, starting_amt_high,
+                      annual_contrib_amt_low, annual_contrib_amt_high, annual_contrib_start_age, annual_contrib_end_age)
+        if self.cache_dir is None:
+            self.project_item(*projection)
+        else:
+            self.pending_projections.append(projection)
+
+    # Sets an item's balances for every year, see add_item
+    # In "paths" mode every sample is kept, and the ledger just holds the 90% bounds of those samples
+    def project_item(self, ledger,
+                     paths,
+                     name,
+                     start_age,
+                     end_age,
+                     growth_perc_low,
+                     growth_perc_high,
+                     starting_amt_low,
+                     starting_amt_high,
+                     annual_contrib_amt_low,
+                     annual_contrib_amt_high,
+                     annual_contrib_start_age,
+                     annual_contrib_end_age
+                    ):
+        if self.simulation_mode == "paths":
+            with self.stage("generate_item_paths"):
+                paths[name] = self.generate_item_paths(start_age,
+                                                  end_age,
+                                                  growth_perc_low,
+                                                  growth_perc_high,
+                                                  starting_amt_low,
+                                                  starting_amt_high,
+                                                  annual_contrib_amt_low,
+                                                  annual_contrib_amt_high,
+                                                  annual_contrib_start_age,
+                                                  annual_contrib_end_age,
+                                                  ("paths", ledger.category, name),
+                                                  self.get_growth_factor_weights(ledger, name)
+                                                 )
+            set_item_balances_from_paths(ledger, name, paths[name]["amount"], self.get_quantiles())
+            self.count("quantile computations", len(ledger.ages))
+            return
+
+        with self.stage("set_item_balances"):
+            self.set_item_balances(ledger, 
+                              name,
+                              start_age, 
+                              end_age,
+                              growth_perc_low, 
+                              growth_perc_high, 
+                              starting_amt_low,
+                              starting_amt_high,
+                              annual_contrib_amt_low, 
+                              annual_contrib_amt_high, 
+                              annual_contrib_start_age, 
+                              annual_contrib_end_age
+                             )
+        self.item_projections[(ledger.category, name)] = ledger.values[ledger.index[name]].copy()
+
+    # Works out the balances of any items that were added while the cache was on, in the order they were added
+    def project_pending_items(self):
+        while len(self.pending_projections) > 0:
+            self.project_item(*self.pending_projections.pop(0))
+
+    # Sets the low and high balance in the ledger for the named item between specified start and end age
+    # Will blow away any previous values.  
+    #    This is important because when expenses are processed investment distributions will call this function 
+    #    to regen the balances after taking a distribution in a year
+    def set_item_balances(self, ledger, 
+                          name,
+                          start_age, 
+                          end_age,
+                          growth_perc_low, 
+                          growth_perc_high, 
+                          starting_amt_low,
+                          starting_amt_high,
+                          annual_contrib_amt_low, 
+                          annual_contrib_amt_high, 
+                          annual_contrib_start_age, 
+                          annual_contrib_end_age
+                         ):
+        item_num = ledger.index[name]
+
+
+        #####
+        #  Set values for first iteration of loop
+        #####
+        amt_low = starting_amt_low
+        amt_high = starting_amt_high
+
+
+        #####
+        # Loop over all the affected years, between start age (inclusive) and end age (exclusive)
+        #####
+        for year_num in ledger.year_range(start_age, end_age):
+
+            #####
+            # Determine if there is a contribution for this year, and in what amount
+            #####
+            age = ledger.ages[year_num]
+            contrib_year = (age >= annual_contrib_start_age) and (age < annual_contrib_end_age)
+            contrib_low = annual_contrib_amt_low if contrib_year else 0
+            contrib_high = annual_contrib_amt_high if contrib_year else 0
+
+            key = ("balances", ledger.category, name, int(year_num))
+
+            #####
+            # Generate a series with num_samples items, accounting for amount, growth and contribution, and take all the percentiles from it at once
+            # Streaming and adaptive modes do the same thing, a chunk of samples at a time
+            #####
+            if self.draws_in_chunks():
+                bounds = self.stream_quantiles(
+                    lambda start, stop: self.generate_samples_for_year(amt_low, amt_high, growth_perc_low, growth_perc_high, contrib_low, contrib_high, key, start, stop),
+                    self.get_quantiles(),
+                    "item balances"
+                )
+            else:
+                year_expenses = self.generate_series_for_year(
+                    amt_low, 
+                    amt_high, 
+                    growth_perc_low, 
+                    growth_perc_high,
+                    contrib_low,
+                    contrib_high,
+                    key
+                )
+                bounds = np.quantile(year_expenses, self.get_quantiles())
+                self.count("quantile computations")
+
+            #####
+            #get 90% bounds and set amt_low and amt_high for next iteration of this loop
+            #####
+            amt_low = bounds[0]
+            amt_high = bounds[1]
+
+            #####
+            # Set the low and high balance for this year in the ledger, and any extra percentiles
+            #####
+            ledger.values[item_num, year_num, LOW] = amt_low
+            ledger.values[item_num, year_num, HIGH] = amt_high
+            ledger.values[item_num, year_num, ledger.percentile_start:] = bounds[2:]
+
+    # The "paths" mode version of set_item_balances
+    # Rather than reducing each year to its 90% bounds and drawing fresh samples for the next year, every sample is carried forward
+    # growth_factors makes the growth out of shared factors instead of drawing it for each year, see get_growth_factor_weights
+    # Returns a dict of (num_samples x years) matrices, with a column for every row in the DataFrames
+    #     amount: the balance of every sample for every year, zero outside of start_age and end_age
+    #     growth: the growth percent drawn for every sample and year
+    #     contrib: the contribution drawn for every sample and year
+    # growth and contrib are kept so investment accounts can be grown again after distributions are taken out of them
+    def generate_item_paths(self, start_age,
+                            end_age,
+                            growth_perc_low,
+                            growth_perc_high,
+                            starting_amt_low,
+                            starting_amt_high,
+                            annual_contrib_amt_low,
+                            annual_contrib_amt_high,
+                            annual_contrib_start_age,
+                            annual_contrib_end_age,
+                            key=(),
+                            growth_factors=None
+                           ):
+        #####
+        # The matrices are column major, so each year's samples (a column) are next to each other
+        #####
+        num_years = self.death_age - self.current_age
+        amount = np.zeros((self.num_samples, num_years), order="F")
+        growth = np.zeros((self.num_samples, num_years), order="F")
+        contrib = np.zeros((self.num_samples, num_years), order="F")
+
+        #####
+        #  Every sample starts from its own starting amount
+        #####
+        amt = self.generate_series(starting_amt_low, starting_amt_high, key + ("starting amount",)).to_numpy()
+        starting_amount = amt
+
+        #####
+        # Correlated growth is the account's mix of the shared factors, for every year at once
+        # Historical growth is the series' return for each sample's year of history, for every year at once
+        #####
+        if isinstance(growth_perc_low, str):
+            historical_growth = np.asfortranarray(self.get_historical_series(growth_perc_low)[self.get_historical_years()])
+        elif growth_factors is not None:
+            growth_normals = np.asfortranarray(sum(weight * self.get_growth_factor(factor) for factor, weight in growth_factors.items()))
+
+        for year_num, age in enumerate(range(self.current_age, self.death_age)):
+            if (age < start_age) or (age >= end_age):
+                continue
+
+            #####
+            # Determine if there is a contribution for this year, only draw one if there is
+            #####
+            if (age >= annual_contrib_start_age) and (age < annual_contrib_end_age):
+                contrib[:, year_num] = self.generate_series(annual_contrib_amt_low, annual_contrib_amt_high, key + (year_num, "contrib"))
+            if isinstance(growth_perc_low, str):
+                growth[:, year_num] = historical_growth[:, year_num]
+            elif growth_factors is None:
+                growth[:, year_num] = self.generate_series(growth_perc_low, growth_perc_high, key + (year_num, "growth"))
+            else:
+                growth[:, year_num] = scale_standard_normals(growth_normals[:, year_num], growth_perc_low, growth_perc_high)
+
+            #####
+            # ((amount + contribution) + ((amount + contribution) * growth_percent)), same as generate_series_for_year
+            #####
+            x = amt + contrib[:, year_num]
+            amt = x + (x * growth[:, year_num])
+            amount[:, year_num] = amt
+
+        return {
+            "amount": amount,
+            "growth": growth,
+            "contrib": contrib,
+            "starting_amount": starting_amount,
+            "start_age": start_age,
+            "end_age": end_age
+        }
+
+    # How much of each shared factor an investment account's growth is made of, or None when it's drawn on its own, see return_correlation
+    # With one correlation for every pair of accounts it's the market factor plus the account's own factor, so any two accounts share return_correlation of it
+    # With a correlation matrix the factors are one for each account in the matrix, mixed by the matrix's Cholesky factor
+    # Either way the weights' squares add up to 1, so the growth has the same 90% range it would have on its own
+    def get_growth_factor_weights(self, ledger, name):
+        correlation = self.return_correlation
+        if (correlation is None) or (not ledger.isInvestment):
+            return None
+
+        if np.isscalar(correlation):
+            if (correlation < 0) or (correlation > 1):
+                raise Exception("return_correlation", "must be between 0 and 1 when it's a single number.  Use a correlation matrix for negative correlations.")
+            return {("market",): np.sqrt(correlation), (ledger.category, name): np.sqrt(1 - correlation)}
+
+        matrix = pd.DataFrame(correlation)
+        if (list(matrix.index) != list(matrix.columns)) or (not np.allclose(matrix.to_numpy(), matrix.to_numpy().T)) or (not np.allclose(np.diag(matrix.to_numpy()), 1)):
+            raise Exception("return_correlation", "must have the same account names, in the same order, for its index and columns, be symmetric and have 1 down its diagonal")
+        try:
+            cholesky = np.linalg.cholesky(matrix.to_numpy(dtype=float))
+        except np.linalg.LinAlgError:
+            raise Exception("return_correlation", "is not a valid correlation matrix (it needs to be positive definite)")
+        if name not in matrix.index:
+            return {(ledger.category, name): 1.0}
+        row = cholesky[matrix.index.get_loc(name)]
+        return {("correlation", column): row[column_num] for column_num, column in enumerate(matrix.columns) if row[column_num] != 0}
+
+    # A (num_samples x years) matrix of standard normals that the growth of correlated accounts is made from
+    # Each factor is drawn for every sample and year in one go, the first time an account needs it, and then shared by every account that uses it
+    def get_growth_factor(self, factor):
+        if factor not in self.growth_factors:
+            num_years = self.death_age - self.current_age
+            key = ("growth factor",) + factor
+            self.count("samples drawn", self.num_samples * num_years)
+            if self.sampler != "random":
+                z = self.generate_standard_normals(num_years, key, 0, self.num_samples)
+            elif self.seed is None:
+                z = np.random.standard_normal((self.num_samples, num_years))
+            else:
+                rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=get_stream_key(key)))
+                z = rng.standard_normal((self.num_samples, num_years))
+            self.growth_factors[factor] = np.asfortranarray(z)
+        return self.growth_factors[factor]
+
+    # Adds up the samples of every item in a paths dict, giving a (num_samples x years) matrix
+    def sum_paths(self, paths):
+        total = np.zeros((self.num_samples, self.death_age - self.current_age))
+        for item in paths.values():
+            total += item["amount"]
+        return total
+
+    # Add an expense to the expenses ledger
+    def add_expense(self, **kwargs):
+        self.items.append(Item("add_expense", kwargs))
+        self.add_item(self.expenses_ledger, isInvestment=False, paths=self.expenses_paths, **kwargs)
+
+    # Add an income to the income ledger
+    def add_income(self, **kwargs):
+        self.items.append(Item("add_income", kwargs))
+        self.add_item(self.income_ledger, isInvestment=False, paths=self.income_paths, **kwargs)
+
+    # Add a non-retirement investment to the non-retirement investments ledger
+    def add_nonretirement_investment(self, end_age=None,
+                                     growth_perc_low=0, 
+                                     growth_perc_high=0, 
+                                     annual_contrib_amt_low=0,
+                                     annual_contrib_amt_high=0,
+                                     annual_contrib_start_age=0,
+                                     annual_contrib_end_age=0,
+                                     **kwargs
+                                    ):
+        #since I'm using kwargs to persist account settings I need to make sure it has all the optional values
+        start_age = kwargs['start_age']
+        if (end_age is None) or (end_age==start_age):
+            end_age = start_age + 1
+        kwargs['end_age'] = end_age
+        kwargs['growth_perc_low'] = growth_perc_low
+        kwargs['growth_perc_high'] = growth_perc_high
+        kwargs['annual_contrib_amt_low'] = annual_contrib_amt_low
+        kwargs['annual_contrib_amt_high'] = annual_contrib_amt_high
+        kwargs['annual_contrib_start_age'] = annual_contrib_start_age
+        kwargs['annual_contrib_end_age'] = annual_contrib_end_age
+        self.items.append(Item("add_nonretirement_investment", kwargs))
+
+        self.add_item(self.nonretirement_investments_ledger, isInvestment=True, paths=self.nonretirement_investment_paths, **kwargs)
+
+        #persist the settings for recalculating account balances after distributions
+        self.nonretirement_account_settings[kwargs['name']] = kwargs
+
+    # Add a retirement investment to the retirement investments ledger
+    def add_retirement_investment(self, end_age=None,
+                                  growth_perc_low=0, 
+                                  growth_perc_high=0, 
+                                  annual_contrib_amt_low=0,
+                                  annual_contrib_amt_high=0,
+                                  annual_contrib_start_age=0,
+                                  annual_contrib_end_age=0,
+                                  **kwargs
+                                 ):
+        #since I'm using kwargs to persist account settings I need to make sure it has all the optional values
+        start_age = kwargs['start_age']
+        if (end_age is None) or (end_age==start_age):
+            end_age = start_age + 1
+        kwargs['end_age'] = end_age
+        kwargs['growth_perc_low'] = growth_perc_low
+        kwargs['growth_perc_high'] = growth_perc_high
+        kwargs['annual_contrib_amt_low'] = annual_contrib_amt_low
+        kwargs['annual_contrib_amt_high'] = annual_contrib_amt_high
+        kwargs['annual_contrib_start_age'] = annual_contrib_start_age
+        kwargs['annual_contrib_end_age'] = annual_contrib_end_age
+        self.items.append(Item("add_retirement_investment", kwargs))
+
+        self.add_item(self.retirement_investments_ledger, isInvestment = True, paths=self.retirement_investment_paths, **kwargs)
+
+        #persist the settings for recalculating account balances after distributions
+        self.retirement_account_settings[kwargs['name']] = kwargs
+
+    # Changes some of the arguments an item was added with, e.g. update_item("rent", starting_amt_high=30000)
+    # Only this item is projected again, the others keep their balances (or samples in "paths" mode).  With recompute "incremental",
+    # once generate_totals has run, the next generate_totals only recalculates what depends on it, see run_stages_incrementally
+    # Otherwise the next generate_totals runs every stage, starting every account from its projection again
+    def update_item(self, name, **changes):
+        if "name" in changes:
+            raise Exception(name, "can't be renamed by update_item")
+        matches = [item_num for item_num, item in enumerate(self.items) if item.name == name]
+        if len(matches) == 0:
+            raise Exception(name, "has not been added")
+        if len(matches) > 1:
+            raise Exception(name, "was added more than once (e.g. as an income and an expense).  Give them different names to update them.")
+
+        item_num = matches[0]
+        function_name = self.items[item_num].function_name
+        kwargs = dict(self.items[item_num].arguments, **changes)
+
+        ledger, paths, account_settings = self.get_item_state(function_name)
+        if (account_settings is not None) and ((kwargs['end_age'] is None) or (kwargs['end_age'] == kwargs['start_age'])):
+            kwargs['end_age'] = kwargs['start_age'] + 1
+
+        if not self.can_recompute_incrementally():
+            #####
+            # A projection of the item that is still waiting for generate_totals (see project_pending_items) is replaced by the new one
+            #####
+            self.pending_projections = [projection for projection in self.pending_projections if (projection[0] is not ledger) or (projection[2] != name)]
+            self.add_item(ledger, isInvestment=(account_settings is not None), paths=paths, replace=True, **kwargs)
+            self.items[item_num] = Item(function_name, kwargs)
+            if account_settings is not None:
+                account_settings[name] = kwargs
+            return
+
+        #####
+        # Project the item again, keeping the projection it had in the last run so restore_checkpoint can tell which of its balances are still good
+        #####
+
+        key = (ledger.category, name)
+        self.project_pending_items()
+        previous = self.changed_items[key][1] if key in self.changed_items else self.item_projections[key]
+        balances = ledger.values[ledger.index[name]].copy()
+
+        self.add_item(ledger, isInvestment=(account_settings is not None), paths=paths, replace=True, **kwargs)
+        self.project_pending_items()
+
+        #####
+        # An account's balances include the distributions of the last run, so they stay as they are until restore_checkpoint fixes them
+        #####
+        if account_settings is not None:
+            ledger.values[ledger.index[name]] = balances
+
+        self.items[item_num] = Item(function_name, kwargs)
+        if account_settings is not None:
+            account_settings[name] = kwargs
+
+        changed_years = np.flatnonzero(np.any(self.item_projections[key] != previous, axis=1))
+        if len(changed_years) == 0:
+            self.changed_items.pop(key, None)
+        else:
+            self.changed_items[key] = (int(changed_years[0]), previous)
+
+    # The ledger, paths and account settings (None for income and expenses) of the items an add_* function adds
+    def get_item_state(self, function_name):
+        return {
+            "add_expense": (self.expenses_ledger, self.expenses_paths, None),
+            "add_income": (self.income_ledger, self.income_paths, None),
+            "add_nonretirement_investment": (self.nonretirement_investments_ledger, self.nonretirement_investment_paths, self.nonretirement_account_settings),
+            "add_retirement_investment": (self.retirement_investments_ledger, self.retirement_investment_paths, self.retirement_account_settings)
+        }[function_name]
+
+    # The settings (other than OUTPUT_SETTINGS) and the number of items, which the checkpoints are only good for as long as they don't change
+    # retirement_age is left out.  Nothing depends on it before the year it's reached, so the checkpoints before then are still good, see run_stages_incrementally
+    def get_checkpoint_inputs(self):
+        settings = {name: getattr(self, name) for name in SCENARIO_SETTINGS if name not in OUTPUT_SETTINGS + ["retirement_age"]}
+        return json.dumps([settings, len(self.items)], sort_keys=True, default=repr)
+
+    # Whether the next generate_totals can start from the checkpoints of the last one
+    def can_recompute_incrementally(self):
+        return ((self.recompute == "incremental") and (self.simulation_mode != "paths") and (len(self.checkpoints) > 0)
+                and (self.checkpoint_inputs == self.get_checkpoint_inputs()))
+
+    # This is the most important function.  It runs a simulation for every year with num_samples iterations.
+    # each simulation takes one possible income value, one possible expense value, and one possible value for each of the investment accounts
+    # it then determines if a distribution is needed from the investment accounts to make up for insufficient income, and keeps track of what those adjustments are
+    # After the simulations run for the year, it analyzes the output, and if necessary, updates investment account balances based on distributions that were needed
+    # from_checkpoint starts from the checkpoint of that year instead of the first year, see run_stages_incrementally
+    def process_expenses(self, from_checkpoint=None):
+        if self.simulation_mode == "paths":
+            self.process_expenses_from_paths()
+            return
+
+        #####
+        # With incremental reprojection, keeps track of accounts that still need years recalculated after a distribution
+        # See project_pending_account_balances
+        #####
+        nonretirement_pending = {}
+        retirement_pending = {}
+        if from_checkpoint is not None:
+            nonretirement_pending, retirement_pending = self.restore_checkpoint(from_checkpoint)
+
+        #####
+        # Loop over every year
+        #####
+        for i, (age, year) in enumerate(zip(self.expenses_ledger.ages, self.expenses_ledger.years)):
+            if (from_checkpoint is not None) and (i < from_checkpoint):
+                continue
+            if self.recompute == "incremental":
+                self.save_checkpoint(i, nonretirement_pending, retirement_pending)
+
+            #####
+            # Bring any accounts that had a distribution taken in an earlier year up to date for this year
+            #####
+            self.project_pending_account_balances(self.nonretirement_investments_ledger, self.nonretirement_account_settings, nonretirement_pending, age + 1)
+            self.project_pending_account_balances(self.retirement_investments_ledger, self.retirement_account_settings, retirement_pending, age + 1)
+
+            #####
+            # Create series with num_samples items for expenses and income for that year
+            # In streaming and adaptive modes the samples are drawn a chunk at a time by run_simulations_streaming instead
+            #####
+            total_expenses_low = self.expenses_ledger.totals[i, LOW]
+            total_expenses_high = self.expenses_ledger.totals[i, HIGH]
+            if not self.draws_in_chunks():
+                total_expenses_series = self.generate_series(total_expenses_low, total_expenses_high, ("process expenses", "expenses", i))
+
+            total_income_low = self.income_ledger.totals[i, LOW]
+            total_income_high = self.income_ledger.totals[i, HIGH]
+            if not self.draws_in_chunks():
+                total_income_series = self.generate_series(total_income_low, total_income_high, ("process expenses", "income", i))
+
+
+            #####
+            # Get list of investment accounts available this year
+            # if retirement_age isn't met yet, it will be an empty list
+            #####
+            nonretirement_investment_list = self.get_investment_list_for_expense_processing(self.nonretirement_investments_ledger, i)
+            retirement_investment_list = self.get_investment_list_for_expense_processing(self.retirement_investments_ledger, i) if age >= self.retirement_age else []
+
+
+            #####
+            # Run simulations
+            # Distributions are taken from the accounts by distribution_strategy, by default non-retirement accounts before retirement accounts
+            #####
+            simulations_run = self.num_samples
+            distribute = self.get_distribution_strategy(nonretirement_investment_list, retirement_investment_list)
+            if self.draws_in_chunks():
+                insufficent_income_counter, simulations_run = self.run_simulations_streaming(i,
+                                                                            total_income_low,
+                                                                            total_income_high,
+                                                                            total_expenses_low,
+                                                                            total_expenses_high,
+                                                                            nonretirement_investment_list + retirement_investment_list,
+                                                                            distribute)
+            else:
+                if self.expense_engine == "legacy":
+                    insufficent_income_counter, remaining_shortage = run_simulations_legacy(total_income_series,
+                                                                                            total_expenses_series,
+                                                                                            nonretirement_investment_list + retirement_investment_list)
+                else:
+                    insufficent_income_counter, remaining_shortage = run_simulations_vectorized(total_income_series,
+                                                                                                total_expenses_series,
+                                                                                                nonretirement_investment_list + retirement_investment_list,
+                                                                                                distribute)
+                short, depleted = find_shortfalls(remaining_shortage, nonretirement_investment_list + retirement_investment_list)
+                self.record_shortfalls(i, np.count_nonzero(short), np.count_nonzero(depleted), simulations_run)
+
+
+            #####
+            # Simulations complete for the year
+            #####
+            if (insufficent_income_counter > 0):
+                self.log_event("insufficient income", year, age, simulations=simulations_run, insufficient=insufficent_income_counter)
+            else:
+                self.log_event("sufficient income", year, age, simulations=simulations_run)
+
+            #####
+            # Update account balances if a distribution was taken
+            #####
+            self.update_account_balance_if_distribution_was_taken(nonretirement_investment_list,
+                                                            self.nonretirement_investments_ledger,
+                                                            self.nonretirement_account_settings,
+                                                            age,
+                                                            year,
+                                                            i,
+                                                            nonretirement_pending)
+
+            self.update_account_balance_if_distribution_was_taken(retirement_investment_list,
+                                                            self.retirement_investments_ledger,
+                                                            self.retirement_account_settings,
+                                                            age,
+                                                            year,
+                                                            i,
+                                                            retirement_pending)
+
+        #####
+        # Recalculate the rest of the years for any accounts that are still waiting on it
+        #####
+        self.project_pending_account_balances(self.nonretirement_investments_ledger, self.nonretirement_account_settings, nonretirement_pending, self.death_age)
+        self.project_pending_account_balances(self.retirement_investments_ledger, self.retirement_account_settings, retirement_pending, self.death_age)
+
+        #####
+        # One more checkpoint for after the last year, so a run with nothing to recalculate knows where the log ended
+        #####
+        if self.recompute == "incremental":
+            self.save_checkpoint(len(self.expenses_ledger.ages), nonretirement_pending, retirement_pending)
+
+    # Keeps everything process_expenses changes as of the start of a year: the investment ledgers, the accounts waiting to be recalculated and the log
+    def save_checkpoint(self, year_num, nonretirement_pending, retirement_pending):
+        self.checkpoints[year_num] = {
+            "nonretirement": self.nonretirement_investments_ledger.values.copy(),
+            "retirement": self.retirement_investments_ledger.values.copy(),
+            "nonretirement pending": dict(nonretirement_pending),
+            "retirement pending": dict(retirement_pending),
+            "log length": len(self.event_log)
+        }
+
+    # Puts everything back the way it was at the start of a year of the last run, and returns the pending dicts for process_expenses
+    # Any investment accounts update_item changed since then have their balances from the first year they changed fixed:
+    #     if no distribution was taken from the account before then, they are just the account's new projection
+    #     with incremental reprojection the account is already waiting to be recalculated, with its new settings, as process_expenses gets to each year
+    #     otherwise they are recalculated now from the balance of the year before
+    def restore_checkpoint(self, year_num):
+        checkpoint = self.checkpoints[year_num]
+        self.nonretirement_investments_ledger.values = checkpoint["nonretirement"].copy()
+        self.retirement_investments_ledger.values = checkpoint["retirement"].copy()
+        nonretirement_pending = dict(checkpoint["nonretirement pending"])
+        retirement_pending = dict(checkpoint["retirement pending"])
+        self.event_log.truncate(checkpoint["log length"])
+
+        for (category, name), (first_year, previous) in self.changed_items.items():
+            if category == self.nonretirement_investments_ledger.category:
+                ledger, account_settings, pending = self.nonretirement_investments_ledger, self.nonretirement_account_settings, nonretirement_pending
+            elif category == self.retirement_investments_ledger.category:
+                ledger, account_settings, pending = self.retirement_investments_ledger, self.retirement_account_settings, retirement_pending
+            else:
+                continue
+
+            item_num = ledger.index[name]
+            settings = account_settings[name]
+            if np.array_equal(ledger.values[item_num, :first_year], previous[:first_year]):
+                ledger.values[item_num, first_year:] = self.item_projections[(category, name)][first_year:]
+                pending.pop(name, None)
+                continue
+
+            ledger.values[item_num, ledger.year_range(settings['end_age'], self.death_age)] = 0
+            if name in pending:
+                continue
+
+            ledger.values[item_num, first_year:] = 0
+            self.set_item_balances(ledger,
+                name,
+                int(ledger.ages[first_year]),
+                settings['end_age'],
+                settings['growth_perc_low'],
+                settings['growth_perc_high'],
+                ledger.values[item_num, first_year - 1, LOW],
+                ledger.values[item_num, first_year - 1, HIGH],
+                settings['annual_contrib_amt_low'],
+                settings['annual_contrib_amt_high'],
+                settings['annual_contrib_start_age'],
+                settings['annual_contrib_end_age']
+            )
+            pending[name] = settings['end_age']
+
+        return nonretirement_pending, retirement_pending
+
+    # Streaming and adaptive modes' version of running the simulations for a year, which always uses the vectorized engine
+    # Income, expenses and account balances are drawn a chunk at a time, and the chunk's simulations are run
+    # Rather than keeping every simulation's balances and distributions, they're added to a QuantileSketch for each account
+    # In adaptive mode it stops once the 90% bounds of every account's lists settle
+    # Returns the number of simulations with insufficient income, like run_simulations_vectorized, and the number of simulations run
+    def run_simulations_streaming(self, year_num, total_income_low, total_income_high, total_expenses_low, total_expenses_high, investment_list, distribute):
+        for investment in investment_list:
+            investment["sketches"] = {list_name: self.new_sketch() for list_name in INVESTMENT_LISTS}
+
+        insufficent_income_counter = 0
+        short_counter = 0
+        depleted_counter = 0
+        simulations_run = 0
+        previous = None
+        for start, stop in self.get_chunks():
+            total_expenses_samples = self.generate_samples(total_expenses_low, total_expenses_high, ("process expenses", "expenses", year_num), start, stop)
+            total_income_samples = self.generate_samples(total_income_low, total_income_high, ("process expenses", "income", year_num), start, stop)
+            for investment in investment_list:
+                investment["starting_balance_list"] = self.generate_samples(investment["starting_balance_low"],
+                                                                            investment["starting_balance_high"],
+                                                                            investment["key"],
+                                                                            start,
+                                                                            stop)
+
+            insufficent_income, remaining_shortage = run_simulations_vectorized(total_income_samples, total_expenses_samples, investment_list, distribute)
+            short, depleted = find_shortfalls(remaining_shortage, investment_list)
+            insufficent_income_counter += insufficent_income
+            short_counter += np.count_nonzero(short)
+            depleted_counter += np.count_nonzero(depleted)
+
+            for investment in investment_list:
+                for list_name in INVESTMENT_LISTS:
+                    investment["sketches"][list_name].update(investment[list_name])
+            simulations_run = stop
+
+            if self.adaptive:
+                current = [investment["sketches"][list_name].quantiles([0.05, 0.95]) for investment in investment_list for list_name in INVESTMENT_LISTS]
+                if (previous is not None) and self.has_converged(previous, current):
+                    break
+                previous = current
+
+        #####
+        # Only the sketches are kept, the lists just hold the last chunk
+        #####
+        for investment in investment_list:
+            for list_name in INVESTMENT_LISTS:
+                investment[list_name] = []
+                self.streaming_rank_error = max(self.streaming_rank_error, investment["sketches"][list_name].rank_error())
+
+        self.record_samples_used("process expenses", simulations_run)
+        self.record_shortfalls(year_num, short_counter, depleted_counter, simulations_run)
+        return insufficent_income_counter, simulations_run
+
+    # The distribution_strategy for a year's accounts, as a function that takes the (num_samples x accounts) starting balances
+    # and the shortages, and returns the ending balances, distributions and the shortage left, like drain_investments
+    def get_distribution_strategy(self, nonretirement_investment_list, retirement_investment_list):
+        strategy = self.distribution_strategy
+        if not callable(strategy):
+            if strategy not in DISTRIBUTION_STRATEGIES:
+                raise Exception("distribution_strategy", "must be a function or one of " + ", ".join(DISTRIBUTION_STRATEGIES.keys()))
+            strategy = DISTRIBUTION_STRATEGIES[strategy]
+        is_retirement = np.array([False] * len(nonretirement_investment_list) + [True] * len(retirement_investment_list))
+        return lambda starting_balances, shortage: strategy(starting_balances, shortage, is_retirement, self)
+
+    # Keeps how many of a year's simulations had a shortage the investments couldn't cover, and how many had run out, see shortfall and depletion
+# Only "paths" mode follows a simulation from one year to the next.  In "bands" mode each year's balances are drawn again, so these are per year only
+    def record_shortfalls(self, year_num, short_count, depleted_count, simulations_run):
+        self.shortfall[year_num] = short_count / simulations_run
+        self.depletion[year_num] = depleted_count / simulations_run
+
+    # When reprojection is "incremental", a distribution only recalculates the balance for the year it was taken in
+    # pending holds the next age that still needs recalculating for each of those accounts.
+    # This recalculates those accounts from that age up to (but excluding) up_to_age, starting from the year before it
+    def project_pending_account_balances(self, investment_ledger, account_settings, pending, up_to_age):
+        for name, next_age in pending.items():
+            settings = account_settings[name]
+            end_age = min(up_to_age, settings['end_age'])
+            if next_age >= end_age:
+                continue
+
+            item_num = investment_ledger.index[name]
+            previous_year_num = next_age - self.current_age - 1
+            self.count("account reprojections")
+            self.count("reprojected years", int(end_age - next_age))
+            with self.stage("reprojection"):
+                self.set_item_balances(investment_ledger,
+                    name,
+                    next_age,
+                    end_age,
+                    settings['growth_perc_low'],
+                    settings['growth_perc_high'],
+                    investment_ledger.values[item_num, previous_year_num, LOW],
+                    investment_ledger.values[item_num, previous_year_num, HIGH],
+                    settings['annual_contrib_amt_low'],
+                    settings['annual_contrib_amt_high'],
+                    settings['annual_contrib_start_age'],
+                    settings['annual_contrib_end_age']
+                )
+            pending[name] = end_age
+
+    # The "paths" mode version of process_expenses
+    # Rather than drawing new samples from the 90% bounds every year, simulation N uses sample N of every item in every year
+    # Investment accounts are grown one year at a time from whatever was left in that simulation after the previous year's distributions
+    def process_expenses_from_paths(self):
+        total_income = self.sum_paths(self.income_paths)
+        total_expenses = self.sum_paths(self.expenses_paths)
+        ran_out = np.zeros(self.num_samples, dtype=bool)
+
+        #####
+        # Loop over every year
+        #####
+        for i, (age, year) in enumerate(zip(self.expenses_ledger.ages, self.expenses_ledger.years)):
+
+            #####
+            # Grow every account from last year's ending balance, which includes any distributions taken last year
+            #####
+            for account in list(self.nonretirement_investment_paths.values()) + list(self.retirement_investment_paths.values()):
+                self.grow_account_path(account, i)
+
+            #####
+            # Get list of investment accounts available this year
+            # if retirement_age isn't met yet, it will be an empty list
+            #####
+            nonretirement_investment_list = get_investment_list_from_paths(self.nonretirement_investment_paths, i)
+            retirement_investment_list = get_investment_list_from_paths(self.retirement_investment_paths, i) if age >= self.retirement_age else []
+
+            #####
+            # Run simulations
+            # Distributions are taken from the accounts by distribution_strategy
+            # Each simulation is the same one from year to year, so once it runs out it counts as having run out from then on
+            #####
+            insufficent_income_counter, remaining_shortage = run_simulations_vectorized(total_income[:, i],
+                                                                                        total_expenses[:, i],
+                                                                                        nonretirement_investment_list + retirement_investment_list,
+                                                                                        self.get_distribution_strategy(nonretirement_investment_list, retirement_investment_list))
+            short, depleted = find_shortfalls(remaining_shortage, nonretirement_investment_list + retirement_investment_list)
+            ran_out |= depleted
+            self.record_shortfalls(i, np.count_nonzero(short), np.count_nonzero(ran_out), self.num_samples)
+
+            #####
+            # Simulations complete for the year
+            #####
+            if (insufficent_income_counter > 0):
+                self.log_event("insufficient income", year, age, simulations=self.num_samples, insufficient=insufficent_income_counter)
+            else:
+                self.log_event("sufficient income", year, age, simulations=self.num_samples)
+
+            #####
+            # Record the distributions, then carry each simulation's ending balance into next year
+            #####
+            self.update_account_balance_if_distribution_was_taken(nonretirement_investment_list,
+                                                            self.nonretirement_investments_ledger,
+                                                            self.nonretirement_account_settings,
+                                                            age,
+                                                            year,
+                                                            i)
+
+            self.update_account_balance_if_distribution_was_taken(retirement_investment_list,
+                                                            self.retirement_investments_ledger,
+                                                            self.retirement_account_settings,
+                                                            age,
+                                                            year,
+                                                            i)
+
+            for investment in nonretirement_investment_list + retirement_investment_list:
+                investment["path"]["amount"][:, i] = investment["ending_balance_list"]
+
+        #####
+        # Now that every distribution has been taken, report the 90% bounds of the account balances
+        #####
+        for name, account in self.nonretirement_investment_paths.items():
+            set_item_balances_from_paths(self.nonretirement_investments_ledger, name, account["amount"], self.get_quantiles())
+        for name, account in self.retirement_investment_paths.items():
+            set_item_balances_from_paths(self.retirement_investments_ledger, name, account["amount"], self.get_quantiles())
+        self.count("quantile computations", len(self.expenses_ledger.ages) * (len(self.nonretirement_investment_paths) + len(self.retirement_investment_paths)))
+
+    # Recalculates one year of an account's samples from the previous year's samples, using the growth and contribution drawn for that year
+    # The first year of the account is grown from its starting amount again, so running process_expenses_from_paths again starts from the projection
+    # rather than from balances the last run already took distributions out of
+    def grow_account_path(self, account, year_num):
+        age = self.current_age + year_num
+        if (age < account["start_age"]) or (age >= account["end_age"]):
+            return
+
+        previous = account["starting_amount"] if (age == account["start_age"]) or (year_num == 0) else account["amount"][:, year_num - 1]
+        x = previous + account["contrib"][:, year_num]
+        account["amount"][:, year_num] = x + (x * account["growth"][:, year_num])
+
+    def update_account_balance_if_distribution_was_taken(self, investment_list,
+                                                         investment_ledger,
+                                                         account_settings,
+                                                         age,
+                                                         year,
+                                                         row_index,
+                                                         pending=None
+                                                        ):
+
+         for investment in investment_list:
+                #####
+                # The 5th and 95th percentile of the starting balances, distributions and ending balances, all taken at once
+                #####
+                bounds = get_investment_quantiles(investment, [0.05, 0.95])
+                self.count("quantile computations", len(INVESTMENT_LISTS))
+                starting_balance_low, new_balanace_low, distribution_low = bounds[0]
+                starting_balance_high, new_balanace_high, distribution_high = bounds[1]
+
+                #####
+                # Distribution is a negative number
+                # distribution_low is the greater negative number
+                # if a series generates a positive distribution, those numbers must be removed
+                #####
+                distribution_high = distribution_high if distribution_high <=0 else 0;
+
+                new_balanace_low = new_balanace_low if new_balanace_low > 0 else 0
+                new_balanace_high = new_balanace_high if new_balanace_high > 0 else 0
+
+                #update ledger with distribution amounts
+                item_num = investment_ledger.index[investment["name"]]
+                investment_ledger.values[item_num, row_index, DISTRIBUTION_LOW] = distribution_low
+                investment_ledger.values[item_num, row_index, DISTRIBUTION_HIGH] = distribution_high
+
+                if (distribution_low < 0): #this means a distribution was taken (distribution is a negative number)
+
+                    self.log_event("distribution", year, age,
+                                   account=investment["name"],
+                                   distribution=(distribution_low, distribution_high),
+                                   balance_before=(starting_balance_low, starting_balance_high),
+                                   balance_after=(new_balanace_low, new_balanace_high))
+
+                    #####
+                    # regen the series, blowing away current values
+                    # In "paths" mode this isn't needed, process_expenses_from_paths grows each simulation's ending balance into next year
+                    #####
+                    if self.simulation_mode == "paths":
+                        continue
+
+                    #####
+                    # With incremental reprojection only this year is recalculated now
+                    # The following years are recalculated by project_pending_account_balances as process_expenses gets to them
+                    #####
+                    reprojection_end_age = account_settings[investment["name"]]['end_age']
+                    if self.reprojection == "incremental":
+                        reprojection_end_age = min(age + 1, reprojection_end_age)
+                        pending[investment["name"]] = age + 1
+
+                    self.count("account reprojections")
+                    self.count("reprojected years", int(max(reprojection_end_age - age, 0)))
+                    with self.stage("reprojection"):
+                        self.set_item_balances(investment_ledger, 
+                            investment["name"],
+                            age, 
+                            reprojection_end_age,
+                            account_settings[investment["name"]]['growth_perc_low'], 
+                            account_settings[investment["name"]]['growth_perc_high'], 
+                            new_balanace_low,
+                            new_balanace_high,
+                            account_settings[investment["name"]]['annual_contrib_amt_low'], 
+                            account_settings[investment["name"]]['annual_contrib_amt_high'], 
+                            account_settings[investment["name"]]['annual_contrib_start_age'], 
+                            account_settings[investment["name"]]['annual_contrib_end_age']
+                        )
+                else:
+                    self.log_event("no distribution", year, age, account=investment["name"])
+
+    #####
+    # Create a list of investment accounts, where each item is a dict containing
+    #     name
+    #     array with num_samples items representing beginning balance
+    #     list representing ending balance after processing expenses (will be populated in processing)
+    #     list representing distribution that was taken out to cover expenses (will be populated in processing)
+    #####        
+    def get_investment_list_for_expense_processing(self, investment_ledger,
+                                                   row_index
+                                                  ):
+        retList = []
+
+        for item_num, account_name in enumerate(investment_ledger.names):
+
+            #get account balance values
+            account_balance_low = investment_ledger.values[item_num, row_index, LOW]
+            account_balance_high = investment_ledger.values[item_num, row_index, HIGH]
+
+            #no point in adding the account if its empty
+            if (account_balance_high > 0):
+                key = ("process expenses", investment_ledger.category, account_name, int(row_index))
+
+                #in streaming and adaptive modes the balances are drawn a chunk at a time by run_simulations_streaming
+                if self.draws_in_chunks():
+                    retList.append({
+                        'name': account_name,
+                        'key': key,
+                        'starting_balance_low': account_balance_low,
+                        'starting_balance_high': account_balance_high,
+                        'starting_balance_list': [],
+                        'ending_balance_list': [],
+                        'distribution_list': []
+                    })
+                    continue
+
+                #generate a series of balance values
+                account_balance_series = self.generate_series(account_balance_low, account_balance_high, key)
+
+                retList.append({
+                    'name': account_name,
+                    'starting_balance_list': account_balance_series.to_numpy(),
+                    'ending_balance_list': [],
+                    'distribution_list': []
+                })
+
+        return retList
+
+    # Set the total low and high for every year in a ledger
+    # by going through all the items in that ledger, creating their series, then adding it all up
+    # In "paths" mode the samples each item already has are added up instead
+    # first_year only recalculates that year and the ones after it, see run_stages_incrementally
+    def generate_total(self, ledger, paths=None, first_year=0):
+
+        if first_year == 0:
+            ledger.totals = np.zeros((len(ledger.ages), len(self.get_quantiles())))
+
+        if self.simulation_mode == "paths":
+            check_paths(ledger.names, paths)
+            ledger.totals[:] = get_bounds_from_paths(self.sum_paths(paths), self.get_quantiles())
+            self.count("quantile computations", len(ledger.ages))
+            return
+
+        #loop over each year
+        for year_num in range(first_year, len(ledger.ages)):
+
+            #in streaming and adaptive modes add up the items a chunk of samples at a time
+            if self.draws_in_chunks():
+                ledger.totals[year_num] = self.stream_quantiles(lambda start, stop: self.generate_total_samples(ledger, year_num, start, stop), self.get_quantiles(), "totals")
+                continue
+
+            total = pd.Series(np.repeat(0, self.num_samples))
+            for item_num, name in enumerate(ledger.names):
+                low = ledger.values[item_num, year_num, LOW]
+                high = ledger.values[item_num, year_num, HIGH]
+                amt_series = self.generate_series(low, high, ("totals", ledger.category, name, year_num))
+                new_total = total.add(amt_series)
+                total = new_total
+
+            ledger.totals[year_num] = np.quantile(total, self.get_quantiles())
+            self.count("quantile computations")
+
+    # The total of every item in a ledger for samples start to stop of a year, used by streaming mode
+    def generate_total_samples(self, ledger, year_num, start, stop):
+        total = np.zeros(stop - start)
+        for item_num, name in enumerate(ledger.names):
+            low = ledger.values[item_num, year_num, LOW]
+            high = ledger.values[item_num, year_num, HIGH]
+            total += self.generate_samples(low, high, ("totals", ledger.category, name, year_num), start, stop)
+        return total
+
+    # This function is called after all values have been entered in the notebook
+    # It totals everything up as well as processes all expenses and adjusts investment account balances if necessary
+    # write_output=False skips the CSV files and the log, which is what the sweep workers do so they don't overwrite each other
+    def generate_totals(self, write_output=True):
+        if self.streaming and (self.simulation_mode == "paths"):
+            raise Exception("streaming", "only works with simulation_mode \"bands\".  \"paths\" keeps every sample, so it can't be streamed.")
+        if self.adaptive and (self.simulation_mode == "paths"):
+            raise Exception("adaptive", "only works with simulation_mode \"bands\".  \"paths\" needs the same samples for every item and year.")
+        if (self.expense_engine == "legacy") and (self.distribution_strategy != "fixed order"):
+            raise Exception("distribution_strategy", "only \"fixed order\" works with expense_engine \"legacy\"")
+        if (self.return_correlation is not None) and (self.simulation_mode != "paths"):
+            raise Exception("return_correlation", "only works with simulation_mode \"paths\".  \"bands\" reduces every account to its own 90% bounds each year, so there is nothing for the accounts to share.")
+        if (len(self.items) > 0) and (self.expenses_ledger.percentiles != list(self.percentiles)):
+            self.rebuild_items()
+        self.set_ledger_percentiles()
+
+        #####
+        # Use the cached results if there are any, otherwise run everything and cache the results
+        #####
+        cache_path = self.get_cache_path()
+        if (cache_path is None) or self.cache_bypass or (not self.load_cached_results(cache_path)):
+            with self.stage("generate_totals"):
+                self.project_pending_items()
+                if self.recompute == "incremental":
+                    self.run_stages_incrementally()
+                else:
+                    self.run_stages()
+
+            if self.streaming:
+                self.log("Streaming mode percentiles are within " + '{:.3%}'.format(self.streaming_rank_error) + " of the exact percentile")
+            if self.adaptive:
+                for stage, counts in self.samples_used.items():
+                    self.log("Adaptive mode used " + '{:,}'.format(min(counts)) + " to " + '{:,}'.format(max(counts)) + " samples (" + '{:,}'.format(int(np.mean(counts))) + " on average) for " + stage)
+
+            if cache_path is not None:
+                with self.stage("cache_results"):
+                    self.cache_results(cache_path)
+
+        if write_output:
+            with self.stage("write_csv_files"):
+                self.write_csv_files()
+            if self.export_format is not None:
+                with self.stage("export_results"):
+                    self.export_results()
+            with self.stage("write_log"):
+                self.write_log()
+
+    # The file this scenario's results are cached in, or None when the cache is off
+    # The name is a hash of everything that goes into the results: the ages, the settings (other than OUTPUT_SETTINGS), every add_* call
+    # and what's in the historical_returns file
+    def get_cache_path(self):
+        if self.cache_dir is None:
+            return None
+        spec = self.spec()
+        for name in OUTPUT_SETTINGS:
+            del spec["settings"][name]
+        if self.historical_returns is not None:
+            with open(self.historical_returns, "rb") as returns_file:
+                spec["historical returns"] = hashlib.sha256(returns_file.read()).hexdigest()
+        inputs = json.dumps([CACHE_VERSION, spec], sort_keys=True, default=get_cache_key_value)
+        return os.path.join(self.cache_dir, hashlib.sha256(inputs.encode()).hexdigest() + ".pkl")
+
+    # Everything generate_totals changes, which is what gets cached
+    # item_projections is there too, so a run after loading cached results (e.g. after update_item) starts every account from its projection, see run_stages
+    CACHED_ATTRIBUTES = ["expenses_ledger", "income_ledger", "nonretirement_investments_ledger", "retirement_investments_ledger", "networth_ledger",
+                         "income_paths", "expenses_paths", "nonretirement_investment_paths", "retirement_investment_paths",
+                         "event_log", "streaming_rank_error", "samples_used", "shortfall", "depletion", "item_projections"]
+
+    # Replaces this scenario's results with the cached ones and returns True, or returns False if they aren't cached
+    def load_cached_results(self, cache_path):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                results = pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.count("cache misses")
+            return False
+
+        #####
+        # Touching the file marks it as just used, so it's the last to be deleted, see evict_cache
+        #####
+        os.utime(cache_path)
+        for name in Scenario.CACHED_ATTRIBUTES:
+            setattr(self, name, results[name])
+        self.pending_projections = []
+        self.checkpoints = {}
+        self.build_frames()
+        self.count("cache hits")
+        return True
+
+    # Saves the results to the cache, then deletes the results used longest ago until it's within cache_size
+    # The file is written under a temporary name and then renamed, so another process never reads half of it
+    def cache_results(self, cache_path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temporary_path = cache_path + "." + str(os.getpid()) + ".tmp"
+        with open(temporary_path, "wb") as cache_file:
+            pickle.dump({name: getattr(self, name) for name in Scenario.CACHED_ATTRIBUTES}, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, cache_path)
+        evict_cache(self.cache_dir, self.cache_size)
+
+    # The stages of generate_totals, each timed on its own when instrumentation is on
+    # Every account starts again from its projection, and the log from empty, so running it again gives the same results rather than
+    # taking the distributions out of accounts they were already taken out of
+    def run_stages(self):
+        if self.simulation_mode != "paths":
+            for ledger in [self.nonretirement_investments_ledger, self.retirement_investments_ledger]:
+                for item_num, name in enumerate(ledger.names):
+                    ledger.values[item_num] = self.item_projections[(ledger.category, name)]
+        self.event_log.truncate(0)
+
+        with self.stage("generate_total (income)"):
+            self.generate_total(self.income_ledger, self.income_paths)
+        with self.stage("generate_total (expenses)"):
+            self.generate_total(self.expenses_ledger, self.expenses_paths)
+        with self.stage("process_expenses"):
+            self.process_expenses()
+        with self.stage("generate_total (nonretirement)"):
+            self.generate_total(self.nonretirement_investments_ledger, self.nonretirement_investment_paths)
+        with self.stage("generate_total (retirement)"):
+            self.generate_total(self.retirement_investments_ledger, self.retirement_investment_paths)
+        with self.stage("generate_networth"):
+            self.generate_networth()
+        with self.stage("build_frames"):
+            self.build_frames()
+
+    # recompute "incremental"'s version of run_stages
+    # The first time, and whenever a setting changes or an item is added, every account starts again from its projection and everything is run,
+    # keeping a checkpoint of every year of process_expenses.  After that only the items changed by update_item are recalculated:
+    #     an income or expense changes the totals of its ledger
+    #     any item changes process_expenses, and so the investment totals and networth
+    # all from the first year any of them changed.  Everything before that year is kept from the last run
+    def run_stages_incrementally(self):
+        if self.simulation_mode == "paths":
+            raise Exception("recompute", "\"incremental\" only works with simulation_mode \"bands\"")
+
+        if not self.can_recompute_incrementally():
+            self.checkpoints = {}
+            self.changed_items = {}
+            self.run_stages()
+            self.checkpoint_inputs = self.get_checkpoint_inputs()
+            self.checkpoint_retirement_age = self.retirement_age
+            return
+
+        #####
+        # Start from the first year a changed item changed, or the earlier of the old and new retirement_age if it changed
+        #####
+        first_years = [first_year for first_year, previous in self.changed_items.values()]
+        if self.retirement_age != self.checkpoint_retirement_age:
+            first_years.append(min(max(min(self.retirement_age, self.checkpoint_retirement_age) - self.current_age, 0), len(self.networth_ledger.ages)))
+        first_year = min(first_years, default=len(self.networth_ledger.ages))
+        changed_categories = set(category for category, name in self.changed_items)
+        if first_year == len(self.networth_ledger.ages):
+            self.event_log.truncate(self.checkpoints[first_year]["log length"])
+        else:
+            for ledger, paths in [(self.income_ledger, self.income_paths), (self.expenses_ledger, self.expenses_paths)]:
+                if ledger.category in changed_categories:
+                    with self.stage("generate_total (" + ledger.category + ")"):
+                        self.generate_total(ledger, paths, first_year)
+            with self.stage("process_expenses"):
+                self.process_expenses(first_year)
+            with self.stage("generate_total (nonretirement)"):
+                self.generate_total(self.nonretirement_investments_ledger, self.nonretirement_investment_paths, first_year)
+            with self.stage("generate_total (retirement)"):
+                self.generate_total(self.retirement_investments_ledger, self.retirement_investment_paths, first_year)
+            with self.stage("generate_networth"):
+                self.generate_networth(first_year)
+        self.changed_items = {}
+        self.checkpoint_retirement_age = self.retirement_age
+        with self.stage("build_frames"):
+            self.build_frames()
+
+    # Everything needed to build this scenario again: its ages, its settings and every add_* call
+    # Overrides can change any of those.  The keys are either a setting, like "retirement_age" or "num_samples",
+    # or an item name and an add_* argument separated by a period, like "401k.growth_perc_low"
+    def spec(self, overrides={}):
+        settings = {name: getattr(self, name) for name in SCENARIO_SETTINGS}
+        items = [(item.function_name, dict(item.arguments)) for item in self.items]
+        item_names = [item.name for item in self.items]
+
+        for key, value in overrides.items():
+            if key in settings:
+                settings[key] = value
+            elif ("." in key) and (key.rsplit(".", 1)[0] in item_names):
+                item_name, argument = key.rsplit(".", 1)
+                items[item_names.index(item_name)][1][argument] = value
+            else:
+                raise Exception(key, "is not a setting or an item of this scenario.  Use a setting name or \"<item name>.<argument>\".")
+
+        return {
+            "current_year": self.current_year,
+            "current_age": self.current_age,
+            "death_age": self.death_age,
+            "settings": settings,
+            "items": items
+        }
+
+    # One row per year with the low and high totals of every ledger, used for the results of a sweep
+    def summary(self):
+        summary = pd.DataFrame({"age": self.networth_ledger.ages, "year": self.networth_ledger.years})
+        for label, ledger in [("income", self.income_ledger),
+                              ("expenses", self.expenses_ledger),
+                              ("nonretirement", self.nonretirement_investments_ledger),
+                              ("retirement", self.retirement_investments_ledger),
+                              ("networth", self.networth_ledger)]:
+            summary[label + " low"] = ledger.totals[:, LOW]
+            summary[label + " high"] = ledger.totals[:, HIGH]
+            for percentile_num, percentile in enumerate(ledger.percentiles):
+                summary[label + " " + percentile_name(percentile)] = ledger.totals[:, 2 + percentile_num]
+        summary["shortfall"] = self.shortfall
+        summary["depletion"] = self.depletion
+        return summary
+
+    # The chance of running out of every account that can be used, from the last generate_totals, see depletion
+    # In "paths" mode it's the chance of having run out by the last year.  In "bands" mode it's only the worst single year,
+    # as each year's balances are drawn again, so the solvers always use "paths" mode, see new_solver_scenario
+    def get_depletion_probability(self):
+        return float(self.depletion.max())
+
+    # A copy of this scenario for the solvers to change over and over, without touching this one
+    # It has a seed (0 if this one doesn't), so every try uses the same random draws and the only difference between them is what the solver changed.
+    # It runs in "paths" mode (see PATHS_SETTINGS), so whether a simulation runs out follows it from year to year.
+    # Each try only projects the item the solver changed again (see update_item), the rest keep their samples and only the stages after them run again
+    def new_solver_scenario(self):
+        solver = scenario_from_spec(self.spec(dict(PATHS_SETTINGS, **{
+            "seed": 0 if self.seed is None else self.seed,
+            "log_level": "none",
+            "cache_dir": None
+        })))
+        solver.instrumentation = self.instrumentation
+        return solver
+
+    # The add_* arguments of an item, as long as it was added by function_name
+    def get_item_arguments(self, name, function_name):
+        matches = [item for item in self.items if item.name == name]
+        if len(matches) == 0:
+            raise Exception(name, "has not been added")
+        if matches[0].function_name != function_name:
+            raise Exception(name, "was not added by " + function_name)
+        return dict(matches[0].arguments)
+
+    # The most that can be spent on one expense while keeping the chance of running out of money (see get_depletion_probability) at or below target
+    # Both of the expense's starting amounts are scaled by the same amount, which is found by bisection to within tolerance (a fraction of it)
+    # Returns the expense's starting_amt_low and starting_amt_high at that scale, the scale, the depletion probability and how many tries it took
+    # This scenario isn't changed, see new_solver_scenario
+    def solve_spending(self, name, target=0.1, tolerance=0.01, max_iterations=50):
+        solver = self.new_solver_scenario()
+        arguments = solver.get_item_arguments(name, "add_expense")
+        tries = {}
+
+        def get_depletion(scale):
+            solver.update_item(name, starting_amt_low=arguments["starting_amt_low"] * scale, starting_amt_high=arguments["starting_amt_high"] * scale)
+            solver.generate_totals(write_output=False)
+            tries[scale] = solver.get_depletion_probability()
+            return tries[scale]
+
+        #####
+        # Bracket the answer between a scale that meets the target and one that doesn't, doubling until it fails
+        #####
+        if get_depletion(0) > target:
+            raise Exception(name, "can't meet the target even with nothing spent on it.  The chance of running out is already " + '{:.1%}'.format(tries[0]))
+        low = 0
+        high = 1
+        while get_depletion(high) <= target:
+            low = high
+            high *= 2
+            if len(tries) >= max_iterations:
+                raise Exception(name, "still meets the target at " + str(low) + " times its starting amounts")
+
+        while ((high - low) > tolerance * high) and (len(tries) < max_iterations):
+            middle = (low + high) / 2
+            if get_depletion(middle) <= target:
+                low = middle
+            else:
+                high = middle
+
+        return {
+            "starting_amt_low": arguments["starting_amt_low"] * low,
+            "starting_amt_high": arguments["starting_amt_high"] * low,
+            "scale": low,
+            "depletion": tries[low],
+            "iterations": len(tries)
+        }
+
+    # The earliest retirement_age that keeps the chance of running out of money (see get_depletion_probability) at or below target
+    # income, if given, is the name of the income that stops at retirement, and its end_age is moved along with retirement_age
+    # Found by bisection over the whole years from current_age to death_age.  Returns the age, its depletion probability and how many tries it took
+    # This scenario isn't changed, see new_solver_scenario
+    def solve_retirement_age(self, target=0.1, income=None):
+        solver = self.new_solver_scenario()
+        if income is not None:
+            solver.get_item_arguments(income, "add_income")
+        tries = {}
+
+        def meets_target(age):
+            solver.retirement_age = age
+            if income is not None:
+                solver.update_item(income, end_age=age)
+            solver.generate_totals(write_output=False)
+            tries[age] = solver.get_depletion_probability()
+            return tries[age] <= target
+
+        low = self.current_age
+        high = self.death_age - 1
+        if not meets_target(high):
+            raise Exception("retirement_age", "no retirement age before death_age meets the target.  The chance of running out is " + '{:.1%}'.format(tries[high]) + " even at " + str(high))
+        while low < high:
+            middle = (low + high) // 2
+            if meets_target(middle):
+                high = middle
+            else:
+                low = middle + 1
+
+        return {
+            "retirement_age": high,
+            "depletion": tries[high],
+            "iterations": len(tries)
+        }
+
+    # Generate a very simple "net worth" by adding income to investments and subtracting expenses
+    # Note: retirement balances won't show up until retirement age
+    def generate_networth(self, first_year=0):
+        if first_year == 0:
+            self.networth_ledger.totals = np.zeros((len(self.networth_ledger.ages), len(self.get_quantiles())))
+
+        if self.simulation_mode == "paths":
+            self.generate_networth_from_paths()
+            return
+
+        for i, age in enumerate(self.networth_ledger.ages):
+            if i < first_year:
+                continue
+
+            #in streaming and adaptive modes do the same thing as below a chunk of samples at a time
+            if self.draws_in_chunks():
+                self.networth_ledger.totals[i] = self.stream_quantiles(lambda start, stop: self.generate_networth_samples(i, age, start, stop), self.get_quantiles(), "networth")
+                continue
+
+            #get totals
+            income_low = self.income_ledger.totals[i, LOW]
+            income_high = self.income_ledger.totals[i, HIGH]
+            expenses_low = self.expenses_ledger.totals[i, LOW]
+            expenses_high = self.expenses_ledger.totals[i, HIGH]
+            nonret_investments_low = self.nonretirement_investments_ledger.totals[i, LOW]
+            nonret_investments_high = self.nonretirement_investments_ledger.totals[i, HIGH]
+            ret_investments_low = self.retirement_investments_ledger.totals[i, LOW]
+            ret_investments_high = self.retirement_investments_ledger.totals[i, HIGH]
+
+            #generate series
+            income_series = self.generate_series(income_low, income_high, ("networth", "income", i))
+            expenses_series = self.generate_series(expenses_low, expenses_high, ("networth", "expenses", i))
+            nonret_investments_series = self.generate_series(nonret_investments_low, nonret_investments_high, ("networth", "nonretirement", i))
+            ret_investments_series = self.generate_series(ret_investments_low, ret_investments_high, ("networth", "retirement", i))
+
+            networth_without_retirement = income_series.add(nonret_investments_series).subtract(expenses_series)
+            networth_with_retirement = networth_without_retirement.add(ret_investments_series)
+
+            if age < self.retirement_age:
+                self.networth_ledger.totals[i] = np.quantile(networth_without_retirement, self.get_quantiles())
+            else:
+                self.networth_ledger.totals[i] = np.quantile(networth_with_retirement, self.get_quantiles())
+            self.count("quantile computations")
+
+    # Networth samples start to stop for a year, used by streaming mode
+    def generate_networth_samples(self, i, age, start, stop):
+        income_samples = self.generate_samples(self.income_ledger.totals[i, LOW], self.income_ledger.totals[i, HIGH], ("networth", "income", i), start, stop)
+        expenses_samples = self.generate_samples(self.expenses_ledger.totals[i, LOW], self.expenses_ledger.totals[i, HIGH], ("networth", "expenses", i), start, stop)
+        nonret_investments_samples = self.generate_samples(self.nonretirement_investments_ledger.totals[i, LOW], self.nonretirement_investments_ledger.totals[i, HIGH], ("networth", "nonretirement", i), start, stop)
+        ret_investments_samples = self.generate_samples(self.retirement_investments_ledger.totals[i, LOW], self.retirement_investments_ledger.totals[i, HIGH], ("networth", "retirement", i), start, stop)
+
+        networth_without_retirement = income_samples + nonret_investments_samples - expenses_samples
+        if age < self.retirement_age:
+            return networth_without_retirement
+        return networth_without_retirement + ret_investments_samples
+
+    # The "paths" mode version of generate_networth
+    # Each simulation's networth is worked out from that simulation's samples, so nothing needs to be drawn again
+    def generate_networth_from_paths(self):
+        networth_without_retirement = self.sum_paths(self.income_paths) + self.sum_paths(self.nonretirement_investment_paths) - self.sum_paths(self.expenses_paths)
+        networth_with_retirement = networth_without_retirement + self.sum_paths(self.retirement_investment_paths)
+
+        before_retirement = self.networth_ledger.ages < self.retirement_age
+        networth = np.where(before_retirement, networth_without_retirement, networth_with_retirement)
+        self.networth_ledger.totals[:] = get_bounds_from_paths(networth, self.get_quantiles())
+        self.count("quantile computations", len(self.networth_ledger.ages))
+
+    def show_account_types_graph(self, start_age=0, 
+                                 end_age=0, 
+                                 yMax=None,
+                                 lines=[], 
+                                 showRetirementLine=True,
+                                 showIncome=True,
+                                 showExpenses=True,
+                                 showNonRetirement=True,
+                                 showRetirement=True
+                                ):
+
+        #get series massaged for graphing
+        expense_data = generate_amounts_for_graph(self.expenses_ledger)
+        income_data = generate_amounts_for_graph(self.income_ledger)
+        nonret_investment_data = generate_amounts_for_graph(self.nonretirement_investments_ledger)
+        ret_investment_data = generate_amounts_for_graph(self.retirement_investments_ledger)
+
+        #matplotlib is only imported when a graph is drawn, so scripts and sweeps that never draw one don't pay for it
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
+
+        #create graph
+        fig, ax = plt.subplots(figsize=(20,10))
+
+        #plot the ranges
+        legends = []
+
+        if showIncome:
+            ax.fill_between(income_data.age, income_data.low, income_data.high, color="green", alpha=0.2)
+            legends.append("Income")
+
+        if showNonRetirement:
+            ax.fill_between(nonret_investment_data.age, nonret_investment_data.low, nonret_investment_data.high, color="blue", alpha=0.2)
+            legends.append("Non-Retirement Investments")
+
+        if showRetirement:
+            ax.fill_between(ret_investment_data.age, ret_investment_data.low, ret_investment_data.high, color="purple", alpha=0.2)
+            legends.append("Retirement Investments")
+
+        if showExpenses:
+            ax.fill_between(expense_data.age, expense_data.low, expense_data.high, color="red", alpha=0.2)
+            legends.append("Expenses")
+
+        #set bounds
+        ax.set_ylim(bottom=0, top=yMax)
+        x_left = self.current_age if start_age == 0 else start_age
+        x_right = self.death_age if end_age == 0 else end_age
+        ax.set_xlim(left=x_left, right=x_right)
+
+        #format axes
+        fmt = '${x:,.0f}'
+        tick = ticker.StrMethodFormatter(fmt)
+        ax.yaxis.set_major_formatter(tick)
+        ax.xaxis.set_minor_locator(ticker.AutoMinorLocator())
+
+        #add grid lines
+        plt.grid()
+
+        #show retirement line
+        ymin, ymax = ax.get_ylim()
+        text_y = ymax - (ymax * .05)
+        if showRetirementLine:
+            ax.axvline(x=self.retirement_age)
+            ax.text(x=self.retirement_age, y=text_y, s="Retirement Investments Available", rotation=270, ha='left', va='top')
+
+        #show user lines
+        for line in lines:
+            ax.axvline(x=line[0])
+            ax.text(x=line[0], y=text_y, s=line[1], rotation=270, ha='left', va='top')
+
+        #set labels
+        plt.xlabel('Age')
+
+        #show legend
+        ax.legend(legends, loc="upper right")
+
+        #save it as a PNG
+        plt.savefig(os.path.join(self.output_dir, 'account-types-graph.png'))
+
+        #show it in jupyter
+        show_graph(plt)
+
+    def show_networth_graph(self, start_age=0, 
+                            end_age=0, 
+                            yMax=None,
+                            yMin=None,
+                            lines=[], 
+                            showRetirementLine=True,
+                            ):
+
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
+
+        #create graph
+        fig, ax = plt.subplots(figsize=(20,10))
+
+        nw_low = self.networth_by_year['networth low']
+        nw_high = self.networth_by_year['networth high']
+
+        #get bounds of graph if not set
+        if (yMax is None):
+            yMax = nw_high.max()
+
+        if (yMin is None):
+            yMin = nw_low.min()
+
+        #draw everything above zero as green, everything below as red.
+        #overlay the network as a solid white, then do it again as a see-through blue
+        ax.fill_between(self.networth_by_year.age, 0, yMax, color="green", alpha=0.1)
+        ax.fill_between(self.networth_by_year.age, 0, yMin, color="red", alpha=0.1)
+        ax.fill_between(self.networth_by_year.age, nw_low, nw_high, color="white", alpha=1)
+        legend_handle = ax.fill_between(self.networth_by_year.age, nw_low, nw_high, color="blue", alpha=0.1, label="Networth")
+
+        ax.plot(self.networth_by_year.age, nw_high, linewidth=2, color="black")
+        ax.plot(self.networth_by_year.age, nw_low, linewidth=2, color="black")
+
+        #set bounds
+        ax.set_ylim(bottom=yMin, top=yMax)
+        x_left = self.current_age if start_age == 0 else start_age
+        x_right = self.death_age if end_age == 0 else end_age
+        ax.set_xlim(left=x_left, right=x_right)
+
+        #format axes
+        fmt = '${x:,.0f}'
+        tick = ticker.StrMethodFormatter(fmt)
+        ax.yaxis.set_major_formatter(tick)
+        ax.xaxis.set_minor_locator(ticker.AutoMinorLocator())
+
+        #add grid lines
+        plt.grid()
+
+        #show retirement line
+        ymin, ymax = ax.get_ylim()
+        text_y = ymax - (ymax * .05)
+        if showRetirementLine:
+            ax.axvline(x=self.retirement_age)
+            ax.text(x=self.retirement_age, y=text_y, s="Retirement Investments Available", rotation=270, ha='left', va='top')
+
+        #show user lines
+        for line in lines:
+            ax.axvline(x=line[0])
+            ax.text(x=line[0], y=text_y, s=line[1], rotation=270, ha='left', va='top')
+
+        #set labels
+        plt.xlabel('Age')
+
+        #show legend
+        ax.legend(handles=[legend_handle])
+
+        #save it as a PNG
+        plt.savefig(os.path.join(self.output_dir, 'networth-graph.png'))
+
+        #show it in jupyter
+        show_graph(plt)
+
+    # A tornado graph of what sensitivity returned, with a bar for each input from its "down" value to its "up" value
+    # metric is "networth" or "depletion", and top limits it to that many of the inputs that matter most
+    def show_sensitivity_graph(self, results, metric="networth", top=None):
+        if metric not in ["networth", "depletion"]:
+            raise Exception("metric", "must be \"networth\" or \"depletion\"")
+        results = results.sort_values(metric + " swing", ascending=False).head(top)
+        base = results.attrs[metric]
+
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
+
+        #create graph
+        fig, ax = plt.subplots(figsize=(20,10))
+
+        #inputs that matter most at the top.  Moving an input down is red, moving it up is green
+        positions = np.arange(len(results))[::-1]
+        down_handle = ax.barh(positions, results[metric + " down"] - base, left=base, color="red", alpha=0.3, edgecolor="black", label="Input moved down")
+        up_handle = ax.barh(positions, results[metric + " up"] - base, left=base, color="green", alpha=0.3, edgecolor="black", label="Input moved up")
+        ax.axvline(x=base, linewidth=2, color="black")
+
+        #format axes
+        ax.set_yticks(positions)
+        ax.set_yticklabels(results["input"])
+        fmt = '${x:,.0f}' if metric == "networth" else '{x:.0%}'
+        tick = ticker.StrMethodFormatter(fmt)
+        ax.xaxis.set_major_formatter(tick)
+
+        #add grid lines
+        plt.grid()
+
+        #set labels
+        if metric == "networth":
+            plt.xlabel('Networth (low end of the 90% range) at age ' + str(results.attrs["age"]))
+        else:
+            plt.xlabel('Chance of running out of money')
+
+        #show legend
+        ax.legend(handles=[down_handle, up_handle])
+
+        #save it as a PNG
+        plt.savefig(os.path.join(self.output_dir, 'sensitivity-graph.png'))
+
+        #show it in jupyter
+        show_graph(plt)
+
+
+# Turns standard normal values into samples of the normal distribution whose 90% bounds are low and high, like generate_series
+def scale_standard_normals(z, low, high):
+    STD_DEV_90 = 3.29#converting from a 90% Confidence Interval to a Standard Deviation
+    return (low + high) / 2 + (high - low) / STD_DEV_90 * z
+
+# The lists every investment gets from running the simulations for a year
+INVESTMENT_LISTS = ["starting_balance_list", "ending_balance_list", "distribution_list"]
+
+# Returns a (quantiles x lists) array with each of the quantiles (0 to 1) of each of an investment's INVESTMENT_LISTS
+# The lists are put side by side so every quantile of every list comes from one np.quantile call
+# In streaming mode the lists aren't kept, so they come from each list's QuantileSketch instead
+def get_investment_quantiles(investment, quantiles):
+    if "sketches" in investment:
+        return np.column_stack([investment["sketches"][list_name].quantiles(quantiles) for list_name in INVESTMENT_LISTS])
+    return np.quantile(np.column_stack([np.asarray(investment[list_name], dtype=float) for list_name in INVESTMENT_LISTS]), quantiles, axis=0)
+
+# The name of an extra percentile's statistic and column, e.g. "p50"
+def percentile_name(percentile):
+    return "p" + '{:g}'.format(percentile)
 
 #####
-# When running the simulation to process expenses it will be necessary to take a distribution from investments
-# This will require recalculating the balances of that investment for that year and all subsequent years
-# To do this we need to store the values that were used to create the investments initially so we can reference them when its recalculated
+# The historical returns files that have been loaded, by path, as (modified time, series names, returns), see load_historical_returns
 #####
-nonretirement_account_settings = {}
-retirement_account_settings = {}
+HISTORICAL_RETURNS = {}
+
+# Loads a CSV file of annual returns, with a row for every year and a column for every series (e.g. "stocks", "bonds")
+# The returns are fractions, like growth_perc_low (0.07 is 7%).  A "year" column, if there is one, is left out.
+# The first time, the returns are saved next to the file as <file>.npy, and from then on that is memory mapped rather than the CSV being read again,
+# so every process of a sweep shares the same read-only copy.  The .npy file is made again whenever the CSV file is newer.
+# Returns the series names and a read-only (years x series) array
+def load_historical_returns(path):
+    modified = os.path.getmtime(path)
+    if (path in HISTORICAL_RETURNS) and (HISTORICAL_RETURNS[path][0] == modified):
+        return HISTORICAL_RETURNS[path][1:]
 
-networth_by_year = pd.DataFrame()
-message_log = []
-current_year = 0
-current_age = 0
-death_age = 0
+    names = [column for column in pd.read_csv(path, nrows=0).columns if column.lower() != "year"]
+    array_path = path + ".npy"
+    if (not os.path.exists(array_path)) or (os.path.getmtime(array_path) < modified):
+        returns = pd.read_csv(path)[names]
+        if len(returns) == 0:
+            raise Exception(path, "doesn't have any years of returns")
+        if returns.isna().any().any():
+            raise Exception(path, "is missing some returns.  Every series needs a return for every year.")
 
-#For Monte Carlo analysis, how many iterations will be run?
-num_samples = 10000
+        #####
+        # Written under a temporary name and then renamed, so another process never maps half of it
+        #####
+        temp_path = array_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "wb") as array_file:
+            np.save(array_file, returns.to_numpy(dtype=float))
+        os.replace(temp_path, array_path)
 
-#at what age are retirement investments available?
-retirement_age = 60
+    HISTORICAL_RETURNS[path] = (modified, names, np.load(array_path, mmap_mode="r"))
+    return HISTORICAL_RETURNS[path][1:]
 
-def log(message, year=None, age=None):
-    if (year is None) or (age is None):
-        message_log.append(message)
-    else:
-        message_log.append("In " + str(int(year)) + " at age " + str(int(age)) + ": " + message)
-        
-def write_log():
-    with open("../data/log.txt", "w") as output:
-        #output.write(str(message_log))
-        #output.write("".format("\n".join(message_log[1:])))
-        multi_line_output = '\n'.join([i for i in message_log[1:]])
-        output.write(multi_line_output)
+# Turns the key of a draw into the numbers a numpy SeedSequence needs, names are replaced by a checksum of the name
+def get_stream_key(key):
+    return tuple(zlib.crc32(part.encode()) if isinstance(part, str) else int(part) for part in key)
+
+#####
+# The matplotlib backends that only save graphs, e.g. "Agg" which financeCli uses.  They can't show a graph, so show_graph doesn't ask them to
+#####
+NON_INTERACTIVE_BACKENDS = ["agg", "cairo", "pdf", "pgf", "ps", "svg", "template"]
+
+# Shows the graph that was just drawn, unless there's nowhere to show it and it's only saved
+def show_graph(plt):
+    if plt.get_backend().lower() in NON_INTERACTIVE_BACKENDS:
+        return
+    plt.show()
 
-def write_csv_files():
-    expenses_by_year.to_csv('../data/expenses.csv')
-    income_by_year.to_csv('../data/income.csv')
-    nonretirement_investments_by_year.to_csv('../data/nonretirement-investments.csv')
-    retirement_investments_by_year.to_csv('../data/retirement-investments.csv')
-    networth_by_year.to_csv('../data/networth.csv')
-        
 def usd_fmt(num):
     return '${:0,.2f}'.format(num).replace('$-','-$')
 
-# helper function to allow you to check what an income is at some specified age
-def get_income_for_age(name, age):
-    df = income_by_year
-    return {
-        'low': int(df.loc[df['age']==age, name + " low"]),
-        'high': int(df.loc[df['age']==age, name + " high"])
-    }
 
-# helper function to allow you to check what an expense is at some specified age
-def get_expense_for_age(name, age):
-    df = expenses_by_year
-    return {
-        'low': int(df.loc[df['age']==age, name + " low"]),
-        'high': int(df.loc[df['age']==age, name + " high"])
-    }
-    
-# helper function to allow you to check what a nonretirement account balance is at some specified age
-# warning: this will give values before expenses have been processed.  This should not be relied on.
-def get_nonretirement_balance_for_age(name, age):
-    warnings.warn("It is not safe to trust investment account balances before expenses have been processed (usually by generate_totals())")
-    df = nonretirement_investments_by_year
-    return {
-        'low': int(df.loc[df['age']==age, name + " balance low"]),
-        'high': int(df.loc[df['age']==age, name + " balance high"])
-    }
+# Returns the names of items that were added to income, expense, nonretirement or retirement ledgers
+# A DataFrame made from a ledger (e.g. tool.expenses_by_year) works too, it keeps the ledger's names in its attrs, see Ledger.to_frame
+# The names aren't worked out from the column names, which can't tell an item called "rent distribution" from the distribution column of "rent"
+def get_item_names(ledger):
+    if isinstance(ledger, Ledger):
+        return list(ledger.names)
+    if isinstance(ledger, pd.DataFrame) and ("names" in ledger.attrs):
+        return list(ledger.attrs["names"])
+    raise Exception("ledger", "must be a ledger (e.g. tool.expenses_ledger) or one of the scenario's DataFrames (e.g. tool.expenses_by_year)")
 
-# helper function to allow you to check what a retirement account balance is at some specified age
-# warning: this will give values before expenses have been processed.  This should not be relied on.
-def get_retirement_balance_for_age(name, age):
-    warnings.warn("It is not safe to trust investment account balances before expenses have been processed (usually by generate_totals())")
-    df = retirement_investments_by_year
-    return {
-        'low': int(df.loc[df['age']==age, name + " balance low"]),
-        'high': int(df.loc[df['age']==age, name + " balance high"])
-    }
 
-# Start populating the four dataframes with age and year columns 
-# And a row from every year from current_year to death_age
-def setup(cy, ca, da):
-    global current_year
-    global current_age
-    global death_age
-    current_year = cy
-    current_age = ca
-    death_age = da
-    
-    expenses_by_year.insert(0, 'age', range(current_age, death_age))
-    expenses_by_year.insert(1, 'year', range(current_year, current_year + (death_age - current_age)))
-    income_by_year.insert(0, 'age', range(current_age, death_age))
-    income_by_year.insert(1, 'year', range(current_year, current_year + (death_age - current_age)))
-    nonretirement_investments_by_year.insert(0, 'age', range(current_age, death_age))
-    nonretirement_investments_by_year.insert(1, 'year', range(current_year, current_year + (death_age - current_age)))
-    retirement_investments_by_year.insert(0, 'age', range(current_age, death_age))
-    retirement_investments_by_year.insert(1, 'year', range(current_year, current_year + (death_age - current_age)))
-    networth_by_year.insert(0, 'age', range(current_age, death_age))
-    networth_by_year.insert(1, 'year', range(current_year, current_year + (death_age - current_age)))
-    
+# Given a (num_samples x years) matrix, returns a (years x 2) array of the low and high 90% bounds for every year
+def get_bounds_from_paths(amount, quantiles=[0.05, 0.95]):
+    return np.quantile(amount, quantiles, axis=0).T
 
 
-# Given two values that together represent the bounds of a 90% confidence interval
-# Create and return a normal distribution with num_samples items that fit those bounds
-def generate_series(low, high):
-    STD_DEV_90 = 3.29#converting from a 90% Confidence Interval to a Standard Deviation
-    mean = (low + high) /2
-    stddev = (high - low) / STD_DEV_90
-    series = pd.Series(np.random.normal(mean, stddev, num_samples))
-    return series    
+# Sets the low and high values in the ledger for an item to the 90% bounds of its samples for every year, and any extra percentiles
+# quantiles are the 5th and 95th percentile followed by the extra percentiles, see Scenario.get_quantiles
+def set_item_balances_from_paths(ledger, name, amount, quantiles):
+    bounds = get_bounds_from_paths(amount, quantiles)
+    ledger.values[ledger.index[name], :, LOW:HIGH + 1] = bounds[:, :2]
+    ledger.values[ledger.index[name], :, ledger.percentile_start:] = bounds[:, 2:]
 
 
-# Creates a series with num_samples items that represents 
-# ((amount + contribution) + ((amount + contribution) * growth_percent))
-def generate_series_for_year(amt_low, 
-                            amt_high, 
-                            growth_perc_low, 
-                            growth_perc_high,
-                            contrib_amt_low,
-                            contrib_amt_high
-                            ):
-    #generate series
-    amt_series = generate_series(amt_low, amt_high)
-    growth_percent_series = generate_series(growth_perc_low, growth_perc_high)
-    contrib_series = generate_series(contrib_amt_low, contrib_amt_high)
-    
-    #generate series with contrib amt added to balance amt
-    x = amt_series.add(contrib_series)
-    
-    #calculate growth
-    y = x.multiply(growth_percent_series)
-    
-    #add it all up
-    total_series = x.add(y)
-    
-    return total_series
-
-
-# Adds a new items to the specified DataFrame
-# Does input sanitization and adds the necessary columns to the DataFrame
-def add_item(df,
-             isInvestment=False,
-             name=None, 
-             starting_amt_low=None, 
-             starting_amt_high=None, 
-             start_age=None, 
-             end_age=None, 
-             growth_perc_low=0, 
-             growth_perc_high=0, 
-             annual_contrib_amt_low=0,
-             annual_contrib_amt_high=0,
-             annual_contrib_start_age=0,
-             annual_contrib_end_age=0
-            ):
-    #####
-    # input sanitization
-    #####
-    if name is None:
-        raise Exception("name is required for all items")
-        
-    if starting_amt_low is None:
-        raise Exception(name, "starting_amt_low is required for all items.  Note this can be the same value as starting_amt_high.")
-        
-    if starting_amt_high is None:
-        raise Exception(name, "starting_amt_high is required for all items.  Note this can be the same value as starting_amt_low.")
-        
-    if starting_amt_low > starting_amt_high:
-        raise Exception(name, "starting_amt_low cannot be greater than starting_amt_high")
-        
-    if start_age is None:
-        raise Exception(name, "start_age is required for all items.")
-    
-    if (end_age is None) or (end_age == start_age):
-        end_age = start_age + 1
-        
-    if end_age < start_age:
-        raise Exception(name, "end_age cannot be less than start_age")
-        
-    if growth_perc_low > growth_perc_high:
-        raise Exception(name, "growth_perc_low cannot be greater than growth_perc_high.  Note they can have the same value.")
-        
-    if annual_contrib_amt_low > annual_contrib_amt_high:
-        raise Exception(name, "annual_contrib_amt_low cannot be greater than annual_contrib_amt_high.  Note they can have the same value.")
-        
-    if annual_contrib_start_age > annual_contrib_end_age:
-        raise Exception(name, "annual_contrib_start_age cannot be greater than annual_contrib_end_age.")
-        
-    if isInvestment == False:
-        if annual_contrib_amt_low > 0: 
-            raise Exception(name, "annual_contrib_amt_low only applies to investments.")
-        if annual_contrib_amt_high > 0: 
-            raise Exception(name, "annual_contrib_amt_high only applies to investments.")
-        if annual_contrib_start_age > 0: 
-            raise Exception(name, "annual_contrib_start_age only applies to investments.")
-        if annual_contrib_end_age > 0: 
-            raise Exception(name, "annual_contrib_end_age only applies to investments.")
-    
-    
-    #####
-    # add a column for the low and high values to the df
-    #####
-    balance_low_name = name + " balance low" if isInvestment else name + " low"
-    balance_high_name = name + " balance high" if isInvestment else name + " high"
-    df.insert(len(df.columns), balance_low_name, 0.0)
-    df.insert(len(df.columns), balance_high_name, 0.0)
-    
-    #####
-    # if this is an investment, add columns for distribution low and high amounts
-    #####
-    if isInvestment:
-        distribution_low_name = name + " distribution low"
-        distribution_high_name = name + " distribution high"
-        df.insert(len(df.columns), distribution_low_name, 0.0)
-        df.insert(len(df.columns), distribution_high_name, 0.0)
-    
-    #####
-    # Now that we have the appropriate columns, set the balances for rows in that column
-    #####
-    set_item_balances(df, 
-                      start_age, 
-                      end_age,
-                      growth_perc_low, 
-                      growth_perc_high, 
-                      starting_amt_low,
-                      balance_low_name,
-                      starting_amt_high,
-                      balance_high_name,
-                      annual_contrib_amt_low, 
-                      annual_contrib_amt_high, 
-                      annual_contrib_start_age, 
-                      annual_contrib_end_age
-                     )
-
-
-# Sets the balance in rows for specified columns (amt_low_name & amt_high_name) between specified start and end age
-# Will blow away any previous values.  
-#    This is important because when expenses are processed investment distributions will call this function 
-#    to regen the balances after taking a distribution in a year
-def set_item_balances(df, 
-                      start_age, 
-                      end_age,
-                      growth_perc_low, 
-                      growth_perc_high, 
-                      starting_amt_low,
-                      amt_low_name,
-                      starting_amt_high,
-                      amt_high_name,
-                      annual_contrib_amt_low, 
-                      annual_contrib_amt_high, 
-                      annual_contrib_start_age, 
-                      annual_contrib_end_age
-                     ):
-    #####
-    # Get the rows for the affected years, between start age (inclusive) and end age (exclusive)
-    #####
-    years_affected = df.loc[(df['age'] >= start_age) & (df['age'] < end_age)]
-    
-    
-    #####
-    #  Set values for first iteration of loop
-    #####
-    amt_low = starting_amt_low
-    amt_high = starting_amt_high
+# The "paths" mode version of get_investment_list_for_expense_processing
+# Rather than drawing from the 90% bounds, the starting balances are the account's samples for that year
+def get_investment_list_from_paths(paths, row_index):
+    retList = []
 
-    
-    #####
-    # Loop over all the affected years
-    #####
-    for i, row in years_affected.iterrows():
-        
-        #####
-        # Determine if there is a contribution for this year, and in what amount
-        #####
-        age = row['age']
-        contrib_year = (age >= annual_contrib_start_age) and (age < annual_contrib_end_age)
-        contrib_low = annual_contrib_amt_low if contrib_year else 0
-        contrib_high = annual_contrib_amt_high if contrib_year else 0
-        
-        #####
-        # Generate a series with num_samples items, accounting for amount, growth and contribution
-        #####
-        year_expenses = generate_series_for_year(
-            amt_low, 
-            amt_high, 
-            growth_perc_low, 
-            growth_perc_high,
-            contrib_low,
-            contrib_high,
-        )
+    for account_name, account in paths.items():
+        account_balance = account["amount"][:, row_index]
+
+        #no point in adding the account if its empty
+        if np.any(account_balance > 0):
+            retList.append({
+                'name': account_name,
+                'path': account,
+                'starting_balance_list': account_balance.copy(),
+                'ending_balance_list': [],
+                'distribution_list': []
+            })
+
+    return retList
+
+
+# Runs every simulation for a year one at a time.
+# This is the original engine, it is kept as a reference to check run_simulations_vectorized against
+# Returns the number of simulations that found insufficient income
+def run_simulations_legacy(total_income_series, total_expenses_series, investment_list):
+    insufficent_income_counter = 0
+    remaining_shortages = []
+
+    total_income_list = total_income_series.tolist()
+    total_expenses_list = total_expenses_series.tolist()
+
+    for investment in investment_list:
+        investment["starting_balance_list"] = investment["starting_balance_list"].tolist()
+
+    for simulation_num in range(len(total_income_list)):
+
+        simulation_income = total_income_list[simulation_num]
+        simulation_expense = total_expenses_list[simulation_num]
 
         #####
-        #get 90% bounds and set amt_low and amt_high for next iteration of this loop
+        # Determine shortage.  note: shortage will be a negative number.  Any positive number is not a shortage and will be set to 0
         #####
-        amt_low = year_expenses.quantile(0.05)
-        amt_high = year_expenses.quantile(0.95)
-        
+        simulation_income_shortage = simulation_income - simulation_expense
+
+        if (simulation_income_shortage >= 0):
+            simulation_income_shortage = 0
+        else:
+            insufficent_income_counter += 1
+
+
         #####
-        # Set the low and high balance for this row in the DataFrame
-        # note, i is accurate since years_affected is just a view of df
+        # Step through investment accounts to cover the shortage.
+        # Distributions are taken from investment accounts in the order they were added.
+        # Even if the shortage is zero we need to step through all the accounts to set ending balance and distribution
         #####
-        df.loc[i, amt_low_name] = amt_low
-        df.loc[i, amt_high_name] = amt_high
+        remaining_shortage = simulation_income_shortage
 
+        for investment in investment_list:
+            results = determine_simulation_investment_balance(investment,
+                                                              simulation_num,
+                                                              remaining_shortage
+                                                             )
+
+            investment["ending_balance_list"].append(results["new_balance"])
+            investment["distribution_list"].append(results["distribution"])
+            remaining_shortage = results["remaining_shortage"]
+        remaining_shortages.append(remaining_shortage)
+
+    return insufficent_income_counter, np.array(remaining_shortages)
+
+
+# Runs every simulation for a year at once.
+# Follows exactly the same rules as run_simulations_legacy, but works on whole arrays of num_samples items at a time
+# distribute takes the distributions out of the accounts, see Scenario.get_distribution_strategy.  It defaults to drain_investments, the "fixed order" strategy
+# Returns the number of simulations that found insufficient income, and the shortage of each simulation that the accounts couldn't cover
+def run_simulations_vectorized(total_income_series, total_expenses_series, investment_list, distribute=None):
 
-# Add an expense to the expenses_by_year DataFrame
-def add_expense(**kwargs):
-    add_item(expenses_by_year, isInvestment=False, **kwargs)
-    
-# Add an income to the income_by_year DataFrame
-def add_income(**kwargs):
-    add_item(income_by_year, isInvestment=False, **kwargs)
-    
-# Add a non-retirement investment to the nonretirement_investments_by_year DataFrame
-def add_nonretirement_investment(end_age=None,
-                                 growth_perc_low=0, 
-                                 growth_perc_high=0, 
-                                 annual_contrib_amt_low=0,
-                                 annual_contrib_amt_high=0,
-                                 annual_contrib_start_age=0,
-                                 annual_contrib_end_age=0,
-                                 **kwargs
-                                ):
-    #since I'm using kwargs to persist account settings I need to make sure it has all the optional values
-    start_age = kwargs['start_age']
-    if (end_age is None) or (end_age==start_age):
-        end_age = start_age + 1
-    kwargs['end_age'] = end_age
-    kwargs['growth_perc_low'] = growth_perc_low
-    kwargs['growth_perc_high'] = growth_perc_high
-    kwargs['annual_contrib_amt_low'] = annual_contrib_amt_low
-    kwargs['annual_contrib_amt_high'] = annual_contrib_amt_high
-    kwargs['annual_contrib_start_age'] = annual_contrib_start_age
-    kwargs['annual_contrib_end_age'] = annual_contrib_end_age
-        
-        
-    add_item(nonretirement_investments_by_year, isInvestment=True, **kwargs)
-    
-    #persist the settings for recalculating account balances after distributions
-    nonretirement_account_settings[kwargs['name']] = kwargs
-    
-# Add a retirement investment to the retirement_investments_by_year DataFrame
-def add_retirement_investment(end_age=None,
-                              growth_perc_low=0, 
-                              growth_perc_high=0, 
-                              annual_contrib_amt_low=0,
-                              annual_contrib_amt_high=0,
-                              annual_contrib_start_age=0,
-                              annual_contrib_end_age=0,
-                              **kwargs
-                             ):
-    #since I'm using kwargs to persist account settings I need to make sure it has all the optional values
-    start_age = kwargs['start_age']
-    if (end_age is None) or (end_age==start_age):
-        end_age = start_age + 1
-    kwargs['end_age'] = end_age
-    kwargs['growth_perc_low'] = growth_perc_low
-    kwargs['growth_perc_high'] = growth_perc_high
-    kwargs['annual_contrib_amt_low'] = annual_contrib_amt_low
-    kwargs['annual_contrib_amt_high'] = annual_contrib_amt_high
-    kwargs['annual_contrib_start_age'] = annual_contrib_start_age
-    kwargs['annual_contrib_end_age'] = annual_contrib_end_age
-    
-    add_item(retirement_investments_by_year, isInvestment = True, **kwargs)
-    
-    #persist the settings for recalculating account balances after distributions
-    retirement_account_settings[kwargs['name']] = kwargs
-    
-    
-# Returns the names of items that were added to income, expense, nonretirement or retirement dataframes
-def get_item_names(df):
-    item_names = []
-    for name in df.columns.values:
-        if ("low" in name) and ("distribution" not in name):
-            item_names.append(name[0:len(name)-4]) #slice off " low"
-    return item_names
-
-           
-# This is the most important function.  It runs a simulation for every year with num_samples iterations.
-# each simulation takes one possible income value, one possible expense value, and one possible value for each of the investment accounts
-# it then determines if a distribution is needed from the investment accounts to make up for insufficient income, and keeps track of what those adjustments are
-# After the simulations run for the year, it analyzes the output, and if necessary, updates investment account balances based on distributions that were needed
-def process_expenses():
     #####
-    # Loop over every year
+    # Determine shortage.  note: shortage will be a negative number.  Any positive number is not a shortage and will be set to 0
     #####
-    for i, row in expenses_by_year.iterrows():
-        
-        age = row["age"]
-        year = row["year"]
-        
-        #####
-        # Keep track of simulation outcomes
-        #####
-        sufficient_income_counter = 0;
-        insufficent_income_counter = 0;
-
-        #####
-        # Create series with num_samples items for expenses and income for that year
-        #####
-        total_expenses_low = row["total low"]
-        total_expenses_high = row["total high"]
-        total_expenses_series = generate_series(total_expenses_low, total_expenses_high)
-        total_expenses_list = total_expenses_series.tolist()
-        
-        total_income_low = income_by_year.loc[i, "total low"]
-        total_income_high = income_by_year.loc[i, "total high"]
-        total_income_series = generate_series(total_income_low, total_income_high)
-        total_income_list = total_income_series.tolist()
-        
-        
-        #####
-        # Get list of investment accounts available this year
-        # if retirement_age isn't met yet, it will be an empty list
-        #####
-        nonretirement_investment_list = get_investment_list_for_expense_processing(nonretirement_investments_by_year, i)
-        retirement_investment_list = get_investment_list_for_expense_processing(retirement_investments_by_year, i) if age >= retirement_age else []
-        
-        
-        #####
-        # Run simulations
-        #####
-        for simulation_num in range(num_samples):
-            
-            simulation_income = total_income_list[simulation_num]
-            simulation_expense = total_expenses_list[simulation_num]
-            
-            #####
-            # Determine shortage.  note: shortage will be a negative number.  Any positive number is not a shortage and will be set to 0
-            #####
-            simulation_income_shortage = simulation_income - simulation_expense
-            
-            if (simulation_income_shortage >= 0):
-                sufficient_income_counter += 1
-                simulation_income_shortage = 0
-            else:
-                insufficent_income_counter += 1
-                
-            
-            #####
-            # Step through investment accounts to cover the shortage.
-            # Distributions are taken from investment accounts in the order they were added.
-            # Non-retirement investment accounts will be drained before retirement investment accounts
-            # Even if the shortage is zero we need to step through all the accounts to set ending balance and distribution
-            #####
-            
-            remaining_shortage = simulation_income_shortage
-            
-            for investment in nonretirement_investment_list:
-                results = determine_simulation_investment_balance(investment,
-                                                                  simulation_num,
-                                                                  remaining_shortage
-                                                                 )
-                    
-                investment["ending_balance_list"].append(results["new_balance"])
-                investment["distribution_list"].append(results["distribution"])
-                remaining_shortage = results["remaining_shortage"]
-                
-                
-            for investment in retirement_investment_list:
-                results = determine_simulation_investment_balance(investment,
-                                                                  simulation_num,
-                                                                  remaining_shortage
-                                                                 )
-                    
-                investment["ending_balance_list"].append(results["new_balance"])
-                investment["distribution_list"].append(results["distribution"])
-                remaining_shortage = results["remaining_shortage"]
-                
-                
-        #####
-        # Simulations complete for the year
-        #####
-        if (insufficent_income_counter > 0):
-            log(str(insufficent_income_counter) + " of " + str(num_samples) + " simulations found insufficient income for the year", year, age)
-        else:
-            log("All simulations (" + str(num_samples) + ") found sufficient income for the year", year, age)
-        
-        #####
-        # Update account balances if a distribution was taken
-        #####
-        update_account_balance_if_distribution_was_taken(nonretirement_investment_list,
-                                                        nonretirement_investments_by_year,
-                                                        nonretirement_account_settings,
-                                                        age,
-                                                        year,
-                                                        i)
-        
-        update_account_balance_if_distribution_was_taken(retirement_investment_list,
-                                                        retirement_investments_by_year,
-                                                        retirement_account_settings,
-                                                        age,
-                                                        year,
-                                                        i)
-        
-       
+    income_shortage = np.asarray(total_income_series) - np.asarray(total_expenses_series)
+    insufficent_income_counter = int(np.count_nonzero(income_shortage < 0))
+    income_shortage = np.where(income_shortage >= 0, 0.0, income_shortage)
+
+    if len(investment_list) == 0:
+        return insufficent_income_counter, income_shortage
+    if distribute is None:
+        distribute = drain_investments
+
+    #####
+    # Build a (num_samples x accounts) matrix of starting balances, non-retirement accounts then retirement accounts, each in the order they were added
+    #####
+    starting_balances = np.column_stack([investment["starting_balance_list"] for investment in investment_list])
+
+    ending_balances, distributions, remaining_shortage = distribute(starting_balances, income_shortage)
+
+    for account_num, investment in enumerate(investment_list):
+        investment["ending_balance_list"] = ending_balances[:, account_num]
+        investment["distribution_list"] = distributions[:, account_num]
+
+    return insufficent_income_counter, remaining_shortage
+
+
+# Which simulations had a shortage left after the distributions (short), and which of those had emptied every account they could use (depleted)
+def find_shortfalls(remaining_shortage, investment_list):
+    short = np.asarray(remaining_shortage) < 0
+    if len(investment_list) == 0:
+        return short, short
+    ending_balance = sum(np.asarray(investment["ending_balance_list"]) for investment in investment_list)
+    return short, short & (ending_balance <= 0)
+
+
+# Given a (num_samples x accounts) matrix of starting balances and an array of num_samples shortages (negative numbers)
+# take distributions out of each account, in column order, until the shortage is covered
+# This is determine_simulation_investment_balance applied to every simulation at once
+# Returns the ending balances, the distributions (both num_samples x accounts), and the shortage that could not be covered
+def drain_investments(starting_balances, shortage):
+    ending_balances = np.empty_like(starting_balances)
+    distributions = np.empty_like(starting_balances)
+    remaining_shortage = shortage
+
+    for account_num in range(starting_balances.shape[1]):
+        simulation_balance = starting_balances[:, account_num]
+        new_balance = simulation_balance + remaining_shortage #remaining shortage is negative, hence addition
+
+        #####
+        # If balance dropped below 0, that account is drained.
+        # Set the balance to 0 and the distribution to what the balance had been
+        # If balance stayed above 0, then there is no remaining shortage
+        #####
+        drained = new_balance < 0
+        distributions[:, account_num] = np.where(drained, simulation_balance * -1, remaining_shortage)
+        ending_balances[:, account_num] = np.where(drained, 0, new_balance)
+        remaining_shortage = np.where(drained, new_balance, 0)
+
+    return ending_balances, distributions, remaining_shortage
+
+
+#####
+# The distribution strategies, see Scenario.distribution_strategy
+# Each one works on every simulation at once, and takes
+#     starting_balances:  a (num_samples x accounts) matrix, the non-retirement accounts in the order they were added, then the retirement accounts
+#     shortage:           an array of num_samples shortages (negative numbers, 0 where income covered expenses)
+#     is_retirement:      an array saying which of the accounts are retirement accounts
+#     scenario:           the Scenario, for any settings the strategy uses
+# and returns the ending balances and distributions (both num_samples x accounts, distributions are negative) and the shortage left uncovered
+#####
+
+# Drains each account before starting on the next, in the order they're given.  This was the only rule before there were strategies
+def distribute_in_order(starting_balances, shortage, is_retirement, scenario):
+    return drain_investments(starting_balances, shortage)
+
+# Drains the retirement accounts first, then the non-retirement accounts
+def distribute_retirement_first(starting_balances, shortage, is_retirement, scenario):
+    order = np.argsort(~is_retirement, kind="stable")
+    ending_balances, distributions, remaining_shortage = drain_investments(starting_balances[:, order], shortage)
+    original_order = np.argsort(order)
+    return ending_balances[:, original_order], distributions[:, original_order], remaining_shortage
+
+# Takes from every account at once, each in proportion to its balance, so they all run down together
+def distribute_proportionally(starting_balances, shortage, is_retirement, scenario):
+    available = np.maximum(starting_balances, 0)
+    total = available.sum(axis=1)
+    taken = np.minimum(-shortage, total)
+    shares = np.divide(available, total[:, np.newaxis], out=np.zeros_like(available), where=total[:, np.newaxis] > 0)
+    distributions = -taken[:, np.newaxis] * shares
+    return starting_balances + distributions, distributions, shortage + taken
+
+# Drains the accounts in order like distribute_in_order, but never takes more than withdrawal_rate of all of them put together in one year
+# The rest of the shortage is left uncovered, like cutting spending in a bad year, rather than emptying the accounts
+def distribute_with_guardrail(starting_balances, shortage, is_retirement, scenario):
+    if (scenario.withdrawal_rate < 0) or (scenario.withdrawal_rate > 1):
+        raise Exception("withdrawal_rate", "must be between 0 and 1")
+    limit = scenario.withdrawal_rate * np.maximum(starting_balances, 0).sum(axis=1)
+    allowed = np.maximum(shortage, -limit)
+    ending_balances, distributions, remaining_shortage = drain_investments(starting_balances, allowed)
+    return ending_balances, distributions, remaining_shortage + (shortage - allowed)
+
+DISTRIBUTION_STRATEGIES = {
+    "fixed order": distribute_in_order,
+    "retirement first": distribute_retirement_first,
+    "proportional": distribute_proportionally,
+    "guardrail": distribute_with_guardrail
+}
+
+
 def determine_simulation_investment_balance(investment,
                                             simulation_num,
                                             remaining_shortage
@@ -535,346 +3124,373 @@ def determine_simulation_investment_balance(investment,
         "remaining_shortage": remaining_shortage
     }
 
+
+# Samples are only kept for items added while simulation_mode is "paths"
+# Make sure simulation_mode wasn't changed part way through adding items
+def check_paths(item_names, paths):
+    if len(paths) != len(item_names):
+        raise Exception("simulation_mode was changed after items were added.  Set simulation_mode before adding any items.")
+
+
+# Given a ledger shape its totals into something that can be easily graphed
+def generate_amounts_for_graph(ledger):
     
-def update_account_balance_if_distribution_was_taken(investment_list,
-                                                     investment_df,
-                                                     account_settings,
-                                                     age,
-                                                     year,
-                                                     row_index
-                                                    ):
-    
-     for investment in investment_list:
-            starting_balance_series = pd.Series(investment["starting_balance_list"])
-            starting_balance_low = starting_balance_series.quantile(0.05)
-            starting_balance_high = starting_balance_series.quantile(0.95)
-            
-            #####
-            # Distribution is a negative number
-            # distribution_low is the greater negative number
-            # if a series generates a positive distribution, those numbers must be removed
-            #####
-            distribution_series = pd.Series(investment["distribution_list"])
-            distribution_low = distribution_series.quantile(0.05)
-            distribution_high = distribution_series.quantile(0.95) if distribution_series.quantile(0.95) <=0 else 0;
-            
-            new_balance_series = pd.Series(investment["ending_balance_list"])
-            new_balanace_low = new_balance_series.quantile(0.05) if new_balance_series.quantile(0.05) > 0 else 0
-            new_balanace_high = new_balance_series.quantile(0.95) if new_balance_series.quantile(0.95) > 0 else 0
-            
-            #update DataFrame with distribution amounts
-            investment_df.loc[row_index, investment["name"] + " distribution low"] = distribution_low
-            investment_df.loc[row_index, investment["name"] + " distribution high"] = distribution_high
-            
-            if (distribution_low < 0): #this means a distribution was taken (distribution is a negative number)
-                
-                log("A distribution of " + usd_fmt(distribution_low) + " to " + usd_fmt(distribution_high) + " was taken from " + investment["name"] + ".  The balance will be changing from " + usd_fmt(starting_balance_low) + " - " + usd_fmt(starting_balance_high) + " to " + usd_fmt(new_balanace_low) + " - " + usd_fmt(new_balanace_high), year, age)
-                
-                #regen the series, blowing away current values
-                set_item_balances(investment_df, 
-                    age, 
-                    account_settings[investment["name"]]['end_age'],
-                    account_settings[investment["name"]]['growth_perc_low'], 
-                    account_settings[investment["name"]]['growth_perc_high'], 
-                    new_balanace_low,
-                    investment["name"] + " balance low",
-                    new_balanace_high,
-                    investment["name"] + " balance high",
-                    account_settings[investment["name"]]['annual_contrib_amt_low'], 
-                    account_settings[investment["name"]]['annual_contrib_amt_high'], 
-                    account_settings[investment["name"]]['annual_contrib_start_age'], 
-                    account_settings[investment["name"]]['annual_contrib_end_age']
-                )
+    # adding mean, plus a column for any extra percentiles (see Scenario.percentiles)
+    total_low = ledger.totals[:, LOW]
+    total_high = ledger.totals[:, HIGH]
+
+    amounts = pd.DataFrame({
+        "age":  ledger.ages, 
+        "low":  total_low, 
+        "high": total_high, 
+        "mean": (total_high + total_low) / 2
+    })
+    for percentile_num, percentile in enumerate(ledger.percentiles):
+        amounts[percentile_name(percentile)] = ledger.totals[:, 2 + percentile_num]
+    return amounts
+
+
+#####
+# The notebook uses these module level functions, which all work on default_scenario
+# Create more Scenario objects to run other plans alongside it
+#####
+default_scenario = Scenario()
+
+def setup(cy, ca, da):
+    default_scenario.setup(cy, ca, da)
+
+def add_expense(**kwargs):
+    default_scenario.add_expense(**kwargs)
+
+def add_income(**kwargs):
+    default_scenario.add_income(**kwargs)
+
+def add_nonretirement_investment(**kwargs):
+    default_scenario.add_nonretirement_investment(**kwargs)
+
+def add_retirement_investment(**kwargs):
+    default_scenario.add_retirement_investment(**kwargs)
+
+def update_item(name, **changes):
+    default_scenario.update_item(name, **changes)
+
+def get_income_for_age(name, age):
+    return default_scenario.get_income_for_age(name, age)
+
+def get_expense_for_age(name, age):
+    return default_scenario.get_expense_for_age(name, age)
+
+def get_nonretirement_balance_for_age(name, age):
+    return default_scenario.get_nonretirement_balance_for_age(name, age)
+
+def get_retirement_balance_for_age(name, age):
+    return default_scenario.get_retirement_balance_for_age(name, age)
+
+def lookup(category, names=None, ages=None, statistics=None, as_array=False):
+    return default_scenario.lookup(category, names, ages, statistics, as_array)
+
+def get_long_frame(category):
+    return default_scenario.get_long_frame(category)
+
+def solve_spending(name, target=0.1, tolerance=0.01, max_iterations=50):
+    return default_scenario.solve_spending(name, target, tolerance, max_iterations)
+
+def solve_retirement_age(target=0.1, income=None):
+    return default_scenario.solve_retirement_age(target, income)
+
+def generate_totals(write_output=True):
+    default_scenario.generate_totals(write_output)
+
+def write_log():
+    default_scenario.write_log()
+
+def write_csv_files():
+    default_scenario.write_csv_files()
+
+def export_results(directory=None):
+    default_scenario.export_results(directory)
+
+def show_account_types_graph(*args, **kwargs):
+    default_scenario.show_account_types_graph(*args, **kwargs)
+
+def show_networth_graph(*args, **kwargs):
+    default_scenario.show_networth_graph(*args, **kwargs)
+
+def show_sensitivity_graph(*args, **kwargs):
+    default_scenario.show_sensitivity_graph(*args, **kwargs)
+
+
+# How a setting that json can't write, like a return_correlation DataFrame or a distribution_strategy function, goes into the cache key
+# Arrays and frames are hashed by their values (their repr leaves most of them out once they're big),
+# and functions by their module and name.  A lambda or a function defined inside another one has no name to tell it apart, so it can't be cached
+def get_cache_key_value(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        values = np.ascontiguousarray(np.asarray(value))
+        key = {"shape": list(values.shape), "dtype": str(values.dtype), "sha256": hashlib.sha256(values.tobytes()).hexdigest()}
+        if isinstance(value, pd.DataFrame):
+            key["index"] = [repr(label) for label in value.index]
+            key["columns"] = [repr(label) for label in value.columns]
+        elif isinstance(value, pd.Series):
+            key["index"] = [repr(label) for label in value.index]
+        return key
+    if isinstance(value, np.generic):
+        return value.item()
+    if callable(value):
+        qualified_name = getattr(value, "__qualname__", "<unknown>")
+        if "<" in qualified_name:
+            raise Exception(qualified_name, "can't be told apart from other functions like it, so its results can't be cached.  Use a function defined at the top level of a module, or set cache_dir to None")
+        return {"function": getattr(value, "__module__", None) + "." + qualified_name}
+    return repr(value)
+
+# Deletes the cached results that were used longest ago (see Scenario.load_cached_results) until the cache holds no more than max_bytes
+def evict_cache(cache_dir, max_bytes):
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith(".pkl"):
+            try:
+                stat = os.stat(os.path.join(cache_dir, file_name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+    total = sum(size for mtime, size, file_name in entries)
+    for mtime, size, file_name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, file_name))
+        except OSError:
+            pass
+        total -= size
+
+# Loads results written by export_results, without needing the scenario that made them
+# Returns a dict with a DataFrame for each of RESULT_FILES (e.g. "networth"), like the ones written to the CSV files,
+# and "samples", a dict of {category: {item name: (num_samples x years) matrix}} if they were exported.
+# The samples are memory mapped, so they are read from disk as they're used rather than all copied into memory
+def load_results(directory):
+    with open(os.path.join(directory, "manifest.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    results = {}
+    if manifest["format"] == "parquet":
+        for file_name, attribute in RESULT_FILES:
+            results[file_name] = pd.read_parquet(os.path.join(directory, file_name + ".parquet"))
+    else:
+        with np.load(os.path.join(directory, "results.npz")) as arrays:
+            for file_name, attribute in RESULT_FILES:
+                frame = pd.DataFrame(arrays[file_name + " values"], columns=list(arrays[file_name + " columns"]))
+                frame[["age", "year"]] = frame[["age", "year"]].astype(int)
+                results[file_name] = frame
+
+    results["samples"] = {category: {name: np.load(os.path.join(directory, file_name), mmap_mode="r") for name, file_name in items.items()}
+                          for category, items in manifest["samples"].items()}
+    return results
+
+
+#####
+# Sweeps run a scenario over and over with some of its values changed, e.g. retiring at 58, 60 or 62 with different growth rates
+# Every combination is run in its own process, using all of the cores, and the results are put in one DataFrame
+#####
+
+# Builds a scenario from a spec (see Scenario.spec), adding every item again in the same order
+def scenario_from_spec(spec):
+    scenario = Scenario()
+    for name, value in spec["settings"].items():
+        setattr(scenario, name, value)
+    scenario.setup(spec["current_year"], spec["current_age"], spec["death_age"])
+    for function_name, kwargs in spec["items"]:
+        getattr(scenario, function_name)(**kwargs)
+    return scenario
+
+# Runs in the worker processes.  Builds and runs one combination and returns its summary
+# The log is never written, so nothing is kept in it
+def run_sweep_combination(spec):
+    scenario = scenario_from_spec(spec)
+    scenario.log_level = "none"
+    scenario.generate_totals(write_output=False)
+    return scenario.summary()
+
+# Turns the overrides given to a sweep into a list of combinations, each a dict of {key: value}
+# A dict of lists is a grid, and every combination of its values is run.  A list of dicts is run as is.
+# Combinations that are the same as one before them are dropped
+def get_sweep_combinations(overrides):
+    if isinstance(overrides, dict):
+        keys = list(overrides.keys())
+        combinations = [dict(zip(keys, values)) for values in itertools.product(*[overrides[key] for key in keys])]
+    else:
+        combinations = [dict(combination) for combination in overrides]
+
+    unique_combinations = []
+    seen = set()
+    for combination in combinations:
+        key = repr(sorted(combination.items()))
+        if key not in seen:
+            seen.add(key)
+            unique_combinations.append(combination)
+    return unique_combinations
+
+# Runs every combination and yields (combination, summary) as each one finishes, so results can be looked at before the whole sweep is done
+# The combinations are not yielded in the order they were given
+def iterate_sweep(overrides, scenario=None, max_workers=None):
+    if scenario is None:
+        scenario = default_scenario
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    combinations = get_sweep_combinations(overrides)
+    specs = [scenario.spec(combination) for combination in combinations]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_sweep_combination, spec): combination for spec, combination in zip(specs, combinations)}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+# Runs every combination and returns one DataFrame with a row per combination and year
+# The first columns are the values of the combination, followed by age, year and the low and high totals (see Scenario.summary)
+# on_result, if given, is called with (combination, summary) as each combination finishes
+def sweep(overrides, scenario=None, max_workers=None, on_result=None):
+    frames = []
+    keys = []
+    for combination, summary in iterate_sweep(overrides, scenario, max_workers):
+        if on_result is not None:
+            on_result(combination, summary)
+        for key, value in combination.items():
+            if key not in keys:
+                keys.append(key)
+            summary[key] = [value] * len(summary)
+        frames.append(summary)
+
+    if len(frames) == 0:
+        return pd.DataFrame()
+    results = pd.concat(frames, ignore_index=True)
+    columns = keys + [column for column in results.columns if column not in keys]
+    return results[columns].sort_values(keys + ["age"], ignore_index=True)
+
+# Runs the scenario with each of the distribution strategies (by default all of DISTRIBUTION_STRATEGIES), in parallel like sweep, and ranks them
+# They're always run in "paths" mode (see PATHS_SETTINGS), whatever the scenario's simulation_mode, so every simulation is followed from year to year
+# Every strategy gets exactly the same random draws, so the differences are down to the strategy alone.  Without a seed, seed 0 is used for all of them
+# Returns a DataFrame with a row per strategy, best first:
+#     shortfall:  the average fraction of simulations each year with spending the accounts didn't cover, whether they ran out or (like "guardrail") held back
+#     depletion:  the chance of running out of every account that can be used by the last year
+#     ending networth low and high: the 90% range of networth in the last year
+# They're ranked by shortfall, then depletion, then the low ending networth.  Depletion on its own doesn't say how well a strategy works,
+# "guardrail" hardly ever empties the accounts because it leaves spending uncovered instead
+def compare_strategies(strategies=None, scenario=None, max_workers=None):
+    if scenario is None:
+        scenario = default_scenario
+    if strategies is None:
+        strategies = list(DISTRIBUTION_STRATEGIES.keys())
+
+    overrides = {"distribution_strategy": list(strategies)}
+    overrides.update({name: [value] for name, value in PATHS_SETTINGS.items()})
+    if scenario.seed is None:
+        overrides["seed"] = [0]
+
+    rows = []
+    for combination, summary in iterate_sweep(overrides, scenario, max_workers):
+        rows.append({
+            "strategy": combination["distribution_strategy"],
+            "shortfall": summary["shortfall"].mean(),
+            "depletion": summary["depletion"].max(),
+            "ending networth low": summary["networth low"].iloc[-1],
+            "ending networth high": summary["networth high"].iloc[-1]
+        })
+
+    results = pd.DataFrame(rows).sort_values(["shortfall", "depletion", "ending networth low"], ascending=[True, True, False], ignore_index=True)
+    results.insert(0, "rank", range(1, len(results) + 1))
+    return results
+
+# The inputs sensitivity changes, as (input, overrides to move it down, overrides to move it up), see Scenario.spec for the overrides
+#     retirement_age moves by age_delta years
+#     every item's starting amount, and every investment's contribution, is scaled by 1 - delta and 1 + delta (both the low and high together)
+#     every item's growth range is shifted by growth_delta (e.g. 0.01 is one percentage point), unless it uses a historical series
+def get_sensitivity_inputs(scenario, delta, growth_delta, age_delta):
+    inputs = [("retirement_age", {"retirement_age": scenario.retirement_age - age_delta}, {"retirement_age": scenario.retirement_age + age_delta})]
+    for item in scenario.items:
+        for label, arguments in [("starting amount", ["starting_amt_low", "starting_amt_high"]),
+                                 ("growth", ["growth_perc_low", "growth_perc_high"]),
+                                 ("contribution", ["annual_contrib_amt_low", "annual_contrib_amt_high"])]:
+            values = [item.arguments.get(argument, 0) for argument in arguments]
+            if any(isinstance(value, str) for value in values):
+                continue
+            if label == "growth":
+                down = [value - growth_delta for value in values]
+                up = [value + growth_delta for value in values]
+            elif all(value == 0 for value in values):
+                continue
             else:
-                log("There is no need to update the account balance for " + investment["name"] + ", there was either zero or insignificant distribution found to be needed in the simulations.", year, age)
-        
-#####
-# Create a list of investment accounts, where each item is a dict containing
-#     name
-#     list with num_samples items representing beginning balance
-#     list representing ending balance after processing expenses (will be populated in processing)
-#     list representing distribution that was taken out to cover expenses (will be populated in processing)
-#####        
-def get_investment_list_for_expense_processing(investment_df,
-                                               row_index
-                                              ):
-    retList = []
-    
-    #####
-    # Get names of the accounts
-    #####
-    investment_item_names = get_item_names(investment_df)
-    
-    for account_name_unclean in investment_item_names:
-        account_name = account_name_unclean[0:len(account_name_unclean)-8] #clip off " balance"
-        
-        #get account balance values
-        account_balance_low = investment_df.loc[row_index, account_name + " balance low"]
-        account_balance_high = investment_df.loc[row_index, account_name + " balance high"]
-        
-        #no point in adding the account if its empty
-        if (account_balance_high > 0):
-            
-            #generate a series of balance values
-            account_balance_series = generate_series(account_balance_low, account_balance_high)
-            account_balance_list = account_balance_series.tolist()
+                down = [value * (1 - delta) for value in values]
+                up = [value * (1 + delta) for value in values]
+            keys = [item.name + "." + argument for argument in arguments]
+            inputs.append((item.name + " " + label, dict(zip(keys, down)), dict(zip(keys, up))))
+    return inputs
 
-            retList.append({
-                'name': account_name,
-                'starting_balance_list': account_balance_list,
-                'ending_balance_list': [],
-                'distribution_list': []
-            })
-        
-    return retList
-        
+# Which inputs matter most.  Each of the inputs (see get_sensitivity_inputs) is moved down and then up, one at a time,
+# and every one of those scenarios is run in parallel like sweep.  They all get exactly the same random draws as the scenario itself,
+# so the differences are down to the input alone.  Without a seed, seed 0 is used for all of them
+# They're always run in "paths" mode (see PATHS_SETTINGS), so the chance of running out follows every simulation from year to year
+# Returns a DataFrame with a row per input, the one that matters most first, with:
+#     networth down and up:  the low end of the 90% range of networth at age (the last age by default), with the input moved down and up
+#     depletion down and up: the chance of running out of money (see Scenario.get_depletion_probability), with the input moved down and up
+#     and each one's swing, how far apart down and up are
+# They're ranked by the networth swing, then by the depletion swing.  The scenario's own networth and depletion are in results.attrs, see show_sensitivity_graph
+def sensitivity(scenario=None, age=None, delta=0.1, growth_delta=0.01, age_delta=1, max_workers=None):
+    if scenario is None:
+        scenario = default_scenario
+    if age is None:
+        age = scenario.death_age - 1
 
-# Create a "total low" and "total high" column in a dataframe
-# by finding all the items in that DataFrame, creating their series, then adding it all up
-def generate_total(df):
-    
-    item_names = get_item_names(df)
-    
-    #add a column for the low and high values to the df
-    df.insert(len(df.columns), "total low", 0.0)
-    df.insert(len(df.columns), "total high", 0.0)
-    
-    #loop over each year
-    for i, row in df.iterrows():
-        
-        total = pd.Series(np.repeat(0, num_samples))
-        for name in item_names:
-            low = row[name + " low"]
-            high = row[name + " high"]
-            amt_series = generate_series(low, high)
-            new_total = total.add(amt_series)
-            total = new_total
-        
-        amt_low = total.quantile(0.05)
-        amt_high = total.quantile(0.95)
-        df.loc[i, "total low"] = amt_low
-        df.loc[i, "total high"] = amt_high
-
-        
-# This function is called after all values have been entered in the notebook
-# It totals everything up as well as processes all expenses and adjusts investment account balances if necessary
-def generate_totals():
-    generate_total(income_by_year)
-    generate_total(expenses_by_year)
-    process_expenses()
-    generate_total(nonretirement_investments_by_year)
-    generate_total(retirement_investments_by_year)
-    generate_networth()
-    write_csv_files()
-    write_log()
-        
-
-# Generate a very simple "net worth" by adding income to investments and subtracting expenses
-# Note: retirement balances won't show up until retirement age
-def generate_networth():
-    networth_by_year.insert(len(networth_by_year.columns), 'networth low', 0.0)
-    networth_by_year.insert(len(networth_by_year.columns), 'networth high', 0.0)
-
-    for i, row in networth_by_year.iterrows():
-        
-        #get totals
-        income_low = income_by_year.loc[i, "total low"]
-        income_high = income_by_year.loc[i, "total high"]
-        expenses_low = expenses_by_year.loc[i, "total low"]
-        expenses_high = expenses_by_year.loc[i, "total high"]
-        nonret_investments_low = nonretirement_investments_by_year.loc[i, "total low"]
-        nonret_investments_high = nonretirement_investments_by_year.loc[i, "total high"]
-        ret_investments_low = retirement_investments_by_year.loc[i, "total low"]
-        ret_investments_high = retirement_investments_by_year.loc[i, "total high"]
-        
-        #generate series
-        income_series = generate_series(income_low, income_high)
-        expenses_series = generate_series(expenses_low, expenses_high)
-        nonret_investments_series = generate_series(nonret_investments_low, nonret_investments_high)
-        ret_investments_series = generate_series(ret_investments_low, ret_investments_high)
-        
-        networth_without_retirement = income_series.add(nonret_investments_series).subtract(expenses_series)
-        networth_with_retirement = networth_without_retirement.add(ret_investments_series)
-        
-        if row['age'] < retirement_age:
-            networth_by_year.loc[i, 'networth low'] = networth_without_retirement.quantile(0.05)
-            networth_by_year.loc[i, 'networth high'] = networth_without_retirement.quantile(0.95)
+    settings = dict(PATHS_SETTINGS, **({"seed": 0} if scenario.seed is None else {}))
+    inputs = get_sensitivity_inputs(scenario, delta, growth_delta, age_delta)
+    combinations = [settings] + [dict(overrides, **settings) for name, down, up in inputs for overrides in [down, up]]
+
+    outcomes = {}
+    for combination, summary in iterate_sweep(combinations, scenario, max_workers):
+        networth = summary.loc[summary["age"] == age, "networth low"]
+        if len(networth) == 0:
+            raise Exception(age, "is not an age of this scenario")
+        outcomes[repr(sorted(combination.items()))] = (float(networth.iloc[0]), float(summary["depletion"].max()))
+
+    def get_outcome(overrides):
+        return outcomes[repr(sorted(dict(overrides, **settings).items()))]
+
+    rows = []
+    for name, down, up in inputs:
+        networth_down, depletion_down = get_outcome(down)
+        networth_up, depletion_up = get_outcome(up)
+        rows.append({
+            "input": name,
+            "networth down": networth_down,
+            "networth up": networth_up,
+            "networth swing": abs(networth_up - networth_down),
+            "depletion down": depletion_down,
+            "depletion up": depletion_up,
+            "depletion swing": abs(depletion_up - depletion_down)
+        })
+
+    results = pd.DataFrame(rows).sort_values(["networth swing", "depletion swing"], ascending=False, ignore_index=True)
+    results.insert(0, "rank", range(1, len(results) + 1))
+    base_networth, base_depletion = get_outcome({})
+    results.attrs = {"age": age, "networth": base_networth, "depletion": base_depletion}
+    return results
+
+
+#####
+# Settings and results that used to be module globals (num_samples, simulation_mode, networth_by_year, etc) are now on default_scenario
+# So that things like tool.networth_by_year and tool.simulation_mode = "paths" keep working,
+# any attribute this module doesn't have itself is read from, and written to, default_scenario
+#####
+class ScenarioModule(types.ModuleType):
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(default_scenario, name)
+
+    def __setattr__(self, name, value):
+        if (name not in self.__dict__) and hasattr(default_scenario, name):
+            setattr(default_scenario, name, value)
         else:
-            networth_by_year.loc[i, 'networth low'] = networth_with_retirement.quantile(0.05)
-            networth_by_year.loc[i, 'networth high'] = networth_with_retirement.quantile(0.95)
-        
+            super().__setattr__(name, value)
 
-# Given a dataframe shape it into something that can be easily graphed
-def generate_amounts_for_graph(df):
-    
-    # create new dataframe that just holds the values we want to graph
-    all_values = pd.DataFrame({
-        "age":  range(current_age, death_age), 
-        "low":  np.repeat(0, death_age-current_age), 
-        "high": np.repeat(0, death_age-current_age), 
-        "mean": np.repeat(0, death_age-current_age)
-    })
-    
-    # all I'm really doing right now is adding mean, 
-    # but this gives me room for future expansion if I wanted to include percentiles or something
-    for i, row in df.iterrows():
-        age = row["age"]
-        total_low = row["total low"]
-        total_high = row["total high"]
-        total_mean = (total_high + total_low) / 2
-        
-        all_values.loc[i, "low"] = total_low
-        all_values.loc[i, "high"] = total_high
-        all_values.loc[i, "mean"] = total_mean
-
-    return all_values
-
-
-def show_account_types_graph(start_age=0, 
-                             end_age=0, 
-                             yMax=None,
-                             lines=[], 
-                             showRetirementLine=True,
-                             showIncome=True,
-                             showExpenses=True,
-                             showNonRetirement=True,
-                             showRetirement=True
-                            ):
-        
-    #get series massaged for graphing
-    expense_data = generate_amounts_for_graph(expenses_by_year)
-    income_data = generate_amounts_for_graph(income_by_year)
-    nonret_investment_data = generate_amounts_for_graph(nonretirement_investments_by_year)
-    ret_investment_data = generate_amounts_for_graph(retirement_investments_by_year)
-    
-    #create graph
-    fig, ax = plt.subplots(figsize=(20,10))
-    
-    #plot the ranges
-    legends = []
-    
-    if showIncome:
-        ax.fill_between(income_data.age, income_data.low, income_data.high, color="green", alpha=0.2)
-        legends.append("Income")
-    
-    if showNonRetirement:
-        ax.fill_between(nonret_investment_data.age, nonret_investment_data.low, nonret_investment_data.high, color="blue", alpha=0.2)
-        legends.append("Non-Retirement Investments")
-    
-    if showRetirement:
-        ax.fill_between(ret_investment_data.age, ret_investment_data.low, ret_investment_data.high, color="purple", alpha=0.2)
-        legends.append("Retirement Investments")
-    
-    if showExpenses:
-        ax.fill_between(expense_data.age, expense_data.low, expense_data.high, color="red", alpha=0.2)
-        legends.append("Expenses")
-    
-    #set bounds
-    ax.set_ylim(bottom=0, top=yMax)
-    x_left = current_age if start_age == 0 else start_age
-    x_right = death_age if end_age == 0 else end_age
-    ax.set_xlim(left=x_left, right=x_right)
-    
-    #format axes
-    fmt = '${x:,.0f}'
-    tick = ticker.StrMethodFormatter(fmt)
-    ax.yaxis.set_major_formatter(tick)
-    ax.xaxis.set_minor_locator(ticker.AutoMinorLocator())
-    
-    #add grid lines
-    plt.grid()
-    
-    #show retirement line
-    ymin, ymax = ax.get_ylim()
-    text_y = ymax - (ymax * .05)
-    if showRetirementLine:
-        ax.axvline(x=retirement_age)
-        ax.text(x=retirement_age, y=text_y, s="Retirement Investments Available", rotation=270, ha='left', va='top')
-        
-    #show user lines
-    for line in lines:
-        ax.axvline(x=line[0])
-        ax.text(x=line[0], y=text_y, s=line[1], rotation=270, ha='left', va='top')
-    
-    #set labels
-    plt.xlabel('Age')
-    
-    #show legend
-    ax.legend(legends, loc="upper right")
-    
-    #save it as a PNG
-    plt.savefig('../data/account-types-graph.png')
-    
-    #show it in jupyter
-    plt.show()
-    
-    
-def show_networth_graph(start_age=0, 
-                        end_age=0, 
-                        yMax=None,
-                        yMin=None,
-                        lines=[], 
-                        showRetirementLine=True,
-                        ):
-
-    #create graph
-    fig, ax = plt.subplots(figsize=(20,10))
-    
-    nw_low = networth_by_year['networth low']
-    nw_high = networth_by_year['networth high']
-    
-    #get bounds of graph if not set
-    if (yMax is None):
-        yMax = nw_high.max()
-        
-    if (yMin is None):
-        yMin = nw_low.min()
-    
-    #draw everything above zero as green, everything below as red.
-    #overlay the network as a solid white, then do it again as a see-through blue
-    ax.fill_between(networth_by_year.age, 0, yMax, color="green", alpha=0.1)
-    ax.fill_between(networth_by_year.age, 0, yMin, color="red", alpha=0.1)
-    ax.fill_between(networth_by_year.age, nw_low, nw_high, color="white", alpha=1)
-    legend_handle = ax.fill_between(networth_by_year.age, nw_low, nw_high, color="blue", alpha=0.1, label="Networth")
-    
-    ax.plot(networth_by_year.age, nw_high, linewidth=2, color="black")
-    ax.plot(networth_by_year.age, nw_low, linewidth=2, color="black")
-
-    #set bounds
-    ax.set_ylim(bottom=yMin, top=yMax)
-    x_left = current_age if start_age == 0 else start_age
-    x_right = death_age if end_age == 0 else end_age
-    ax.set_xlim(left=x_left, right=x_right)
-    
-    #format axes
-    fmt = '${x:,.0f}'
-    tick = ticker.StrMethodFormatter(fmt)
-    ax.yaxis.set_major_formatter(tick)
-    ax.xaxis.set_minor_locator(ticker.AutoMinorLocator())
-    
-    #add grid lines
-    plt.grid()
-    
-    #show retirement line
-    ymin, ymax = ax.get_ylim()
-    text_y = ymax - (ymax * .05)
-    if showRetirementLine:
-        ax.axvline(x=retirement_age)
-        ax.text(x=retirement_age, y=text_y, s="Retirement Investments Available", rotation=270, ha='left', va='top')
-        
-    #show user lines
-    for line in lines:
-        ax.axvline(x=line[0])
-        ax.text(x=line[0], y=text_y, s=line[1], rotation=270, ha='left', va='top')
-    
-    #set labels
-    plt.xlabel('Age')
-    
-    #show legend
-    ax.legend(handles=[legend_handle])
-    
-    #save it as a PNG
-    plt.savefig('../data/networth-graph.png')
-    
-    #show it in jupyter
-    plt.show()
\ No newline at end of file
+sys.modules[__name__].__class__ = ScenarioModule
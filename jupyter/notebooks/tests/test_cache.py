@@ -0,0 +1,72 @@
+#####
+# Tests for the cache key, see Scenario.get_cache_path
+#
+# Run from jupyter/notebooks with
+#     python -m pytest tests
+#####
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import financeTool as tool
+from test_generate_totals import new_scenario
+
+
+def get_cache_path(tmp_path, **settings):
+    scenario = tool.Scenario()
+    scenario.cache_dir = str(tmp_path)
+    for name, value in settings.items():
+        setattr(scenario, name, value)
+    scenario.setup(2022, 37, 100)
+    return scenario.get_cache_path()
+
+def test_large_correlation_matrices_that_look_the_same_get_different_keys(tmp_path):
+    names = ["account " + str(i) for i in range(60)]
+    correlation = pd.DataFrame(np.eye(60), index=names, columns=names)
+    changed = correlation.copy()
+    changed.iloc[30, 31] = changed.iloc[31, 30] = 0.5
+
+    assert repr(correlation) == repr(changed)
+    assert get_cache_path(tmp_path, return_correlation=correlation) != get_cache_path(tmp_path, return_correlation=changed)
+    assert get_cache_path(tmp_path, return_correlation=correlation) == get_cache_path(tmp_path, return_correlation=correlation.copy())
+
+def test_functions_are_keyed_by_name(tmp_path):
+    assert get_cache_path(tmp_path, distribution_strategy=tool.distribute_proportionally) == get_cache_path(tmp_path, distribution_strategy=tool.distribute_proportionally)
+    with pytest.raises(Exception):
+        get_cache_path(tmp_path, distribution_strategy=lambda balances, shortage, is_retirement, scenario: tool.distribute_in_order(balances, shortage, is_retirement, scenario))
+
+# A scenario that loaded its results from the cache can still run everything again, and gets the same results as one that never used the cache
+@pytest.mark.parametrize("simulation_mode", ["bands", "paths"])
+def test_running_again_after_a_cache_hit(tmp_path, simulation_mode):
+    new_scenario(cache_dir=str(tmp_path), simulation_mode=simulation_mode).generate_totals(write_output=False)
+
+    scenario = new_scenario(cache_dir=str(tmp_path), simulation_mode=simulation_mode)
+    scenario.instrumentation = tool.Instrumentation()
+    scenario.generate_totals(write_output=False)
+    assert scenario.instrumentation.counters["cache hits"] == 1
+
+    scenario.cache_bypass = True
+    scenario.generate_totals(write_output=False)
+    expected = new_scenario(simulation_mode=simulation_mode)
+    expected.generate_totals(write_output=False)
+    np.testing.assert_array_equal(scenario.networth_ledger.totals, expected.networth_ledger.totals)
+
+@pytest.mark.parametrize("simulation_mode", ["bands", "paths"])
+def test_updating_an_item_after_a_cache_hit(tmp_path, simulation_mode):
+    new_scenario(cache_dir=str(tmp_path), simulation_mode=simulation_mode).generate_totals(write_output=False)
+
+    scenario = new_scenario(cache_dir=str(tmp_path), simulation_mode=simulation_mode)
+    scenario.generate_totals(write_output=False)
+    scenario.update_item("Expenses", starting_amt_low=40000, starting_amt_high=50000)
+    scenario.generate_totals(write_output=False)
+
+    expected = new_scenario(simulation_mode=simulation_mode)
+    expected.update_item("Expenses", starting_amt_low=40000, starting_amt_high=50000)
+    expected.generate_totals(write_output=False)
+    np.testing.assert_array_equal(scenario.networth_ledger.totals, expected.networth_ledger.totals)
+    np.testing.assert_array_equal(scenario.nonretirement_investments_ledger.values, expected.nonretirement_investments_ledger.values)
@@ -0,0 +1,62 @@
+#####
+# Tests for generate_totals
+#
+# Run from jupyter/notebooks with
+#     python -m pytest tests
+#####
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import financeTool as tool
+
+
+# The scenario from the notebook, small enough to run quickly
+def new_scenario(**settings):
+    scenario = tool.Scenario()
+    scenario.seed = 1
+    scenario.num_samples = 2000
+    for name, value in settings.items():
+        setattr(scenario, name, value)
+    scenario.setup(2022, 37, 100)
+    scenario.add_income(name="job salary", starting_amt_low=85000, starting_amt_high=100000,
+                        start_age=37, end_age=50, growth_perc_low=.01, growth_perc_high=.05)
+    scenario.add_expense(name="Expenses", starting_amt_low=45000, starting_amt_high=55000,
+                         start_age=37, end_age=100, growth_perc_low=.02, growth_perc_high=.05)
+    scenario.add_nonretirement_investment(name="brokerage account", starting_amt_low=10000, starting_amt_high=10000,
+                                          start_age=37, end_age=100, growth_perc_low=-.02, growth_perc_high=.1,
+                                          annual_contrib_amt_low=20000, annual_contrib_amt_high=25000,
+                                          annual_contrib_start_age=40, annual_contrib_end_age=50)
+    scenario.add_retirement_investment(name="401k", starting_amt_low=205000, starting_amt_high=205000,
+                                       start_age=37, end_age=100, growth_perc_low=-0.02, growth_perc_high=0.15,
+                                       annual_contrib_amt_low=6000, annual_contrib_amt_high=6000,
+                                       annual_contrib_start_age=37, annual_contrib_end_age=50)
+    return scenario
+
+
+@pytest.mark.parametrize("settings", [{}, {"simulation_mode": "paths"}, {"streaming": True}, {"reprojection": "incremental"}, {"recompute": "incremental"}])
+def test_running_again_gives_the_same_results(settings):
+    scenario = new_scenario(**settings)
+    scenario.generate_totals(write_output=False)
+    networth = scenario.networth_ledger.totals.copy()
+    retirement = scenario.retirement_investments_ledger.values.copy()
+    log_length = len(scenario.event_log.to_frame())
+
+    scenario.generate_totals(write_output=False)
+    np.testing.assert_array_equal(scenario.networth_ledger.totals, networth)
+    np.testing.assert_array_equal(scenario.retirement_investments_ledger.values, retirement)
+    assert len(scenario.event_log.to_frame()) == log_length
+
+@pytest.mark.parametrize("simulation_mode", ["bands", "paths"])
+def test_percentiles_can_change_after_items_are_added(simulation_mode):
+    changed = new_scenario(simulation_mode=simulation_mode)
+    changed.percentiles = [50]
+    changed.generate_totals(write_output=False)
+
+    fresh = new_scenario(simulation_mode=simulation_mode, percentiles=[50])
+    fresh.generate_totals(write_output=False)
+    np.testing.assert_array_equal(changed.networth_ledger.totals, fresh.networth_ledger.totals)
+    np.testing.assert_array_equal(changed.retirement_investments_ledger.values, fresh.retirement_investments_ledger.values)
@@ -0,0 +1,33 @@
+#####
+# Tests for showing the graphs
+#
+# Run from jupyter/notebooks with
+#     python -m pytest tests
+#####
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import financeTool as tool
+
+
+# Stands in for matplotlib.pyplot, keeping track of whether show was called
+class Pyplot:
+    def __init__(self, backend):
+        self.backend = backend
+        self.shown = False
+
+    def get_backend(self):
+        return self.backend
+
+    def show(self):
+        self.shown = True
+
+
+@pytest.mark.parametrize("backend, shown", [("Agg", False), ("agg", False), ("pdf", False), ("module://matplotlib_inline.backend_inline", True), ("TkAgg", True)])
+def test_graphs_are_only_shown_by_interactive_backends(backend, shown):
+    plt = Pyplot(backend)
+    tool.show_graph(plt)
+    assert plt.shown == shown
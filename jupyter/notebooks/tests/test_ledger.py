@@ -0,0 +1,33 @@
+#####
+# Tests for Ledger and get_item_names
+#
+# Run from jupyter/notebooks with
+#     python -m pytest tests
+#####
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import financeTool as tool
+from test_generate_totals import new_scenario
+
+
+# Item names that look like statistic columns, and the totals column, don't confuse get_item_names
+def test_item_names_come_from_the_ledger():
+    scenario = new_scenario(num_samples=500)
+    scenario.add_retirement_investment(name="required distribution", starting_amt_low=1000, starting_amt_high=1000,
+                                       start_age=37, end_age=100)
+    scenario.add_expense(name="rent distribution", starting_amt_low=100, starting_amt_high=200, start_age=37, end_age=40)
+    scenario.generate_totals(write_output=False)
+
+    assert tool.get_item_names(scenario.retirement_investments_ledger) == ["401k", "required distribution"]
+    assert tool.get_item_names(scenario.retirement_investments_by_year) == ["401k", "required distribution"]
+    assert tool.get_item_names(scenario.expenses_by_year) == ["Expenses", "rent distribution"]
+
+def test_item_names_need_a_ledger_or_its_frame():
+    with pytest.raises(Exception):
+        tool.get_item_names(pd.DataFrame({"rent low": [1], "rent high": [2]}))
@@ -0,0 +1,36 @@
+#####
+# Tests for solve_spending and solve_retirement_age
+#
+# Run from jupyter/notebooks with
+#     python -m pytest tests
+#####
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import financeTool as tool
+from test_generate_totals import new_scenario
+
+
+# Each try only projects the item the solver changed, the other items keep their samples
+def test_solvers_only_project_the_item_they_change():
+    scenario = new_scenario(num_samples=1000)
+    scenario.instrumentation = tool.Instrumentation()
+
+    result = scenario.solve_spending("Expenses", target=0.1)
+    assert scenario.instrumentation.stages["generate_item_paths"]["calls"] == result["iterations"]
+
+    scenario.instrumentation.reset()
+    result = scenario.solve_retirement_age(target=0.1, income="job salary")
+    assert scenario.instrumentation.stages["generate_item_paths"]["calls"] == result["iterations"]
+
+# The answer is the same as running the scenario from scratch in "paths" mode at that age
+def test_retirement_age_matches_a_full_run():
+    scenario = new_scenario(num_samples=1000)
+    result = scenario.solve_retirement_age(target=0.1, income="job salary")
+    assert result["retirement_age"] > scenario.current_age
+
+    check = tool.scenario_from_spec(scenario.spec(dict(tool.PATHS_SETTINGS, retirement_age=result["retirement_age"], **{"job salary.end_age": result["retirement_age"]})))
+    check.generate_totals(write_output=False)
+    assert check.get_depletion_probability() == result["depletion"]
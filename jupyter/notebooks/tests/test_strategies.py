@@ -0,0 +1,23 @@
+#####
+# Tests for compare_strategies
+#
+# Run from jupyter/notebooks with
+#     python -m pytest tests
+#####
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import financeTool as tool
+from test_generate_totals import new_scenario
+
+
+def test_strategies_are_ranked_by_uncovered_spending():
+    results = tool.compare_strategies(["fixed order", "guardrail"], new_scenario(num_samples=500), max_workers=2)
+    assert list(results["shortfall"]) == sorted(results["shortfall"])
+
+def test_strategies_are_compared_in_paths_mode():
+    bands = tool.compare_strategies(["fixed order"], new_scenario(num_samples=500), max_workers=1)
+    paths = tool.compare_strategies(["fixed order"], new_scenario(num_samples=500, simulation_mode="paths"), max_workers=1)
+    assert bands.equals(paths)